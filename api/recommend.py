@@ -2,15 +2,29 @@ from http.server import BaseHTTPRequestHandler
 import os, json, time
 USE_DB   = bool(os.getenv("DATABASE_URL"))
 PREFER_DB= os.getenv("PREFER_DB","1") == "1"
+MAX_LIMIT= int(os.getenv("MAX_LIMIT","200"))
 
-from core_cached import recommend_from_db
+from core_cached import recommend_cached, recommend_cached_stream, browse, decode_cursor, normalize_filters
 from core import recommend as recommend_live
 
 def _send(r, code, obj):
-    b=json.dumps(obj,ensure_ascii=False).encode("utf-8")
+    b=json.dumps(obj,ensure_ascii=False,default=str).encode("utf-8")
     r.send_response(code); r.send_header("Content-Type","application/json; charset=utf-8")
     r.send_header("Content-Length", str(len(b))); r.end_headers(); r.wfile.write(b)
 
+def _send_ndjson(r, events):
+    """イベントを1行1 JSON（application/x-ndjson）で順に書き出す。ヘッダ送信後の失敗は error 行で知らせる"""
+    r.send_response(200); r.send_header("Content-Type","application/x-ndjson; charset=utf-8")
+    r.send_header("Cache-Control","no-cache"); r.send_header("X-Accel-Buffering","no")
+    r.send_header("Connection","close"); r.end_headers()
+    try:
+        for ev in events:
+            r.wfile.write(json.dumps(ev,ensure_ascii=False,default=str).encode("utf-8")+b"\n"); r.wfile.flush()
+    except (BrokenPipeError, ConnectionResetError):
+        return
+    except Exception as e:
+        r.wfile.write(json.dumps({"type":"error","message":str(e)},ensure_ascii=False).encode("utf-8")+b"\n")
+
 def _json(r):
     try:
         n=int(r.headers.get("content-length","0"))
@@ -33,15 +47,38 @@ class handler(BaseHTTPRequestHandler):
         query  = d.get("query") or None
         scope  = d.get("scope") or "national"
         nocache= (str(d.get("nocache","0"))=="1")
+        stream = str(d.get("stream","0")).lower() in ("1","true") or "application/x-ndjson" in (self.headers.get("accept") or "")
+        # ページング（next_cursor をそのまま cursor に渡す）と絞り込み。view=list は採点なしの軽い一覧
+        cursor = d.get("cursor") or None
+        try: limit=max(1,min(int(d.get("limit") or 40),MAX_LIMIT))
+        except (TypeError,ValueError): limit=40
+        try:
+            if cursor: decode_cursor(cursor)
+            filters=normalize_filters(d)  # 型の合わない値は 400
+        except ValueError as e:
+            return _send(self,400,{"error":str(e)})
+        page   = dict(limit=limit, cursor=cursor, filters=filters)
         t0=time.time()
+        if USE_DB and d.get("view")=="list":
+            try:
+                res = browse(query, **page)
+            except Exception as e:
+                res={"items":[], "next_cursor":None, "excluded":[{"title":"","url":"","reason":str(e)}],
+                     "kpi":{"elapsed_ms":int((time.time()-t0)*1000)}}
+            return _send(self,200,res)
+        if stream and USE_DB and PREFER_DB:
+            return _send_ndjson(self, recommend_cached_stream(profile, query=query, nocache=nocache, **page))
         try:
             if USE_DB and PREFER_DB:
-                res = recommend_from_db(profile, query=query)
+                res = recommend_cached(profile, query=query, nocache=nocache, **page)
             else:
                 res = recommend_live(profile, query=query, scope=scope, force_refresh=nocache)
         except Exception as e:
             res={"items":[], "excluded":[{"title":"","url":"","reason":str(e)}], "kpi":{"elapsed_ms":0}}
         res.setdefault("kpi",{})["elapsed_ms"]=int((time.time()-t0)*1000)
+        if stream:  # ライブ検索は逐次化していないので、まとめて items と done の2行で返す
+            return _send_ndjson(self, [{"type":"items","items":res["items"]},
+                                       {"type":"done","kpi":res["kpi"],"excluded":res.get("excluded",[])}])
         _send(self,200,res)
 
     def do_GET(self):
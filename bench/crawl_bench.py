@@ -0,0 +1,109 @@
+# bench/crawl_bench.py
+# replay_server を立てて crawler をそこへ向け、E2E のスループット・DB往復回数・締切までの余裕を測る。
+# ネットワーク不要。DB は DATABASE_URL の Postgres に書き込むので、使い捨てのローカルDBを指定すること。
+#
+# 使い方:
+#   DATABASE_URL=postgresql://localhost/bench python bench/crawl_bench.py --reset --latency-ms 300 --rl-rate 5
+#   python bench/crawl_bench.py --target crawl-async --p429 0.05 --p-timeout 0.02 --p-huge 0.01
+#   python bench/crawl_bench.py --target orchestrator --batch 20   … タイトル/要約が空の pages 行が対象（--reset 直後は0件）
+#
+# スケジューラは既定で無効（毎回同じ URL 集合を取る）。--sched で有効にして間隔調整の効果を比べる。
+
+from __future__ import annotations
+import os, sys, json, time, argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench.replay_server import start, add_behavior_args, behavior_from_args
+
+def _env(a, base: str):
+    # lib.* / crawl_incremental は import 時に ENV を読むので、import より前に設定する
+    os.environ["HTTP_REPLAY_BASE"] = base
+    os.environ["TIME_BUDGET_SEC"] = str(a.budget_sec)
+    os.environ["HARD_KILL_SEC"] = str(a.budget_sec)
+    os.environ["PARALLEL_WORKERS"] = str(a.workers)
+    os.environ["CRAWL_ASYNC"] = "1" if a.target == "crawl-async" else "0"
+    os.environ["SCHED_ENABLED"] = "1" if a.sched else "0"
+    os.environ["READ_TIMEOUT"] = os.environ["CHUSHO_READ_TIMEOUT"] = str(a.read_timeout)
+    if a.rl_rate is not None:
+        os.environ["RL_RATE"] = str(a.rl_rate)
+    os.environ.setdefault("RUN_ID", f"bench-{int(time.time())}")
+
+def _run_target(a):
+    if a.target == "orchestrator":
+        import orchestrator
+        sys.argv = ["orchestrator", "run", "--lane", "night", "--batch", str(a.batch)]
+        try:
+            orchestrator.main()
+        except SystemExit:
+            pass
+        return None
+    import crawl_incremental
+    crawl_incremental.crawl()
+    return crawl_incremental._saved
+
+def main(argv=None) -> int:
+    p = argparse.ArgumentParser(prog="crawl_bench")
+    p.add_argument("--target", choices=["crawl", "crawl-async", "orchestrator"], default="crawl")
+    p.add_argument("--budget-sec", type=int, default=60)
+    p.add_argument("--workers", type=int, default=6)
+    p.add_argument("--batch", type=int, default=10, help="orchestrator の --batch")
+    p.add_argument("--read-timeout", type=int, default=5)
+    p.add_argument("--rl-rate", type=float, help="ホスト別の初期レート（RL_RATE。未指定なら ENV/既定）")
+    p.add_argument("--sched", action="store_true", help="再クロールスケジューラを有効にする")
+    p.add_argument("--reset", action="store_true",
+                   help="開始前に pages / http_cache / fetch_log を空にする（前回の ETag で一覧が 304 にならないように）")
+    p.add_argument("--port", type=int, default=0)
+    p.add_argument("--json", help="結果を JSON で書き出すパス")
+    add_behavior_args(p)
+    p.set_defaults(hang_sec=None)
+    a = p.parse_args(argv)
+    if not os.getenv("DATABASE_URL"):
+        print("[BENCH] DATABASE_URL が未設定です（使い捨てのローカル Postgres を指定してください）")
+        return 2
+    if a.hang_sec is None:
+        a.hang_sec = a.read_timeout + 5
+
+    os.chdir(ROOT)  # seeds.yaml / schema.sql は相対パスで読まれる
+    srv, base, counts = start(a.port, behavior_from_args(a))
+    _env(a, base)
+    from lib.db import pool_stats, ensure_schema, conn
+    from lib.sink import WB
+    if a.reset:
+        ensure_schema()
+        with conn() as c:
+            c.execute("truncate public.pages, public.http_cache, public.fetch_log", prepare=False)
+
+    rt0 = pool_stats()["round_trips"]
+    t0 = time.time()
+    try:
+        saved = _run_target(a)
+    finally:
+        WB.flush()
+        elapsed = time.time() - t0
+        srv.shutdown()
+
+    requests_ = sum(v for k, v in counts.items() if k not in ("200", "304", "404"))
+    ps = pool_stats()
+    result = {
+        "target": a.target,
+        "elapsed_sec": round(elapsed, 2),
+        "time_to_deadline_sec": round(a.budget_sec - elapsed, 2),  # 負なら締切超過
+        "requests": requests_,
+        "requests_per_sec": round(requests_ / elapsed, 2) if elapsed else 0.0,
+        "responses": {k: counts[k] for k in sorted(counts)},
+        "pages_changed": saved if saved is not None else WB.stats["changed"],
+        "db_round_trips": ps["round_trips"] - rt0,
+        "db_acquire": ps["count"],
+        "db_wait_max_ms": int(ps["max_ms"]),
+        "write_behind": dict(WB.stats),
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if a.json:
+        with open(a.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,134 @@
+# bench/extract_bench.py
+# 抽出処理のオフラインベンチマーク（bench/corpus の保存ページだけを使う。ネットワーク・DB 不要）
+#   対象: extract_from_html / extract_links / extract_links_by_regex / content_hash
+#   HTML をパースするものは入っているパーサ（selectolax / lxml / bs4）ごとに計測する
+#   出力: pages/sec, p50/p99 (ms), tracemalloc のピーク (KB)
+#
+# 使い方:
+#   python bench/extract_bench.py                     … 表を表示
+#   python bench/extract_bench.py --check             … bench/baseline.json を下回ったら exit 1
+#   python bench/extract_bench.py --update-baseline   … 今回の結果で baseline を書き換え
+#   python bench/extract_bench.py --json out.json
+#
+# ENV:
+#   BENCH_ROUNDS (既定: 20)        … コーパス全体を回す回数
+#   BENCH_TOLERANCE (既定: 0.3)    … baseline からこの割合まで遅くなっても許容（CI のばらつき分）
+
+from __future__ import annotations
+import os, sys, json, time, argparse, tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from lib.htmldoc import available_backends, parse_html
+from lib.extractors import extract_from_html, extract_links, extract_links_by_regex
+from lib.util import content_hash
+
+CORPUS_DIR      = os.path.join(ROOT, "bench", "corpus")
+BASELINE_PATH   = os.path.join(ROOT, "bench", "baseline.json")
+BENCH_ROUNDS    = int(os.getenv("BENCH_ROUNDS", "20"))
+BENCH_TOLERANCE = float(os.getenv("BENCH_TOLERANCE", "0.3"))
+
+def load_corpus(kind: str | None = None) -> list[tuple[str, str, str]]:
+    """[(name, url, html)]。kind を指定すると list / detail で絞る"""
+    with open(os.path.join(CORPUS_DIR, "index.json"), encoding="utf-8") as f:
+        index = json.load(f)
+    out = []
+    for name, meta in index.items():
+        if kind and meta["kind"] != kind:
+            continue
+        with open(os.path.join(CORPUS_DIR, name), encoding="utf-8") as f:
+            out.append((name, meta["url"], f.read()))
+    return out
+
+def _cases():
+    """(ケース名, 関数(url, html), コーパス)"""
+    pages = load_corpus()
+    cases = [("extract_links_by_regex", lambda u, h: extract_links_by_regex(h), pages)]
+    for b in available_backends():
+        cases += [
+            (f"extract_from_html[{b}]", lambda u, h, b=b: extract_from_html(u, parse_html(h, b)), pages),
+            (f"extract_links[{b}]",     lambda u, h, b=b: extract_links(u, parse_html(h, b)), pages),
+        ]
+    rows = [(n, u, extract_from_html(u, h)) for n, u, h in pages]
+    cases.append(("content_hash", lambda u, row: content_hash(row), rows))
+    return cases
+
+def _pct(xs: list[float], p: float) -> float:
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(round(p / 100 * (len(xs) - 1))))]
+
+def run_case(fn, pages, rounds: int = BENCH_ROUNDS) -> dict:
+    for _, u, h in pages:  # ウォームアップ（import・正規表現コンパイル等を計測から外す）
+        fn(u, h)
+    lat = []
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for _, u, h in pages:
+            s = time.perf_counter()
+            fn(u, h)
+            lat.append(time.perf_counter() - s)
+    total = time.perf_counter() - t0
+    # メモリは別パス（tracemalloc を有効にすると遅くなるので時間計測とは分ける）
+    tracemalloc.start()
+    for _, u, h in pages:
+        fn(u, h)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"pages_per_sec": round(len(lat) / total, 1),
+            "p50_ms": round(_pct(lat, 50) * 1000, 3),
+            "p99_ms": round(_pct(lat, 99) * 1000, 3),
+            "peak_kb": peak // 1024}
+
+def run_all(rounds: int = BENCH_ROUNDS) -> dict[str, dict]:
+    return {name: run_case(fn, pages, rounds) for name, fn, pages in _cases()}
+
+def check(results: dict[str, dict], baseline: dict, tolerance: float = BENCH_TOLERANCE) -> list[str]:
+    """baseline の pages/sec × (1 - tolerance) を下回ったケースを返す（baseline に無いケースは見ない）"""
+    bad = []
+    for name, base in baseline.get("cases", {}).items():
+        r = results.get(name)
+        if r is None:
+            continue
+        floor = base["pages_per_sec"] * (1 - tolerance)
+        if r["pages_per_sec"] < floor:
+            bad.append(f"{name}: {r['pages_per_sec']} pages/sec < {floor:.1f} (baseline {base['pages_per_sec']})")
+    return bad
+
+def print_table(results: dict[str, dict]):
+    print(f"{'case':<34}{'pages/sec':>11}{'p50 ms':>10}{'p99 ms':>10}{'peak KB':>10}")
+    for name, r in results.items():
+        print(f"{name:<34}{r['pages_per_sec']:>11}{r['p50_ms']:>10}{r['p99_ms']:>10}{r['peak_kb']:>10}")
+
+def main(argv=None) -> int:
+    p = argparse.ArgumentParser(prog="extract_bench")
+    p.add_argument("--rounds", type=int, default=BENCH_ROUNDS)
+    p.add_argument("--json", help="結果を JSON で書き出すパス")
+    p.add_argument("--check", action="store_true", help="baseline を下回ったら exit 1")
+    p.add_argument("--update-baseline", action="store_true")
+    p.add_argument("--baseline", default=BASELINE_PATH)
+    a = p.parse_args(argv)
+
+    results = run_all(a.rounds)
+    print_table(results)
+    if a.json:
+        with open(a.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if a.update_baseline:
+        with open(a.baseline, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "rounds": a.rounds, "cases": results},
+                      f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        print(f"[BENCH] baseline updated: {a.baseline}")
+    if a.check:
+        with open(a.baseline, encoding="utf-8") as f:
+            bad = check(results, json.load(f))
+        for line in bad:
+            print(f"[BENCH] REGRESSION {line}")
+        if bad:
+            return 1
+        print("[BENCH] OK (no regression)")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+# bench/replay_server.py
+# seeds.yaml のホストの代わりに bench/corpus のページを返すローカルHTTPサーバ（オフラインE2Eベンチ用）
+#   GET /{host}/{path}  … lib.http_client は HTTP_REPLAY_BASE を設定するとこの形に書き換えて送る
+#   - corpus/index.json の URL はそのファイルを返す
+#   - それ以外（/koukai/koubo/20xx/k*.html 等）は詳細ページの雛形から URL ごとに内容を変えて返す（PDF・静的ファイルは 404）
+#   - ETag（本文の md5）を付け、If-None-Match が一致すれば 304
+#   - 確率で遅延・429(Retry-After)・応答停止（タイムアウト）・巨大本文を混ぜる（--seed で再現可能）
+#
+# 使い方:
+#   python bench/replay_server.py --port 8765 --latency-ms 200 --p429 0.05
+#   HTTP_REPLAY_BASE=http://127.0.0.1:8765 python orchestrator.py run --lane night
+#   （crawl を回して計測するなら bench/crawl_bench.py がサーバ起動から集計までまとめて行う）
+
+from __future__ import annotations
+import os, re, sys, json, time, random, hashlib, argparse, threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+DETAIL_TEMPLATE = "chusho_k_detail.html"
+_TITLE = re.compile(r"<title>.*?</title>", re.S)
+_ASSET = re.compile(r"\.(?:pdf|js|css|png|jpe?g|gif|svg|ico)$", re.I)
+
+class Behavior:
+    """応答のゆらぎ設定。確率は要求ごとに独立に判定する"""
+    def __init__(self, latency_ms=0, jitter_ms=0, p429=0.0, retry_after=1, p_timeout=0.0,
+                 hang_sec=120.0, p_huge=0.0, huge_bytes=20_000_000, etag=True, seed=0):
+        self.latency_ms, self.jitter_ms = latency_ms, jitter_ms
+        self.p429, self.retry_after = p429, retry_after
+        self.p_timeout, self.hang_sec = p_timeout, hang_sec
+        self.p_huge, self.huge_bytes = p_huge, huge_bytes
+        self.etag = etag
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def roll(self) -> tuple[float, str]:
+        """(遅延秒, 種別 ok/429/timeout/huge)"""
+        with self.lock:
+            r = self.rnd.random()
+            delay = max(0.0, self.latency_ms + self.rnd.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+        for kind, p in (("429", self.p429), ("timeout", self.p_timeout), ("huge", self.p_huge)):
+            if r < p: return delay, kind
+            r -= p
+        return delay, "ok"
+
+class Corpus:
+    def __init__(self, corpus_dir: str = CORPUS_DIR):
+        with open(os.path.join(corpus_dir, "index.json"), encoding="utf-8") as f:
+            index = json.load(f)
+        self.pages: dict[str, bytes] = {}
+        for name, meta in index.items():
+            with open(os.path.join(corpus_dir, name), "rb") as f:
+                self.pages[self._key(meta["url"])] = f.read()
+        with open(os.path.join(corpus_dir, DETAIL_TEMPLATE), encoding="utf-8") as f:
+            self.template = f.read()
+
+    @staticmethod
+    def _key(url: str) -> str:
+        p = urlsplit(url)
+        return f"{p.netloc}{p.path or '/'}"
+
+    def get(self, host: str, path: str) -> bytes | None:
+        body = self.pages.get(f"{host}{path}")
+        if body is not None:
+            return body
+        if _ASSET.search(path):
+            return None
+        # 一覧からリンクされる詳細ページ等：URL ごとにタイトルを変えて content_hash を別にする
+        name = path.rstrip("/").rsplit("/", 1)[-1].removesuffix(".html") or host
+        return _TITLE.sub(f"<title>{name}｜中小企業庁</title>", self.template, count=1).encode("utf-8")
+
+def make_handler(corpus: Corpus, bh: Behavior, counts: Counter):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *a):  # アクセスログは出さない（counts で集計）
+            pass
+
+        def _send(self, code: int, body: bytes = b"", headers: dict | None = None):
+            self.send_response(code)
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if body: self.wfile.write(body)
+
+        def do_GET(self):
+            parts = urlsplit(self.path)
+            host, _, rest = parts.path.lstrip("/").partition("/")
+            delay, kind = bh.roll()
+            if delay: time.sleep(delay)
+            counts[kind] += 1
+            if kind == "429":
+                return self._send(429, b"", {"Retry-After": str(bh.retry_after)})
+            if kind == "timeout":
+                time.sleep(bh.hang_sec)  # クライアントの READ_TIMEOUT 切れを起こす
+                self.close_connection = True
+                return
+            if kind == "huge":
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(bh.huge_bytes))
+                self.end_headers()
+                chunk = b"<p>" + b"x" * 65530 + b"</p>"
+                try:
+                    for _ in range(bh.huge_bytes // len(chunk)):
+                        self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # 上限で打ち切られるのが期待動作
+                self.close_connection = True
+                return
+            body = corpus.get(host, "/" + rest)
+            if body is None:
+                counts["404"] += 1
+                return self._send(404, b"not found", {"Content-Type": "text/plain"})
+            headers = {"Content-Type": "text/html; charset=utf-8"}
+            if bh.etag:
+                etag = '"' + hashlib.md5(body).hexdigest() + '"'
+                headers["ETag"] = etag
+                if self.headers.get("If-None-Match") == etag:
+                    counts["304"] += 1
+                    return self._send(304, b"", {"ETag": etag})
+            counts["200"] += 1
+            self._send(200, body, headers)
+    return Handler
+
+def start(port: int = 0, behavior: Behavior | None = None, corpus_dir: str = CORPUS_DIR):
+    """
+    別スレッドでサーバを起動して (server, base_url, counts) を返す。
+    止めるときは server.shutdown()。
+    """
+    counts: Counter = Counter()
+    srv = ThreadingHTTPServer(("127.0.0.1", port), make_handler(Corpus(corpus_dir), behavior or Behavior(), counts))
+    srv.daemon_threads = True
+    threading.Thread(target=srv.serve_forever, name="replay-server", daemon=True).start()
+    return srv, f"http://127.0.0.1:{srv.server_address[1]}", counts
+
+def add_behavior_args(p: argparse.ArgumentParser):
+    p.add_argument("--latency-ms", type=float, default=0)
+    p.add_argument("--jitter-ms", type=float, default=0)
+    p.add_argument("--p429", type=float, default=0.0, help="429 を返す確率")
+    p.add_argument("--retry-after", type=int, default=1)
+    p.add_argument("--p-timeout", type=float, default=0.0, help="応答を止める確率")
+    p.add_argument("--hang-sec", type=float, default=120.0)
+    p.add_argument("--p-huge", type=float, default=0.0, help="巨大本文を返す確率")
+    p.add_argument("--huge-bytes", type=int, default=20_000_000)
+    p.add_argument("--no-etag", action="store_true")
+    p.add_argument("--seed", type=int, default=0)
+
+def behavior_from_args(a) -> Behavior:
+    return Behavior(a.latency_ms, a.jitter_ms, a.p429, a.retry_after, a.p_timeout,
+                    a.hang_sec, a.p_huge, a.huge_bytes, not a.no_etag, a.seed)
+
+def main(argv=None) -> int:
+    p = argparse.ArgumentParser(prog="replay_server")
+    p.add_argument("--port", type=int, default=8765)
+    add_behavior_args(p)
+    a = p.parse_args(argv)
+    srv, base, counts = start(a.port, behavior_from_args(a))
+    print(f"[REPLAY] serving {CORPUS_DIR} at {base}  (HTTP_REPLAY_BASE={base})")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"[REPLAY] {dict(counts)}")
+    except KeyboardInterrupt:
+        srv.shutdown()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
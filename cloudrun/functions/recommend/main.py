@@ -1,11 +1,53 @@
-from flask import Flask, request, jsonify
-import os, json, psycopg, re, unicodedata
+# 単体でデプロイする関数。lib/respcache.py（応答キャッシュ）と lib/pagesearch.py（検索）を共有する。
+# 両方 vendor.py でこのディレクトリにコピーしてコミット済み。lib 側を変えたら
+#   python cloudrun/functions/recommend/vendor.py を実行してコピーも一緒にコミットする
+from flask import Flask, request, jsonify, Response, stream_with_context
+import os, json, math, time, base64, hashlib, threading, re, unicodedata
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from openai import OpenAI
+from psycopg_pool import ConnectionPool
+from respcache import ResponseCache  # lib/respcache.py のコピー（vendor.py）
+from pagesearch import search_pages, decode_cursor, normalize_filters  # lib/pagesearch.py のコピー（vendor.py）
 
 app=Flask(__name__)
 DSN=os.getenv("DATABASE_URL")
+# DB 接続はインスタンス内のプールから借りる（要求ごとに接続しない。DB_POOL_MAX はインスタンスの同時処理数に合わせる）
+DB_POOL_MAX=int(os.getenv("DB_POOL_MAX","4"))
 OPENAI_MODEL=os.getenv("OPENAI_MODEL","gpt-4o-mini")
 client=OpenAI()
+# 一次ランキング：新しい順に PRERANK_POOL 件を引き、文字 n-gram BM25 ＋ 都道府県/対象経費の一致で並べ替えて
+# LIST_LIMIT 件ずつ返す（各ページの上位 MAX_LLM_ITEMS 件だけ LLM 採点。候補集合を返し切ったら次の PRERANK_POOL 件へ）
+PRERANK_POOL=int(os.getenv("PRERANK_POOL","200"))
+BM25_K1, BM25_B = 1.2, 0.75
+FIELD_W={"title":2.0,"summary":1.0,"target":1.0,"cost_items":1.5}
+PREF_BONUS, COST_BONUS = 8.0, 4.0
+PREFS=("北海道 青森県 岩手県 宮城県 秋田県 山形県 福島県 茨城県 栃木県 群馬県 埼玉県 千葉県 東京都 神奈川県 "
+       "新潟県 富山県 石川県 福井県 山梨県 長野県 岐阜県 静岡県 愛知県 三重県 滋賀県 京都府 大阪府 兵庫県 "
+       "奈良県 和歌山県 鳥取県 島根県 岡山県 広島県 山口県 徳島県 香川県 愛媛県 高知県 福岡県 佐賀県 "
+       "長崎県 熊本県 大分県 宮崎県 鹿児島県 沖縄県").split()
+# 応答キャッシュ（インスタンス内 LRU。respcache.ResponseCache）
+RESP_CACHE_TTL_SEC=float(os.getenv("RESP_CACHE_TTL_SEC","300"))
+RESP_CACHE_MAX=int(os.getenv("RESP_CACHE_MAX","256"))
+RESP_CACHE_GEN_SEC=float(os.getenv("RESP_CACHE_GEN_SEC","5"))
+# LLM 採点は上位 MAX_LLM_ITEMS 件を LLM_BATCH 件ずつ並行に投げる（ストリーム時は終わったバッチから返す）
+LLM_BATCH=int(os.getenv("LLM_BATCH","3"))
+
+def _pref_key(p):
+    """末尾の都/府/県を1文字だけ落とす（"京都府"→"京都"、"東京都"→"東京"。北海道はそのまま）"""
+    return p if p=="北海道" else re.sub("[都府県]$","",p)
+PREF_RE=re.compile("|".join(_pref_key(p) for p in PREFS))
+
+_pool=None; _pool_lock=threading.Lock()
+def _db():
+    """プールの接続（autocommit。Supabase pooler 前提で prepared statement は使わない）"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool=ConnectionPool(DSN,min_size=1,max_size=max(1,DB_POOL_MAX),
+                                 kwargs={"autocommit":True,"prepare_threshold":None},
+                                 check=ConnectionPool.check_connection,name="recommend",open=True)
+    return _pool.connection()
 
 def _norm(s): return unicodedata.normalize("NFKC", s or "")
 def _to_text(x):
@@ -14,20 +56,57 @@ def _to_text(x):
     if isinstance(x,dict): return "、".join(f"{k}:{_to_text(v)}" for k,v in x.items())
     return str(x)
 
-def _search(cur,q,limit=40):
-    if q:
-        cur.execute("""select url,title,summary,rate,cap,target,cost_items,deadline,fiscal_year,
-                              call_no,scheme_type,period_from,period_to,last_fetched
-                         from public.pages
-                        where tokens @@ plainto_tsquery('simple', %s)
-                     order by last_fetched desc limit %s""",(q,limit))
-    else:
-        cur.execute("""select url,title,summary,rate,cap,target,cost_items,deadline,fiscal_year,
-                              call_no,scheme_type,period_from,period_to,last_fetched
-                         from public.pages
-                     order by last_fetched desc limit %s""",(limit,))
-    cols=[d.name for d in cur.description]
-    return [dict(zip(cols,row)) for row in cur]
+FULL_COLS=("url,title,summary,rate,cap,target,cost_items,deadline,deadline_date,fiscal_year,call_no,scheme_type,"
+           "period_from,period_to,last_fetched")
+LEAN_COLS="url,title,rate,cap,deadline,deadline_date,fiscal_year,scheme_type,last_fetched"  # view=list 用
+
+def _search(cur,q,limit=40,cursor=None,filters=None,lean=False):
+    """(行, 次ページのカーソル)。並びは新しい順（pagesearch.search_pages）"""
+    return search_pages(cur,LEAN_COLS if lean else FULL_COLS,q,limit=limit,cursor=cursor,filters=filters)
+
+_NON_WORD=re.compile(r"[\s\W_]+")
+def _grams(s,n=2):
+    """NFKC・小文字化して記号/空白で区切り、各塊を文字 n-gram に（日本語は分かち書き不要）"""
+    out=[]
+    for w in _NON_WORD.split(_norm(s).lower()):
+        if len(w)<=n: out += [w] if w else []
+        else: out += [w[i:i+n] for i in range(len(w)-n+1)]
+    return out
+
+def _prerank(rows,profile,q):
+    """
+    BM25F 風（フィールド重み付き tf）の文字2-gram スコア＋構造化一致で rows を並べ替え、score に一次点を入れる。
+    idf は候補集合から計算する。
+    """
+    qterms=set(_grams(" ".join([_to_text(profile.get("目的")),_to_text(profile.get("対象経費カテゴリ")),q or ""])))
+    pref=_norm(_to_text(profile.get("所在地_都道府県")))
+    pref_key=_pref_key(pref) if pref else pref
+    costs=[_norm(_to_text(x)) for x in (profile.get("対象経費カテゴリ") or []) if x]
+    docs=[]
+    for it in rows:
+        tf=Counter()
+        for f,w in FIELD_W.items():
+            for g in _grams(_to_text(it.get(f))):
+                if g in qterms: tf[g]+=w
+        dl=sum(len(_to_text(it.get(f))) for f in FIELD_W)
+        docs.append((tf,dl))
+    n=len(docs) or 1; avgdl=(sum(dl for _,dl in docs)/n) or 1.0
+    df=Counter(g for tf,_ in docs for g in tf)
+    idf={g:math.log(1+(n-c+0.5)/(c+0.5)) for g,c in df.items()}
+    bm=[sum(idf[g]*v*(BM25_K1+1)/(v+BM25_K1*(1-BM25_B+BM25_B*dl/avgdl)) for g,v in tf.items()) for tf,dl in docs]
+    top=max(bm) if bm and max(bm)>0 else 1.0
+    for it,b in zip(rows,bm):
+        base=40.0+30.0*b/top
+        where=_norm(" ".join(_to_text(it.get(k)) for k in ("title","target","summary")))
+        found=set(PREF_RE.findall(where))
+        if pref_key and found:  # 地域限定の制度：自県なら加点、他県のみなら減点（全国向けは中立）
+            base += PREF_BONUS if pref_key in found else -PREF_BONUS
+        ci=_norm(_to_text(it.get("cost_items")))
+        base += COST_BONUS*sum(1 for c in costs if c and c in ci)
+        base += 2.0 if it.get("rate") else 0.0; base += 2.0 if it.get("cap") else 0.0
+        it["score"]=round(min(base,80.0),1); it.setdefault("why",[])
+    rows.sort(key=lambda x:-x["score"])
+    return rows
 
 def _llm_batch(items,profile):
     # 上位Nのみ採点（まとめて1回）
@@ -53,6 +132,138 @@ def _llm_batch(items,profile):
     except Exception as e:
         for it in items: it.setdefault("why",[]).append(f"llm error: {e}")
 
+RESPONSES=ResponseCache(RESP_CACHE_MAX,RESP_CACHE_TTL_SEC)
+_gen={"value":None,"checked":0.0}; _gen_lock=threading.Lock()
+
+def _generation():
+    with _gen_lock:
+        if time.monotonic()-_gen["checked"]<RESP_CACHE_GEN_SEC: return _gen["value"]
+    with _db() as c:
+        row=c.execute("select gen from public.cache_generation where name='pages'").fetchone()
+    with _gen_lock:
+        _gen["value"]=row[0] if row else None; _gen["checked"]=time.monotonic()
+        return _gen["value"]
+
+def _cache_key(profile,q,cursor=None,filters=None):
+    p=json.dumps(profile,ensure_ascii=False,sort_keys=True)
+    return (_generation(), hashlib.md5(_norm(p).encode("utf-8")).hexdigest(),
+            re.sub(r"\s+"," ",_norm(q or "")).strip(), cursor, json.dumps(filters or {},ensure_ascii=False,sort_keys=True))
+
+def _finish(it,profile):
+    it.setdefault("why_table",[
+        {"項目":"所在地","入力":_to_text(profile.get("所在地_都道府県")),"制度側":_to_text(it.get("target")),"評価":"-"},
+        {"項目":"目的","入力":_to_text(profile.get("目的")),"制度側":_to_text(it.get("summary")),"評価":"-"},
+        {"項目":"対象経費","入力":_to_text(profile.get("対象経費カテゴリ")),"制度側":_to_text(it.get("cost_items")),"評価":"-"},
+    ])
+    return _finish_lean(it)
+
+def _finish_lean(it):
+    lf=it.pop("last_fetched",None)
+    if lf: it["last_checked_at"]=str(lf)
+    if it.get("deadline_date"): it["deadline_date"]=it["deadline_date"].isoformat()
+    return it
+
+def _encode_pool_cursor(start,off):
+    raw=json.dumps([start,off]).encode("ascii")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _decode_pool_cursor(c):
+    """(候補集合の開始カーソル（先頭なら None）, 並べ替えた候補集合の中の位置)。不正なら ValueError"""
+    try:
+        start,off=json.loads(base64.urlsafe_b64decode(c+"="*(-len(c)%4)))
+        if start is not None: decode_cursor(start)
+        if not isinstance(off,int) or isinstance(off,bool) or off<0: raise ValueError(off)
+        return start,off
+    except Exception:
+        raise ValueError(f"bad cursor: {c!r}")
+
+def _page(ranked,start,off,pool_next,limit):
+    """
+    並べ替えた候補集合 ranked の off 件目から limit 件と次ページのカーソル。
+    候補集合を返し切るまでは同じ集合の続き（start, off+limit）、返し切ったら次の集合の先頭（pool_next, 0）
+    """
+    if off+limit<len(ranked): nxt=_encode_pool_cursor(start,off+limit)
+    elif pool_next: nxt=_encode_pool_cursor(pool_next,0)
+    else: nxt=None
+    return ranked[off:off+limit],nxt
+
+def _recommend_stream(profile,q,cursor=None,filters=None):
+    """
+    イベントを順に yield する:
+      items  … 一次ランキング直後の全候補（LLM 採点待ちの上位 MAX_LLM_ITEMS 件は provisional=true）と next_cursor
+               （カーソルは新しい順に引いた PRERANK_POOL 件の候補集合と、並べ替えたその中の位置を指す。_page）
+      scores … LLM_BATCH 件ずつ並行に採点し、終わった順に {"url","score","why"} を返す
+      done   … kpi（first_item_ms と stages_ms: search / prerank / llm）
+    """
+    MAX_LLM=int(os.getenv("MAX_LLM_ITEMS","6")); LIST_LIMIT=int(os.getenv("LIST_LIMIT","30"))
+    t0=time.time()
+    start,off=_decode_pool_cursor(cursor) if cursor else (None,0)
+    with _db() as c, c.cursor() as cur:
+        rows,pool_next=_search(cur,q,limit=max(PRERANK_POOL,LIST_LIMIT),cursor=start,filters=filters)
+    t1=time.time()
+    # まず一次ランキング（ローカル・LLMなし）で候補を絞る
+    rows,nxt=_page(_prerank(rows,profile,q),start,off,pool_next,LIST_LIMIT)
+    rows=[_finish(it,profile) for it in rows]
+    top=rows[:MAX_LLM]
+    yield {"type":"items","items":[dict(it,provisional=i<len(top)) for i,it in enumerate(rows)],"next_cursor":nxt}
+    t2=time.time()
+    # 上位Nだけ LLM 採点（LLM_BATCH 件ずつ並行）
+    chunks=[top[i:i+LLM_BATCH] for i in range(0,len(top),max(1,LLM_BATCH))]
+    if chunks:
+        with ThreadPoolExecutor(max_workers=len(chunks)) as ex:
+            futs={ex.submit(_llm_batch,ch,profile):ch for ch in chunks}
+            for f in as_completed(futs):
+                yield {"type":"scores","items":[{"url":it["url"],"score":it.get("score"),"why":it.get("why"),
+                                                 "provisional":False} for it in futs[f]]}
+    t3=time.time()
+    yield {"type":"done","kpi":{"elapsed_ms":int((t3-t0)*1000),"first_item_ms":int((t2-t0)*1000),
+                                "llm_calls":len(chunks),
+                                "stages_ms":{"search":int((t1-t0)*1000),"prerank":int((t2-t1)*1000),
+                                             "llm":int((t3-t2)*1000)}}}
+
+def _collect(events):
+    """イベント列を一括応答 {"items","next_cursor","kpi"} にまとめる"""
+    items={}; kpi={}; nxt=None
+    for ev in events:
+        if ev["type"]=="items": items={it["url"]:dict(it) for it in ev["items"]}; nxt=ev.get("next_cursor")
+        elif ev["type"]=="scores":
+            for u in ev["items"]:
+                if u["url"] in items: items[u["url"]].update(u)
+        elif ev["type"]=="done": kpi=ev["kpi"]
+    rows=[{k:v for k,v in it.items() if k!="provisional"} for it in items.values()]
+    rows.sort(key=lambda x:(-(x.get("score") or 0), _norm(x.get("title"))))
+    return {"items":rows,"next_cursor":nxt,"kpi":kpi}
+
+def _recommend(profile,q,cursor=None,filters=None):
+    return _collect(_recommend_stream(profile,q,cursor,filters))
+
+def _browse(q,limit,cursor,filters):
+    """view=list：LLM・一次ランキングなし、軽い列だけでキーセット・ページング"""
+    with _db() as c, c.cursor() as cur:
+        rows,nxt=_search(cur,q,limit=limit,cursor=cursor,filters=filters,lean=True)
+    return {"items":[_finish_lean(it) for it in rows],"next_cursor":nxt}
+
+def _ndjson(events):
+    try:
+        for ev in events: yield json.dumps(ev,ensure_ascii=False,default=str)+"\n"
+    except Exception as e:
+        yield json.dumps({"type":"error","message":str(e)},ensure_ascii=False)+"\n"
+
+def _stream(key,profile,q,nocache,cursor,filters):
+    """キャッシュにあれば items と done の2行、無ければ逐次に流し、流し切れたらキャッシュに入れる"""
+    t0=time.time()
+    res=None if nocache else RESPONSES.get(key)
+    if res is not None:
+        ms=int((time.time()-t0)*1000)
+        yield {"type":"items","items":[dict(it,provisional=False) for it in res["items"]],"next_cursor":res.get("next_cursor")}
+        yield {"type":"done","kpi":dict(res.get("kpi") or {},cache="hit",elapsed_ms=ms,first_item_ms=ms)}
+        return
+    evs=[]
+    for ev in _recommend_stream(profile,q,cursor,filters):
+        if ev["type"]=="done": ev["kpi"]["cache"]="bypass" if nocache else "miss"
+        evs.append(ev); yield ev
+    RESPONSES.put(key,_collect(evs))
+
 @app.post("/")
 def handler():
     d=request.get_json(force=True) or {}
@@ -60,29 +271,28 @@ def handler():
              "目的":d.get("goal",""),
              "対象経費カテゴリ":d.get("cost_categories",[])}
     q=d.get("query") or None
-    MAX_LLM=int(os.getenv("MAX_LLM_ITEMS","6"))
-    rows=[]
-    with psycopg.connect(DSN, autocommit=True) as c, c.cursor() as cur:
-        rows=_search(cur,q,limit=int(os.getenv("LIST_LIMIT","30")))
-    # まず軽量スコア（簡易）
-    for it in rows:
-        base=40.0
-        qstr=" ".join([_to_text(profile.get("目的"))]+[_to_text(x) for x in profile.get("対象経費カテゴリ",[])])
-        txt=_to_text(it.get("title"))+" "+_to_text(it.get("summary"))
-        if qstr: base += 6.0*sum(1 for w in set(qstr.split()) if w and w in txt)
-        base += 2.0 if it.get("rate") else 0.0; base += 2.0 if it.get("cap") else 0.0
-        it["score"]=min(base,80.0); it.setdefault("why",[])
-    # 上位Nだけ LLM バッチ採点
-    top=rows[:MAX_LLM]; _llm_batch(top,profile)
-    # 仕上げ
-    for it in rows:
-        it.setdefault("why_table",[
-            {"項目":"所在地","入力":_to_text(profile.get("所在地_都道府県")),"制度側":_to_text(it.get("target")),"評価":"-"},
-            {"項目":"目的","入力":_to_text(profile.get("目的")),"制度側":_to_text(it.get("summary")),"評価":"-"},
-            {"項目":"対象経費","入力":_to_text(profile.get("対象経費カテゴリ")),"制度側":_to_text(it.get("cost_items")),"評価":"-"},
-        ])
-        lf=it.pop("last_fetched",None)
-        if lf: it["last_checked_at"]=str(lf)
-    rows.sort(key=lambda x:(-(x.get("score") or 0), _norm(x.get("title"))))
-    return jsonify({"items":rows,"kpi":{"elapsed_ms":0}})
+    nocache=str(d.get("nocache","0"))=="1"
+    stream=str(d.get("stream","0")).lower() in ("1","true") or "application/x-ndjson" in (request.headers.get("Accept") or "")
+    cursor=d.get("cursor") or None
+    try:
+        if cursor: (decode_cursor if d.get("view")=="list" else _decode_pool_cursor)(cursor)
+        filters=normalize_filters(d)
+    except ValueError as e:
+        return jsonify({"error":str(e)}),400
+    t0=time.time()
+    if d.get("view")=="list":
+        try: limit=max(1,min(int(d.get("limit") or 40),int(os.getenv("MAX_LIMIT","200"))))
+        except (TypeError,ValueError): limit=40
+        res=_browse(q,limit,cursor,filters)
+        return jsonify({**res,"kpi":{"elapsed_ms":int((time.time()-t0)*1000)}})
+    key=_cache_key(profile,q,cursor,filters)
+    if stream:
+        return Response(stream_with_context(_ndjson(_stream(key,profile,q,nocache,cursor,filters))),
+                        mimetype="application/x-ndjson", headers={"Cache-Control":"no-cache","X-Accel-Buffering":"no"})
+    if nocache:
+        res=_recommend(profile,q,cursor,filters); how="bypass"; RESPONSES.put(key,res)
+    else:
+        res,how=RESPONSES.get_or_compute(key,lambda: _recommend(profile,q,cursor,filters))
+    ms=int((time.time()-t0)*1000)  # 一括応答では全件そろってから返る
+    return jsonify({"items":res["items"],"next_cursor":res.get("next_cursor"),"kpi":dict(res.get("kpi") or {},elapsed_ms=ms,first_item_ms=ms,cache=how)})
 # Cloud Functions (gen2) entry: app
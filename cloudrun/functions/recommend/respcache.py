@@ -0,0 +1,62 @@
+# lib/respcache.py
+# recommend の応答キャッシュ。core_cached.py と Cloud Function（cloudrun/functions/recommend）で共有する。
+# Cloud Function は単体でデプロイするので、cloudrun/functions/recommend/vendor.py が
+# このファイルを関数のディレクトリへコピーする（コピーもコミットする。標準ライブラリ以外に依存しないこと）。
+
+from __future__ import annotations
+import time, threading
+from typing import Any, Callable
+from collections import OrderedDict
+from concurrent.futures import Future
+
+class ResponseCache:
+    """
+    LRU + TTL の応答キャッシュ。同じキーの同時要求は1本だけ計算し、他はその結果を待つ（single-flight）。
+    例外はキャッシュせず、待っていた要求にもそのまま投げる。
+    """
+    def __init__(self, maxsize:int, ttl:float):
+        self.maxsize, self.ttl = maxsize, ttl
+        self._lock = threading.Lock()
+        self._data:OrderedDict[Any,tuple[float,Any]] = OrderedDict()
+        self._inflight:dict[Any,Future] = {}
+        self.stats = {"hits":0, "misses":0, "coalesced":0}
+
+    def get_or_compute(self, key, fn:Callable[[],Any])->tuple[Any,str]:
+        """(値, "hit" / "miss" / "coalesced")"""
+        with self._lock:
+            ent=self._data.get(key)
+            if ent and ent[0]>time.monotonic():
+                self._data.move_to_end(key); self.stats["hits"]+=1
+                return ent[1],"hit"
+            fut=self._inflight.get(key)
+            owner=fut is None
+            if owner:
+                fut=self._inflight[key]=Future(); self.stats["misses"]+=1
+            else:
+                self.stats["coalesced"]+=1
+        if not owner:
+            return fut.result(),"coalesced"
+        try:
+            val=fn()
+        except BaseException as e:
+            with self._lock: self._inflight.pop(key,None)
+            fut.set_exception(e); raise
+        with self._lock:
+            self._put(key,val); self._inflight.pop(key,None)
+        fut.set_result(val)
+        return val,"miss"
+
+    def get(self, key):
+        """有効なエントリがあれば値、無ければ None（計算中の要求は待たない。ストリーム応答用）"""
+        with self._lock:
+            ent=self._data.get(key)
+            if not ent or ent[0]<=time.monotonic(): return None
+            self._data.move_to_end(key); self.stats["hits"]+=1
+            return ent[1]
+
+    def put(self, key, val):
+        with self._lock: self._put(key,val)
+
+    def _put(self, key, val):
+        self._data[key]=(time.monotonic()+self.ttl,val); self._data.move_to_end(key)
+        while len(self._data)>self.maxsize: self._data.popitem(last=False)
@@ -0,0 +1,35 @@
+# cloudrun/functions/recommend/vendor.py
+# 関数のソース（このディレクトリ）に lib/ の共有モジュールをコピーする。コピーもコミットする
+# （gcloud functions deploy --source cloudrun/functions/recommend はこのディレクトリしか上げないため）。
+#   python cloudrun/functions/recommend/vendor.py          # lib を変えたら実行して、コピーも一緒にコミット
+#   python cloudrun/functions/recommend/vendor.py --check  # コピーが lib と同じか確認（違えば終了コード 1。CI で実行）
+
+import os, sys, shutil, filecmp, argparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.abspath(os.path.join(HERE, "..", "..", ".."))
+MODULES = ("respcache.py", "pagesearch.py")
+
+def stale() -> list[str]:
+    """lib と中身の違う（または無い）コピーの名前"""
+    return [name for name in MODULES
+            if not os.path.exists(os.path.join(HERE, name))
+            or not filecmp.cmp(os.path.join(ROOT, "lib", name), os.path.join(HERE, name), shallow=False)]
+
+def main() -> int:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--check", action="store_true", help="コピーせず、lib と違うコピーがあれば 1 で終わる")
+    args = ap.parse_args()
+    if args.check:
+        bad = stale()
+        for name in bad:
+            print(f"stale: cloudrun/functions/recommend/{name} (run vendor.py and commit)", file=sys.stderr)
+        return 1 if bad else 0
+    for name in MODULES:
+        src, dst = os.path.join(ROOT, "lib", name), os.path.join(HERE, name)
+        shutil.copyfile(src, dst)
+        print(f"vendored {os.path.relpath(src, ROOT)} -> {os.path.relpath(dst, ROOT)}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
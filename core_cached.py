@@ -1,10 +1,21 @@
-import os, json, time, psycopg, re, unicodedata
-from typing import Dict, Any, List
+import os, json, time, re, unicodedata, hashlib, threading
+from typing import Dict, Any, List, Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from openai import OpenAI
+from lib.respcache import ResponseCache
+from lib.db import conn
+from lib.pagesearch import search_pages, decode_cursor, normalize_filters  # decode_cursor, normalize_filters は api/recommend.py 用
 client = OpenAI()
 
-DSN = os.getenv("DATABASE_URL")
 OPENAI_MODEL = os.getenv("OPENAI_MODEL","gpt-4o-mini")
+# LLM 採点：1プロンプトに SCORE_BATCH 件、同時 SCORE_WORKERS 本。結果は score_cache に SCORE_CACHE_TTL_SEC 秒
+SCORE_BATCH         = int(os.getenv("SCORE_BATCH","5"))
+SCORE_WORKERS       = int(os.getenv("SCORE_WORKERS","4"))
+SCORE_CACHE_TTL_SEC = int(os.getenv("SCORE_CACHE_TTL_SEC","604800"))
+# 応答キャッシュ（プロセス内 LRU）。pages の世代番号は RESP_CACHE_GEN_SEC 秒ごとに確認する
+RESP_CACHE_TTL_SEC  = float(os.getenv("RESP_CACHE_TTL_SEC","300"))
+RESP_CACHE_MAX      = int(os.getenv("RESP_CACHE_MAX","256"))
+RESP_CACHE_GEN_SEC  = float(os.getenv("RESP_CACHE_GEN_SEC","5"))
 
 def _norm(s): 
     if not s: return ""
@@ -16,57 +27,218 @@ def _to_text(x):
     if isinstance(x,dict): return "、".join(f"{k}:{_to_text(v)}" for k,v in x.items())
     return str(x)
 
-def _search(cur, q:str|None, limit:int=40)->list[dict]:
-    if q:
-        cur.execute("""
-          select url,title,summary,rate,cap,target,cost_items,deadline,fiscal_year,call_no,scheme_type,
-                 period_from,period_to,last_fetched
-          from pages
-          where tokens @@ plainto_tsquery('simple', %s)
-          order by last_fetched desc
-          limit %s
-        """, (q, limit))
-    else:
-        cur.execute("""
-          select url,title,summary,rate,cap,target,cost_items,deadline,fiscal_year,call_no,scheme_type,
-                 period_from,period_to,last_fetched
-          from pages order by last_fetched desc limit %s
-        """, (limit,))
-    cols=[d.name for d in cur.description]
-    return [dict(zip(cols,row)) for row in cur]
-
-def _llm_score(it:dict, profile:dict)->tuple[float,list]:
-    t=" ".join(_to_text(it.get(k)) for k in ("title","summary","target","cost_items","rate","cap"))
+FULL_COLS=("url,title,summary,rate,cap,target,cost_items,deadline,deadline_date,fiscal_year,call_no,scheme_type,"
+           "period_from,period_to,last_fetched,content_hash")
+LEAN_COLS="url,title,rate,cap,deadline,deadline_date,fiscal_year,scheme_type,last_fetched"  # 一覧表示用（summary 等なし）
+
+def _search(cur, q:str|None, limit:int=40, cursor:str|None=None, filters:dict|None=None,
+            lean:bool=False)->tuple[list[dict],str|None]:
+    """(行, 次ページのカーソル)。並びは新しい順（lib/pagesearch.search_pages）"""
+    return search_pages(cur, LEAN_COLS if lean else FULL_COLS, q, limit=limit, cursor=cursor, filters=filters)
+
+def _profile_hash(profile:dict)->str:
+    """表記ゆれ（全角/半角・空白・リスト順）と空項目を除いて正規化したプロファイル＋モデル名のハッシュ"""
+    def norm(v):
+        if isinstance(v,(list,tuple,set)): return sorted(n for n in (norm(x) for x in v) if n)
+        if isinstance(v,dict): return {k:norm(x) for k,x in v.items()}
+        return re.sub(r"\s+"," ",_norm(str(v))).strip() if v is not None else ""
+    p={k:v for k,v in norm(profile).items() if v}
+    return hashlib.md5(json.dumps([OPENAI_MODEL,p],ensure_ascii=False,sort_keys=True).encode("utf-8")).hexdigest()
+
+def _llm_batch(items:list[dict], profile:dict)->list[tuple[float,list]|None]:
+    """items をまとめて1回で採点。取れなかった候補は None（キャッシュしない）"""
+    t=[]
+    for i,it in enumerate(items):
+        txt=" ".join(_to_text(it.get(k)) for k in ("title","summary","target","cost_items","rate","cap"))
+        t.append({"idx":i,"text":txt[:1500]})
     prompt = ("あなたは補助金マッチングの査定者です。\n"
-      "以下の事業者プロファイルと制度概要テキストの適合度を0〜100点で出し、"
-      "根拠箇条書きを2〜4点、JSONで返してください。\n\n"
+      "以下の事業者プロファイルと各候補 idx の制度概要テキストの適合度を0〜100点で出し、"
+      "根拠箇条書きを2〜4点、JSON配列で返してください。\n\n"
       f"[事業者]\n{json.dumps(profile,ensure_ascii=False)}\n\n"
-      f"[制度テキスト]\n{t[:4000]}\n\n"
-      "出力: {\"score\": 数値, \"reasons\":[\"...\"] }")
-    score=50.0; reasons=[]
-    try:
-        r=client.chat.completions.create(model=OPENAI_MODEL,
-            messages=[{"role":"user","content":prompt}],temperature=0.2,max_tokens=300)
-        txt=r.choices[0].message.content.strip()
-        m=re.search(r"\{[\s\S]*\}", txt)
-        if m:
-            obj=json.loads(m.group(0)); score=float(obj.get("score",score))
-            reasons=[_norm(x) for x in obj.get("reasons",[]) if x]
-    except Exception as e:
-        reasons=[f"llm error: {e}"]
-    return score, reasons
-
-def recommend_from_db(profile:dict, query:str|None=None, limit:int=40)->dict:
-    t0=time.time(); items=[]
-    with psycopg.connect(DSN, autocommit=True) as c, c.cursor() as cur:
-        rows=_search(cur, query, limit=limit)
-        for r in rows:
-            it=dict(r); sc,why=_llm_score(it, profile)
-            it.update({"score": sc, "why": why, "why_table": [
-                {"項目":"所在地","入力":_to_text(profile.get("所在地_都道府県")),"制度側":_to_text(it.get("target")),"評価":"-"},
-                {"項目":"目的","入力":_to_text(profile.get("目的")),"制度側":_to_text(it.get("summary")),"評価":"-"},
-                {"項目":"対象経費","入力":_to_text(profile.get("対象経費カテゴリ")),"制度側":_to_text(it.get("cost_items")),"評価":"-"},
-            ], "last_checked_at": it.pop("last_fetched", None)})
-            items.append(it)
-    items.sort(key=lambda x: (-(x.get("score") or 0), _norm(x.get("title"))))
-    return {"items":items, "excluded":[], "kpi":{"elapsed_ms": int((time.time()-t0)*1000), "seeds": len(items)}}
\ No newline at end of file
+      f"[候補]\n{json.dumps(t,ensure_ascii=False)}\n\n"
+      "出力: [{\"idx\": 0, \"score\": 数値, \"reasons\":[\"...\"]}, ...]")
+    out:list[tuple[float,list]|None]=[None]*len(items)
+    r=client.chat.completions.create(model=OPENAI_MODEL,
+        messages=[{"role":"user","content":prompt}],temperature=0.2,max_tokens=220*len(items)+100)
+    txt=r.choices[0].message.content.strip()
+    m=re.search(r"\[[\s\S]*\]", txt)
+    for obj in (json.loads(m.group(0)) if m else []):
+        i=obj.get("idx") if isinstance(obj,dict) else None
+        if isinstance(i,int) and 0<=i<len(items):
+            out[i]=(float(obj.get("score",50.0)), [_norm(x) for x in obj.get("reasons",[]) if x])
+    return out
+
+def _cached_scores(cur, ph:str, hashes:list[str])->dict[str,tuple[float,list]]:
+    if not hashes: return {}
+    cur.execute("""select content_hash, score, reasons from public.score_cache
+                    where profile_hash=%s and content_hash = any(%s)
+                      and scored_at > now() - make_interval(secs => %s)""", (ph, hashes, SCORE_CACHE_TTL_SEC))
+    return {h:(float(sc),list(rs or [])) for h,sc,rs in cur.fetchall()}
+
+def _store_scores(cur, ph:str, scored:dict[str,tuple[float,list]])->None:
+    if not scored: return
+    cur.executemany("""insert into public.score_cache(profile_hash, content_hash, score, reasons)
+                       values(%s,%s,%s,%s::jsonb)
+                       on conflict(profile_hash, content_hash) do update
+                         set score=excluded.score, reasons=excluded.reasons, scored_at=now()""",
+                    [(ph,h,sc,json.dumps(rs,ensure_ascii=False)) for h,(sc,rs) in scored.items()])
+
+def _score_iter(rows:list[dict], profile:dict, stats:dict):
+    """
+    rows に score/why を付けながら、確定した行のリストを順に yield する。
+    最初に score_cache にあった行（0件でも1回）、以降は SCORE_BATCH 件ずつ SCORE_WORKERS 本並行で
+    LLM 採点し、バッチが終わった順に yield。最後に新しい採点を score_cache に書く。
+    プールの接続は score_cache の読み書きの間だけ借りる（LLM を待つ間は返しておく）。
+    stats には cache_hits / llm_calls / cache_ms / llm_ms を入れる。
+    """
+    t0=time.time()
+    ph=_profile_hash(profile)
+    with conn() as c, c.cursor() as cur:
+        cached=_cached_scores(cur, ph, list({r["content_hash"] for r in rows if r.get("content_hash")}))
+    hit,todo=[],[]
+    for r in rows:
+        if r.get("content_hash") in cached:
+            r["score"],r["why"]=cached[r["content_hash"]]; hit.append(r)
+        else: todo.append(r)
+    batches=[todo[i:i+SCORE_BATCH] for i in range(0,len(todo),max(1,SCORE_BATCH))]
+    stats.update(cache_hits=len(hit), llm_calls=len(batches), cache_ms=int((time.time()-t0)*1000))
+    yield hit
+    t1=time.time(); fresh:dict[str,tuple[float,list]]={}
+
+    def run(batch):
+        try: return batch,_llm_batch(batch,profile),None
+        except Exception as e: return batch,[None]*len(batch),e
+
+    if batches:
+        with ThreadPoolExecutor(max_workers=max(1,min(SCORE_WORKERS,len(batches)))) as ex:
+            for f in as_completed([ex.submit(run,b) for b in batches]):
+                batch,res,err=f.result()
+                for r,sc in zip(batch,res):
+                    if sc is None:
+                        r["score"],r["why"]=50.0,[f"llm error: {err}" if err else "llm error: no score"]
+                        continue
+                    r["score"],r["why"]=sc
+                    if r.get("content_hash"): fresh[r["content_hash"]]=sc
+                yield batch
+    if fresh:
+        with conn() as c, c.cursor() as cur: _store_scores(cur, ph, fresh)
+    stats["llm_ms"]=int((time.time()-t1)*1000)
+
+def _item(r:dict, profile:dict)->dict:
+    it=dict(r); it.pop("content_hash", None)
+    it.update({"why_table": [
+        {"項目":"所在地","入力":_to_text(profile.get("所在地_都道府県")),"制度側":_to_text(it.get("target")),"評価":"-"},
+        {"項目":"目的","入力":_to_text(profile.get("目的")),"制度側":_to_text(it.get("summary")),"評価":"-"},
+        {"項目":"対象経費","入力":_to_text(profile.get("対象経費カテゴリ")),"制度側":_to_text(it.get("cost_items")),"評価":"-"},
+    ], "last_checked_at": it.pop("last_fetched", None)})
+    return it
+
+def recommend_stream(profile:dict, query:str|None=None, limit:int=40, cursor:str|None=None, filters:dict|None=None):
+    """
+    recommend_from_db の逐次版。次のイベント dict を順に yield する（NDJSON の1行ずつに相当）:
+      {"type":"items","items":[...],"next_cursor":...}   検索直後に全候補。score_cache にあれば確定点、無ければ仮点50 と provisional=true
+      {"type":"scores","items":[{"url","score","why","provisional":false}, ...]}   LLM バッチが終わるたび
+      {"type":"done","kpi":{...}}      first_item_ms と stages_ms（search / cache / llm）を含む
+    """
+    t0=time.time(); stats:dict={}
+    with conn() as c, c.cursor() as cur:
+        rows,nxt=_search(cur, query, limit=limit, cursor=cursor, filters=filters)
+    search_ms=int((time.time()-t0)*1000)
+    it=_score_iter(rows, profile, stats)
+    done={id(r) for r in next(it)}
+    items=[]
+    for r in rows:
+        x=_item(r, profile)
+        if id(r) not in done: x.update(score=50.0, why=[])
+        x["provisional"]=id(r) not in done
+        items.append(x)
+    items.sort(key=lambda x: -(x.get("score") or 0))
+    yield {"type":"items","items":items,"next_cursor":nxt}
+    first_ms=int((time.time()-t0)*1000)
+    for batch in it:
+        yield {"type":"scores","items":[{"url":r["url"],"score":r.get("score"),"why":r.get("why"),"provisional":False}
+                                        for r in batch]}
+    yield {"type":"done","kpi":{"elapsed_ms": int((time.time()-t0)*1000), "first_item_ms": first_ms,
+                                "seeds": len(rows), "cache_hits": stats["cache_hits"], "llm_calls": stats["llm_calls"],
+                                "stages_ms": {"search": search_ms, "cache": stats["cache_ms"], "llm": stats.get("llm_ms",0)}}}
+
+def collect_stream(events)->dict:
+    """recommend_stream のイベント列を一括応答（items / excluded / kpi）にまとめる"""
+    items:dict[str,dict]={}; kpi:dict={}; nxt=None
+    for ev in events:
+        if ev["type"]=="items": items={x["url"]:x for x in ev["items"]}; nxt=ev.get("next_cursor")
+        elif ev["type"]=="scores":
+            for u in ev["items"]:
+                if u["url"] in items: items[u["url"]].update(u)
+        elif ev["type"]=="done": kpi=ev["kpi"]
+    out=[{k:v for k,v in x.items() if k!="provisional"} for x in items.values()]
+    out.sort(key=lambda x: (-(x.get("score") or 0), _norm(x.get("title"))))
+    return {"items":out, "excluded":[], "next_cursor":nxt, "kpi":kpi}
+
+def recommend_from_db(profile:dict, query:str|None=None, limit:int=40, cursor:str|None=None,
+                      filters:dict|None=None)->dict:
+    res=collect_stream(recommend_stream(profile, query=query, limit=limit, cursor=cursor, filters=filters))
+    res["kpi"]["first_item_ms"]=res["kpi"]["elapsed_ms"]  # 一括応答では全件そろってから返る
+    return res
+
+RESPONSES=ResponseCache(RESP_CACHE_MAX, RESP_CACHE_TTL_SEC)
+_gen={"value":None, "checked":0.0}; _gen_lock=threading.Lock()
+
+def _generation()->int|None:
+    """pages の世代番号（RESP_CACHE_GEN_SEC 秒はメモリの値を使う）"""
+    with _gen_lock:
+        if time.monotonic()-_gen["checked"]<RESP_CACHE_GEN_SEC: return _gen["value"]
+    with conn() as c:
+        row=c.execute("select gen from public.cache_generation where name='pages'").fetchone()
+    with _gen_lock:
+        _gen["value"]=row[0] if row else None; _gen["checked"]=time.monotonic()
+        return _gen["value"]
+
+def _cache_key(profile:dict, query:str|None, limit:int, cursor:str|None=None, filters:dict|None=None):
+    f=json.dumps({k:v for k,v in (filters or {}).items() if v},ensure_ascii=False,sort_keys=True)
+    return (_generation(), _profile_hash(profile), re.sub(r"\s+"," ",_norm(query or "")).strip(), limit, cursor, f)
+
+def recommend_cached(profile:dict, query:str|None=None, limit:int=40, nocache:bool=False,
+                     cursor:str|None=None, filters:dict|None=None)->dict:
+    """
+    recommend_from_db の応答キャッシュ版。キーは（pages 世代, 正規化プロファイル, 正規化クエリ, limit, カーソル, 絞り込み）。
+    nocache=True なら常に計算し直す（結果はキャッシュに入れ直す）。
+    """
+    key=_cache_key(profile, query, limit, cursor, filters)
+    run=lambda: recommend_from_db(profile, query=query, limit=limit, cursor=cursor, filters=filters)
+    if nocache:
+        res=run(); how="bypass"
+        RESPONSES.put(key,res)
+    else:
+        res,how=RESPONSES.get_or_compute(key, run)
+    # 呼び出し側が kpi を書き換えるので共有オブジェクトは返さない
+    res=dict(res); res["kpi"]=dict(res.get("kpi") or {}, cache=how)
+    return res
+
+def recommend_cached_stream(profile:dict, query:str|None=None, limit:int=40, nocache:bool=False,
+                            cursor:str|None=None, filters:dict|None=None):
+    """
+    recommend_stream の応答キャッシュ版。キャッシュにあれば items（確定点）と done を即返す。
+    無ければ逐次で計算し、最後まで流し切れたら一括応答の形でキャッシュに入れる
+    （最初の1件を遅らせないため、計算中の同じ要求は待ち合わせない）。
+    """
+    t0=time.time(); key=_cache_key(profile, query, limit, cursor, filters)
+    res=None if nocache else RESPONSES.get(key)
+    if res is not None:
+        yield {"type":"items","items":[dict(x, provisional=False) for x in res["items"]],"next_cursor":res.get("next_cursor")}
+        ms=int((time.time()-t0)*1000)
+        yield {"type":"done","kpi":dict(res.get("kpi") or {}, cache="hit", elapsed_ms=ms, first_item_ms=ms)}
+        return
+    evs=[]
+    for ev in recommend_stream(profile, query=query, limit=limit, cursor=cursor, filters=filters):
+        if ev["type"]=="done": ev["kpi"]["cache"]="bypass" if nocache else "miss"
+        evs.append(ev); yield ev
+    RESPONSES.put(key, collect_stream(evs))
+
+def browse(query:str|None=None, limit:int=40, cursor:str|None=None, filters:dict|None=None)->dict:
+    """一覧表示用：LLM 採点なし・軽い列だけでキーセット・ページング（next_cursor が null なら最後のページ）"""
+    t0=time.time()
+    with conn() as c, c.cursor() as cur:
+        rows,nxt=_search(cur, query, limit=limit, cursor=cursor, filters=filters, lean=True)
+    for r in rows: r["last_checked_at"]=r.pop("last_fetched", None)
+    return {"items":rows, "next_cursor":nxt, "kpi":{"elapsed_ms": int((time.time()-t0)*1000), "seeds": len(rows)}}
@@ -1,13 +1,17 @@
 from __future__ import annotations
-import os, re, time, threading, yaml
+import os, re, time, heapq, asyncio, logging, threading, yaml
 from typing import List, Set
-from urllib.parse import urlsplit, urljoin
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from bs4 import BeautifulSoup
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
 
-from lib.http_client import conditional_fetch
-from lib.extractors import extract_from_html, extract_from_text
-from lib.db import conn, upsert_http_meta, upsert_page, log_fetch, ensure_schema
+from lib.http_client import conditional_fetch, conditional_fetch_async, async_session, aiohttp, acquire, RetryLater
+from lib import ratelimit
+from lib.extractors import extract_from_html, extract_from_text, extract_links, extract_links_by_regex
+from lib.pdf import row_from_pdf
+from lib import bodystore
+from lib.db import conn, ensure_schema, http_meta_values
+from lib.sink import WB
+from lib.schedule import due
 
 try:
     from tavily import TavilyClient
@@ -21,11 +25,12 @@ MAX_PAGES_PER_RUN = int(os.getenv("MAX_PAGES_PER_RUN", "120"))
 MAX_PER_DOMAIN    = int(os.getenv("MAX_PER_DOMAIN", "50"))
 PARALLEL_WORKERS  = int(os.getenv("PARALLEL_WORKERS", "6"))
 PER_HOST_LIMIT    = int(os.getenv("PER_HOST_LIMIT", "2"))
+CRAWL_ASYNC       = os.getenv("CRAWL_ASYNC", "0") == "1"
+MAX_REQUEUE       = int(os.getenv("MAX_REQUEUE", "2"))   # 429/5xx を再投入する回数
 DOC_TYPES: Set[str] = {"text/html", "application/xhtml+xml", "application/pdf"}
 ASSET_RE  = re.compile(r'\.(js|mjs|css|png|jpe?g|gif|svg|ico|json|map|woff2?|ttf|eot|mp4|webm)($|\?)', re.I)
 
 ALLOWED_HOSTS: Set[str] = set()
-RUN_ID = os.getenv("RUN_ID","")
 
 def allowed(u: str) -> bool:
     try: host=urlsplit(u).netloc
@@ -44,29 +49,17 @@ def load_seeds(path="seeds.yaml")->List[dict]:
     ALLOWED_HOSTS=set(cfg.get("allowed_hosts",[]))
     return cfg.get("sources",[])
 
-def L(c, url, status, took, msg=None):
-    if RUN_ID: msg = f"run={RUN_ID}; " + (msg or "")
-    log_fetch(c, url, status, took, msg)
-
-def extract_links(base_url: str, html: str) -> List[str]:
-    soup=BeautifulSoup(html, "html.parser")
-    out=[]
-    for a in soup.find_all("a", href=True):
-        href=a.get("href")
-        if not href or href.startswith("#") or href.startswith("javascript:"): continue
-        out.append(urljoin(base_url, href))
-    seen=set(); uniq=[]
-    for u in out:
-        if u not in seen: seen.add(u); uniq.append(u)
-    return uniq
-
-URL_RE=re.compile(r'https?://(?:www\.)?(?:chusho\.meti\.go\.jp|meti\.go\.jp|jgrants-portal\.go\.jp)[^\s"\'>)]+', re.I)
-def extract_links_by_regex(html: str)->List[str]:
-    out=URL_RE.findall(html or "")
-    seen=set(); uniq=[]
-    for u in out:
-        if u not in seen: seen.add(u); uniq.append(u)
-    return uniq
+LANE = "crawl"
+
+def L(url, status, took, msg=None):
+    WB.log_fetch(url, status, took, msg, lane=LANE)
+
+def _validators(u: str)->tuple:
+    """(etag, last_modified, body_hash)"""
+    with conn() as c:
+        cur=c.cursor()
+        cur.execute("select etag, last_modified, body_hash from public.http_cache where url=%s",(u,), prepare=False)
+        return cur.fetchone() or (None,None,None)
 
 _saved=0; _lock=threading.Lock()
 host_sem:dict[str,threading.Semaphore]={}; host_lock=threading.Lock()
@@ -78,95 +71,272 @@ def _inc(n=1):
     global _saved
     with _lock: _saved += n
 
-def process_detail(u:str, deadline:float)->None:
-    if time.time()>deadline:
-        with conn() as c: L(c,u,"skip",0,"deadline"); return
-    host=urlsplit(u).netloc
-    with _host_sem(host):
+def _changed(_u:str)->None: _inc(1)
+
+def _handle_detail(u:str, res:tuple, prev_hash:str|None=None)->None:
+    html,new_etag,new_lm,ctype,status,took=res
+    h=bodystore.body_hash(html)
+    # body_hash は抽出した pages 行が書けた時だけ（upsert_page の http_meta）。ここで書くと、
+    # 型違い・抽出や書き込みの失敗でも次回「同じ本文」として飛ばしてしまう
+    WB.upsert_http_meta(u,new_etag,new_lm,status)
+    if html is None: L(u,"304",took,None); return
+    if ctype and ctype.lower() not in DOC_TYPES:
+        L(u,"skip",took,f"ctype={ctype}"); return
+    if h==prev_hash:
+        # 条件付きGETを無視して同じ本文を返すサーバ：解析せずに未変更扱い
+        L(u,"skip",took,"same body"); return
+    bodystore.put(html,h)
+    row=row_from_pdf(u,html) if ctype=="application/pdf" else extract_from_html(u,html)
+    WB.upsert_page(row,took,None,lane=LANE,on_change=_changed,
+                   http_meta=http_meta_values(u,new_etag,new_lm,status,h))
+
+def _fallback(u:str, e:Exception)->None:
+    if tv:
         try:
-            with conn() as c:
-                cur=c.cursor()
-                cur.execute("select etag, last_modified from public.http_cache where url=%s",(u,), prepare=False)
-                petag,plm=cur.fetchone() or (None,None)
-                html,new_etag,new_lm,ctype,status,took=conditional_fetch(u,petag,plm)
-                upsert_http_meta(c,u,new_etag,new_lm,status)
-                if html is None: L(c,u,"304",took,None); return
-                if ctype and ctype.lower() not in DOC_TYPES:
-                    L(c,u,"skip",took,f"ctype={ctype}"); return
-                row=extract_from_html(u,html)
-                changed=upsert_page(c,row)
-                L(c,u,"ok" if changed else "skip",took,None)
-                if changed: _inc(1); return
-        except Exception as e:
-            if tv:
-                try:
-                    raw=None
-                    if hasattr(tv,"extract"): raw=tv.extract(u).get("content")  # type: ignore[attr-defined]
-                    if not raw:
-                        r=tv.search(u, search_depth="basic", max_results=1,
-                                    include_answer=False, include_raw_content=True)
-                        raw=(r.get("results") or [{}])[0].get("raw_content")
-                    if raw:
-                        with conn() as c:
-                            row=extract_from_text(u,raw)
-                            changed=upsert_page(c,row)
-                            L(c,u,"ok" if changed else "skip",0,"fallback: raw")
-                            if changed: _inc(1); return
-                except Exception as e2:
-                    with conn() as c: L(c,u,"ng",0,f"fallback error: {e2}"); return
-            with conn() as c: L(c,u,"ng",0,str(e)); return
+            raw=None
+            if hasattr(tv,"extract"): raw=tv.extract(u).get("content")  # type: ignore[attr-defined]
+            if not raw:
+                r=tv.search(u, search_depth="basic", max_results=1,
+                            include_answer=False, include_raw_content=True)
+                raw=(r.get("results") or [{}])[0].get("raw_content")
+            if raw:
+                row=extract_from_text(u,raw)
+                WB.upsert_page(row,0,"fallback: raw",lane=LANE,on_change=_changed)
+                return
+        except Exception as e2:
+            L(u,"ng",0,f"fallback error: {e2}"); return
+    L(u,"ng",0,str(e))
+
+def process_detail(u:str, deadline:float)->RetryLater|None:
+    """詳細ページを1件処理。429/5xx はスレッドで待たずに RetryLater を返す（呼び出し側が再投入）"""
+    if time.time()>deadline:
+        L(u,"skip",0,"deadline"); return None
+    try:
+        acquire(u)  # レート待ちは枠の外で（待っている間に同じホストの他の取得を止めない）
+        with _host_sem(urlsplit(u).netloc):
+            petag,plm,phash=_validators(u)
+            _handle_detail(u,conditional_fetch(u,petag,plm,acquired=True),phash)
+    except RetryLater as e:
+        return e
+    except Exception as e:
+        _fallback(u,e)
+    return None
+
+def _listing_candidates(src:dict, list_url:str, html:str|None, ctype:str|None)->tuple[int,int,List[str]]:
+    include=[re.compile(p) for p in src.get("include",[])]; exclude=[re.compile(p) for p in src.get("exclude",[])]
+    anchors=extract_links(list_url,html) if html and (not ctype or ctype.lower() in DOC_TYPES) else []
+    regex_found=extract_links_by_regex(html or "")
+
+    def ok(u:str)->bool:
+        if include and not any(p.search(u) for p in include): return False
+        if exclude and any(p.search(u) for p in exclude): return False
+        return allowed(u) and is_document_url(u)
+
+    uniq=list(dict.fromkeys(u for u in (anchors+regex_found) if ok(u)))
+    with conn() as c: cand=due(c,uniq)
+    return len(anchors),len(regex_found),cand
+
+def _listing_due(list_url:str, deadline:float)->bool:
+    if time.time()>deadline: return False
+    with conn() as c: list_due=bool(due(c,[list_url],kind="list"))
+    if not list_due: L(list_url,"list",0,"not due")
+    return list_due
+
+def process_listing(src:dict, deadline:float)->tuple[str,int,int,List[str]]|RetryLater|None:
+    """
+    一覧ページを取得して、include/exclude・許可ホスト・スケジューラを通した詳細URL候補を返す。
+    戻り値: (list_url, anchors件数, regex件数, 候補URL)。締切超過・取得時期前は None。
+    429/5xx は process_detail と同じく RetryLater を返す（呼び出し側が一覧ごと再投入）
+    """
+    list_url=src["url"]
+    if not _listing_due(list_url,deadline): return None
+
+    html=None; ctype=None
+    try:
+        acquire(list_url)
+        with _host_sem(urlsplit(list_url).netloc):
+            etag,lm,_=_validators(list_url)
+            html,new_etag,new_lm,ctype,status,took=conditional_fetch(list_url,etag,lm,acquired=True)
+            WB.upsert_http_meta(list_url,new_etag,new_lm,status)
+            if html is None: L(list_url,"304",took,None)  # スケジューラの未変更履歴になる
+    except RetryLater as e:
+        return e
+    except Exception as e:
+        L(list_url,"ng",0,f"list error: {e}")
+    return (list_url,)+_listing_candidates(src,list_url,html,ctype)
+
+class _Caps:
+    """MAX_PER_DOMAIN / max_new / 重複投入の判定（メインスレッド・イベントループからのみ呼ぶ）"""
+    def __init__(self):
+        self.per_domain:dict[str,int]={}; self.queued:Set[str]=set()
+    def take(self, src:dict, res:tuple)->List[str]:
+        list_url,n_anchor,n_regex,cand=res
+        max_new=int(src.get("max_new",20))
+        filtered=[]
+        for u in cand:
+            if u in self.queued: continue
+            host=urlsplit(u).netloc; cnt=self.per_domain.get(host,0)
+            if cnt<MAX_PER_DOMAIN: filtered.append(u); self.per_domain[host]=cnt+1
+            if len(filtered)>=max_new: break
+        self.queued.update(filtered)
+        L(list_url,"list",0,f"anchors={n_anchor}, regex={n_regex}, due={len(cand)}, candidates={len(filtered)}")
+        return filtered
+
+def _stop(deadline:float)->bool:
+    if time.time()>deadline: return True
+    # _saved は flush 時に増えるので、溜まっている分で上限に届きうるなら先に flush して確定させる
+    if _saved<MAX_PAGES_PER_RUN<=_saved+WB.pending_pages(): WB.flush()
+    return _saved>=MAX_PAGES_PER_RUN
+
+class _Requeue:
+    """RetryLater を受けたURL（一覧なら src も）を delay 後に再投入するための待ち行列（MAX_REQUEUE 回まで）"""
+    def __init__(self):
+        self.heap:list[tuple[float,str]]=[]; self.tries:dict[str,int]={}; self.src:dict[str,dict]={}
+    def allow(self, e:RetryLater, deadline:float)->bool:
+        n=self.tries.get(e.url,0)
+        if n>=MAX_REQUEUE or time.time()+e.delay>deadline:
+            L(e.url,"ng",0,f"gave up: {e}"); return False
+        self.tries[e.url]=n+1; return True
+    def push(self, e:RetryLater, deadline:float, src:dict|None=None)->None:
+        if not self.allow(e,deadline): return
+        if src is not None: self.src[e.url]=src
+        heapq.heappush(self.heap,(time.time()+e.delay,e.url))
+    def ready(self)->List[tuple[str,dict|None]]:
+        """期限の来た (URL, 一覧なら src / 詳細なら None)"""
+        out=[]
+        while self.heap and self.heap[0][0]<=time.time():
+            u=heapq.heappop(self.heap)[1]
+            out.append((u,self.src.pop(u,None)))
+        return out
+    def next_in(self)->float:
+        return max(0.0,self.heap[0][0]-time.time()) if self.heap else 1.0
+
+def _log_rates()->None:
+    for host,st in ratelimit.stats().items():
+        logging.info("rate %s: %s", host, st)
 
 def crawl()->None:
+    """
+    全ソースを1本のパイプラインで処理する：
+    一覧取得も詳細取得も同じワーカープールに流し、一覧が返ってきた順に詳細URLを投入する。
+    遅いホストの一覧が他ソースの詳細処理を止めない（PER_HOST_LIMIT / MAX_PER_DOMAIN / max_new は従来どおり）。
+    CRAWL_ASYNC=1 かつ aiohttp があれば crawl_async() で処理する。
+    """
+    if CRAWL_ASYNC and aiohttp is not None:
+        asyncio.run(crawl_async()); return
     ensure_schema()
     sources=load_seeds()
     deadline=time.time()+TIME_BUDGET_SEC
     global _saved; _saved=0
-    per_domain:dict[str,int]={}
-
-    with conn() as c_main:
-        for src in sources:
-            if time.time()>deadline: break
-            list_url=src["url"]; include=[re.compile(p) for p in src.get("include",[])]; exclude=[re.compile(p) for p in src.get("exclude",[])]
-            max_new=int(src.get("max_new",20))
-
-            cur=c_main.cursor()
-            cur.execute("select etag, last_modified from public.http_cache where url=%s",(list_url,), prepare=False)
-            etag,lm=cur.fetchone() or (None,None)
-            html=None; ctype=None
-            try:
-                html,new_etag,new_lm,ctype,status,took=conditional_fetch(list_url,etag,lm)
-                upsert_http_meta(c_main,list_url,new_etag,new_lm,status)
-            except Exception as e:
-                L(c_main,list_url,"ng",0,f"list error: {e}")
-
-            anchors=extract_links(list_url,html) if html and (not ctype or ctype.lower() in DOC_TYPES) else []
-            regex_found=extract_links_by_regex(html or "")
-
-            def ok(u:str)->bool:
-                if include and not any(p.search(u) for p in include): return False
-                if exclude and any(p.search(u) for p in exclude): return False
-                return allowed(u) and is_document_url(u)
-
-            cand=[u for u in (anchors+regex_found) if ok(u)]
-            seen=set(); uniq=[]
-            for u in cand:
-                if u not in seen: seen.add(u); uniq.append(u)
-            cand=uniq
-
-            filtered=[]
-            for u in cand:
-                host=urlsplit(u).netloc; cnt=per_domain.get(host,0)
-                if cnt<MAX_PER_DOMAIN: filtered.append(u); per_domain[host]=cnt+1
-                if len(filtered)>=max_new: break
-
-            L(c_main,list_url,"list",0,f"anchors={len(anchors)}, regex={len(regex_found)}, candidates={len(filtered)}")
-            if not filtered: continue
-
-            with ThreadPoolExecutor(max_workers=PARALLEL_WORKERS) as ex:
-                futures=[ex.submit(process_detail,u,deadline) for u in filtered]
-                for _ in as_completed(futures):
-                    if time.time()>deadline or _saved>=MAX_PAGES_PER_RUN:
-                        for f in futures: f.cancel()
-                        break
-
-            if time.time()>deadline or _saved>=MAX_PAGES_PER_RUN: break
+    caps=_Caps(); rq=_Requeue()
+
+    WB.arm_deadline(deadline)
+    try:
+        with ThreadPoolExecutor(max_workers=PARALLEL_WORKERS) as ex:
+            # 一覧を先に投入しておけば空いたワーカーから順に一覧→詳細の順で拾われる
+            pending:dict[Future,dict|None]={ex.submit(process_listing,src,deadline): src for src in sources}
+            while pending or rq.heap:
+                if pending:
+                    done,_=wait(pending, timeout=min(1.0,rq.next_in()), return_when=FIRST_COMPLETED)
+                else:
+                    done=set(); time.sleep(min(1.0,rq.next_in()))
+                for f in done:
+                    src=pending.pop(f)
+                    res=None if f.cancelled() else f.result()
+                    if isinstance(res,RetryLater):
+                        rq.push(res,deadline,src); continue
+                    if src is None or res is None: continue
+                    for u in caps.take(src,res):
+                        pending[ex.submit(process_detail,u,deadline)]=None
+                for u,src in rq.ready():
+                    if src is not None: pending[ex.submit(process_listing,src,deadline)]=src
+                    else: pending[ex.submit(process_detail,u,deadline)]=None
+                if _stop(deadline):
+                    for f in pending: f.cancel()
+                    break
+    finally:
+        WB.flush()
+        _log_rates()
+
+# ---------- async 版 ----------
+def _validators_many(urls:List[str])->dict[str,tuple]:
+    if not urls: return {}
+    with conn() as c:
+        cur=c.cursor()
+        cur.execute("select url, etag, last_modified, body_hash from public.http_cache where url = any(%s)",(urls,), prepare=False)
+        return {u:(e,lm,h) for u,e,lm,h in cur.fetchall()}
+
+async def _listing_async(session, src:dict, deadline:float, delay:float=0.0):
+    if delay: await asyncio.sleep(delay)  # 再投入分
+    list_url=src["url"]
+    if not await asyncio.to_thread(_listing_due,list_url,deadline): return None
+    html=None; ctype=None
+    try:
+        etag,lm,_=await asyncio.to_thread(_validators,list_url)
+        html,new_etag,new_lm,ctype,status,took=await conditional_fetch_async(session,list_url,etag,lm)
+        WB.upsert_http_meta(list_url,new_etag,new_lm,status)
+        if html is None: L(list_url,"304",took,None)
+    except RetryLater as e:
+        return e
+    except Exception as e:
+        L(list_url,"ng",0,f"list error: {e}")
+    return (list_url,)+await asyncio.to_thread(_listing_candidates,src,list_url,html,ctype)
+
+async def _detail_async(session, u:str, validators:tuple, deadline:float, delay:float=0.0)->RetryLater|None:
+    if delay: await asyncio.sleep(delay)  # 再投入分（スレッドは消費しない）
+    if time.time()>deadline:
+        L(u,"skip",0,"deadline"); return None
+    try:
+        res=await conditional_fetch_async(session,u,validators[0],validators[1])
+        await asyncio.to_thread(_handle_detail,u,res,validators[2])  # 解析はスレッドへ（イベントループを止めない）
+    except RetryLater as e:
+        return e
+    except Exception as e:
+        await asyncio.to_thread(_fallback,u,e)
+    return None
+
+async def crawl_async()->None:
+    """
+    crawl() の asyncio 版。待ち時間の長い官公庁サイトへの要求を少数スレッドで大量に並行させる。
+    同時接続は lib.http_client の ASYNC_MAX_INFLIGHT / ASYNC_PER_HOST で制限する。
+    """
+    await asyncio.to_thread(ensure_schema)
+    sources=load_seeds()
+    deadline=time.time()+TIME_BUDGET_SEC
+    global _saved; _saved=0
+    caps=_Caps(); rq=_Requeue(); vals_all:dict[str,tuple]={}
+
+    WB.arm_deadline(deadline)
+    try:
+        async with async_session() as session:
+            pending:dict[asyncio.Task,dict|None]={
+                asyncio.ensure_future(_listing_async(session,src,deadline)): src for src in sources}
+            while pending:
+                done,_=await asyncio.wait(pending, timeout=1.0, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    src=pending.pop(t)
+                    exc=None if t.cancelled() else t.exception()
+                    if exc is not None:
+                        logging.error("async task failed (%s): %r", src["url"] if src else "detail", exc, exc_info=exc)
+                    res=None if (t.cancelled() or exc is not None) else t.result()
+                    # async は sleep 付きタスクとして再投入する（待ち行列は使わない）
+                    if isinstance(res,RetryLater):
+                        if not rq.allow(res,deadline): continue
+                        if src is not None:
+                            pending[asyncio.ensure_future(_listing_async(session,src,deadline,res.delay))]=src
+                        else:
+                            v=vals_all.get(res.url,(None,None,None))
+                            pending[asyncio.ensure_future(_detail_async(session,res.url,v,deadline,res.delay))]=None
+                        continue
+                    if src is None or res is None: continue
+                    urls=caps.take(src,res)
+                    vals=await asyncio.to_thread(_validators_many,urls); vals_all.update(vals)
+                    for u in urls:
+                        pending[asyncio.ensure_future(_detail_async(session,u,vals.get(u,(None,None,None)),deadline))]=None
+                if await asyncio.to_thread(_stop,deadline):  # 上限間際は flush するのでループの外で
+                    for t in pending: t.cancel()
+                    await asyncio.gather(*pending, return_exceptions=True)
+                    break
+    finally:
+        await asyncio.to_thread(WB.flush)
+        _log_rates()
@@ -1,12 +1,14 @@
 import time, feedparser
-from lib.db import conn, ensure_schema, log_fetch, upsert_page
+from lib.db import ensure_schema
+from lib.sink import WB
 from lib.util import norm_ws, clip
+from lib.extractors import make_row, extract_fields
 
 FEEDS = ["https://j-net21.smrj.go.jp/rss/support.xml"]
 
 def ingest():
     ensure_schema()
-    with conn() as c:
+    try:
         for url in FEEDS:
             t0=time.time()
             try:
@@ -16,11 +18,10 @@ def ingest():
                     title=norm_ws(getattr(e,"title",""))
                     smy=norm_ws(getattr(e,"summary",""))
                     if not link: continue
-                    row={"url":link,"title":title or "(無題)","summary":clip(smy,800),
-                         "rate":None,"cap":None,"target":None,"cost_items":None,
-                         "deadline":None,"fiscal_year":None,"call_no":None,
-                         "scheme_type":None,"period_from":None,"period_to":None}
-                    changed=upsert_page(c,row)
-                    log_fetch(c,link,"ok" if changed else "skip",0,"rss")
+                    row=make_row(link,title or "(無題)",clip(smy,800),
+                                 **extract_fields(f"{title}\n{smy}"))
+                    WB.upsert_page(row,0,"rss",lane="rss")
             except Exception as e:
-                log_fetch(c,url,"ng",int((time.time()-t0)*1000),f"rss error: {e}")
+                WB.log_fetch(url,"ng",int((time.time()-t0)*1000),f"rss error: {e}",lane="rss")
+    finally:
+        WB.flush()
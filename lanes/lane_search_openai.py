@@ -15,8 +15,9 @@ from typing import List, Dict, Optional
 from urllib.parse import urlparse
 from openai import OpenAI
 
-from lib.db import conn, log_fetch, upsert_page
+from lib.sink import WB
 from lib.util import norm_ws, clip
+from lib.extractors import make_row, extract_fields
 
 API_KEY = os.getenv("OPENAI_API_KEY", "")
 ALLOWED = [s.strip() for s in os.getenv("DR_ALLOWED_DOMAINS", "").split(",") if s.strip()]
@@ -63,7 +64,7 @@ def discover_and_extract(query: str, max_items: int = MAX_ITEMS) -> List[Dict]:
             timeout=TIMEOUT
         )
     except Exception as e:
-        with conn() as c: log_fetch(c, "openai:deep_research", "ng", 0, f"api error: {e}")
+        WB.log_fetch("openai:deep_research", "ng", 0, f"api error: {e}", lane="dr")
         return []
 
     try:
@@ -77,23 +78,14 @@ def discover_and_extract(query: str, max_items: int = MAX_ITEMS) -> List[Dict]:
         urls = [u for u in URL_RE.findall(text) if _allowed(u)]
         urls = list(dict.fromkeys(urls))[:max_items]
         items = [{"url": u, "title": "(無題)", "summary": None} for u in urls]
-        with conn() as c: log_fetch(c, "openai:deep_research", "list", 0, f"fallback_links={len(items)}; parse_err={e}")
+        WB.log_fetch("openai:deep_research", "list", 0, f"fallback_links={len(items)}; parse_err={e}", lane="dr")
         # upsert & return
-        saved = 0
-        with conn() as c:
-            for it in items:
-                try:
-                    it_full = {
-                        "url": it["url"], "title": "(無題)", "summary": None,
-                        "rate": None, "cap": None, "target": None, "cost_items": None,
-                        "deadline": None, "fiscal_year": None, "call_no": None,
-                        "scheme_type": None, "period_from": None, "period_to": None
-                    }
-                    changed = upsert_page(c, it_full)
-                    log_fetch(c, it["url"], "ok" if changed else "skip", 0, "dr-fallback")
-                    if changed: saved += 1
-                except Exception as ee:
-                    log_fetch(c, it["url"], "ng", 0, f"upsert error: {ee}")
+        for it in items:
+            try:
+                WB.upsert_page(make_row(it["url"], "(無題)"), 0, "dr-fallback", lane="dr")
+            except Exception as ee:
+                WB.log_fetch(it["url"], "ng", 0, f"upsert error: {ee}", lane="dr")
+        WB.flush()
         return items
 
     # 正常時：正規化して返す
@@ -108,24 +100,20 @@ def discover_and_extract(query: str, max_items: int = MAX_ITEMS) -> List[Dict]:
         cap  = norm_ws(o.get("max_amount")  or o.get("cap")  or "")
         fy   = norm_ws(o.get("fiscal_year") or "")
         call = norm_ws(o.get("call_no") or "")
-        items.append({
-            "url": url, "title": title or "(無題)", "summary": clip(summary, 800),
-            "rate": rate or None, "cap": cap or None, "target": None, "cost_items": None,
-            "deadline": None, "fiscal_year": fy or None, "call_no": call or None,
-            "scheme_type": None, "period_from": None, "period_to": None
-        })
-
-    saved = 0
-    with conn() as c:
-        for it in items:
-            try:
-                changed = upsert_page(c, it)
-                log_fetch(c, it["url"], "ok" if changed else "skip", 0, "dr")
-                if changed: saved += 1
-            except Exception as ee:
-                log_fetch(c, it["url"], "ng", 0, f"upsert error: {ee}")
-    with conn() as c:
-        log_fetch(c, "openai:deep_research", "list", 0, f"candidates={len(items)}; saved={saved}")
+        # DR が返した値を優先し、足りない項目は title/summary から補う
+        fields = extract_fields(f"{title}\n{summary}")
+        fields.update({k: v for k, v in
+                       {"rate": rate, "cap": cap, "fiscal_year": fy, "call_no": call}.items() if v})
+        items.append(make_row(url, title or "(無題)", clip(summary, 800), **fields))
+
+    saved = []
+    for it in items:
+        try:
+            WB.upsert_page(it, 0, "dr", lane="dr", on_change=saved.append)
+        except Exception as ee:
+            WB.log_fetch(it["url"], "ng", 0, f"upsert error: {ee}", lane="dr")
+    WB.flush()  # saved を確定させてから集計ログ
+    WB.log_fetch("openai:deep_research", "list", 0, f"candidates={len(items)}; saved={len(saved)}", lane="dr")
     return items
 
 # ---------- 2) 任意URLの本文テキスト抽出（今回追加） ----------
@@ -167,5 +155,5 @@ def dr_fetch_text(url: str, max_chars: int = 6000) -> Optional[str]:
         if isinstance(txt, str) and txt.strip():
             return txt[:max_chars]
     except Exception as e:
-        with conn() as c: log_fetch(c, url, "ng", 0, f"dr-fetch error: {e}")
+        WB.log_fetch(url, "ng", 0, f"dr-fetch error: {e}", lane="dr")
     return None
@@ -17,7 +17,7 @@ _SC_PAT = re.compile(
 def discover(query="公募 補助金 申請 2025", page_size=25, max_pages=1) -> list[str]:
     if not API_KEY or not SERVING_CONFIG: return []
     if not _SC_PAT.match(SERVING_CONFIG):
-        with conn() as c: log_fetch(c, "vertex:discovery", "ng", 0, f"malformed servingConfig: {SERVING_CONFIG}")
+        with conn() as c: log_fetch(c, "vertex:discovery", "ng", 0, f"malformed servingConfig: {SERVING_CONFIG}", lane="vertex")
         return []
 
     urls, page_token = [], None
@@ -32,7 +32,7 @@ def discover(query="公募 補助金 申請 2025", page_size=25, max_pages=1) ->
             ); r.raise_for_status()
             js = r.json()
         except Exception as e:
-            with conn() as c: log_fetch(c, "vertex:discovery", "ng", 0, f"http error: {e}")
+            with conn() as c: log_fetch(c, "vertex:discovery", "ng", 0, f"http error: {e}", lane="vertex")
             return []
         for res in (js.get("results") or []):
             doc = res.get("document") or {}
@@ -47,5 +47,5 @@ def discover(query="公募 補助金 申請 2025", page_size=25, max_pages=1) ->
     uniq, seen = [], set()
     for u in urls:
         if u not in seen: seen.add(u); uniq.append(u)
-    with conn() as c: log_fetch(c, "vertex:discovery", "list", 0, f"candidates={len(uniq)}")
+    with conn() as c: log_fetch(c, "vertex:discovery", "list", 0, f"candidates={len(uniq)}", lane="vertex")
     return uniq
@@ -0,0 +1,52 @@
+# lib/bodystore.py
+# 取得した本文のハッシュ（http_cache.body_hash）と、任意の gzip 本文ストア（content-addressed）。
+# - body_hash(): 解析前に前回の本文と同じか判定する（同じなら抽出を省いて skip）。
+#   EXTRACTOR_VERSION を混ぜるので、抽出ロジックを上げた後は同じ本文でも抽出し直す
+# - BODY_STORE_DIR を指定すると本文を {dir}/{hash[:2]}/{hash}.gz に保存し、
+#   抽出ロジックを直した後に reextract.py で再取得なしに抽出し直せる
+#
+# ENV:
+#   BODY_STORE_DIR (既定: 空=保存しない)
+
+from __future__ import annotations
+import os, gzip, hashlib, tempfile
+from .extractors import EXTRACTOR_VERSION
+
+BODY_STORE_DIR = os.getenv("BODY_STORE_DIR", "")
+
+def to_bytes(body: str | bytes) -> bytes:
+    """HTML 等は decode 済み str なので UTF-8 で保存・ハッシュする（PDF は bytes のまま）"""
+    return body.encode("utf-8") if isinstance(body, str) else bytes(body)
+
+def body_hash(body: str | bytes | None) -> str | None:
+    if body is None: return None
+    return hashlib.md5(f"{EXTRACTOR_VERSION}\0".encode() + to_bytes(body)).hexdigest()
+
+def _path(h: str) -> str:
+    return os.path.join(BODY_STORE_DIR, h[:2], f"{h}.gz")
+
+def put(body: str | bytes, h: str | None = None) -> str | None:
+    """BODY_STORE_DIR があれば保存してハッシュを返す（同じハッシュが既にあれば書かない）"""
+    if not BODY_STORE_DIR or body is None: return None
+    h = h or body_hash(body)
+    path = _path(h)
+    if os.path.exists(path): return h
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(gzip.compress(to_bytes(body), compresslevel=6))
+        os.replace(tmp, path)  # 並行書き込みでも壊れたファイルを残さない
+    except Exception:
+        try: os.unlink(tmp)
+        except OSError: pass
+        raise
+    return h
+
+def get(h: str) -> bytes | None:
+    if not BODY_STORE_DIR or not h: return None
+    try:
+        with open(_path(h), "rb") as f:
+            return gzip.decompress(f.read())
+    except FileNotFoundError:
+        return None
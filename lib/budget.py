@@ -1,13 +1,5 @@
-import os, datetime, psycopg
-from contextlib import contextmanager
-from lib.db import ensure_schema
-
-DSN = os.getenv("DATABASE_URL")
-
-@contextmanager
-def _conn():
-    with psycopg.connect(DSN, autocommit=True) as c:
-        yield c
+import datetime
+from lib.db import ensure_schema, conn as _conn
 
 def _month_str(dt=None):
     dt = dt or datetime.datetime.utcnow()
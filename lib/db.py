@@ -1,59 +1,152 @@
-import os, psycopg
+import os, time, atexit, threading
 from contextlib import contextmanager
 from pathlib import Path
+import psycopg
+from psycopg_pool import ConnectionPool
 from .util import content_hash
 
 DSN = os.getenv("DATABASE_URL")
+# RUN_ID: 未設定なら実行時刻で自動採番（fetch_log.run_id でサマリ集計するため常時付与）
+RUN_ID = os.getenv("RUN_ID") or str(int(time.time()))
+
+# プール設定：ワーカー数 + メインスレッド（crawl は c_main を握ったまま詳細を並列処理する）
+POOL_MIN      = int(os.getenv("DB_POOL_MIN", "1"))
+POOL_MAX      = int(os.getenv("DB_POOL_MAX", str(int(os.getenv("PARALLEL_WORKERS", "6")) + 1)))
+POOL_TIMEOUT  = float(os.getenv("DB_POOL_TIMEOUT", "30"))    # 取得待ちの上限（秒）
+POOL_MAX_IDLE = float(os.getenv("DB_POOL_MAX_IDLE", "300"))  # アイドル接続を閉じるまで（秒）
+
+_pool: ConnectionPool | None = None
+_pool_lock = threading.Lock()
+_wait = {"count": 0, "ms": 0.0, "max_ms": 0.0, "round_trips": 0}
+
+class _CountingCursor(psycopg.Cursor):
+    """execute / executemany / copy の回数を数える（1回 ≒ 1往復。pool_stats の round_trips）"""
+    def _count(self):
+        with _pool_lock: _wait["round_trips"] += 1
+    def execute(self, *a, **kw):
+        self._count(); return super().execute(*a, **kw)
+    def executemany(self, *a, **kw):
+        self._count(); return super().executemany(*a, **kw)
+    def copy(self, *a, **kw):
+        self._count(); return super().copy(*a, **kw)
+
+def _get_pool() -> ConnectionPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Supabase pooler(6543, transaction mode) 前提で prepared statement は使わない
+            _pool = ConnectionPool(
+                DSN, min_size=POOL_MIN, max_size=max(POOL_MIN, POOL_MAX),
+                timeout=POOL_TIMEOUT, max_idle=POOL_MAX_IDLE,
+                kwargs={"autocommit": True, "prepare_threshold": None,
+                        "cursor_factory": _CountingCursor},
+                check=ConnectionPool.check_connection,
+                name="lib.db", open=True,
+            )
+        return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        p, _pool = _pool, None
+    if p is not None:
+        p.close()
 
 @contextmanager
 def conn():
-    with psycopg.connect(DSN, autocommit=True) as c:
+    pool = _get_pool()
+    t0 = time.perf_counter()
+    with pool.connection() as c:
+        waited = (time.perf_counter() - t0) * 1000
+        with _pool_lock:
+            _wait["count"] += 1; _wait["ms"] += waited
+            _wait["max_ms"] = max(_wait["max_ms"], waited)
         yield c
 
+# lib.sink など後から登録される atexit（最終 flush）がプールを閉じる前に走るよう先に登録
+atexit.register(close_pool)
+
+def pool_stats() -> dict:
+    """プール取得回数・待ち時間（ms）・DB往復回数を返す（サマリ表示用）"""
+    with _pool_lock:
+        st = dict(_wait)
+        p = _pool
+    st["size"] = p.get_stats().get("pool_size", 0) if p is not None else 0
+    return st
+
 def ensure_schema():
     sql = Path("schema.sql").read_text(encoding="utf-8")
     with conn() as c:
         c.execute(sql, prepare=False)
 
-def upsert_http_meta(c, url, etag, last_mod, status):
-    cur = c.cursor()
-    cur.execute("""
-      insert into public.http_cache(url, etag, last_modified, last_status, last_checked_at, last_changed_at)
-      values(%s,%s,%s,%s, now(),
-             case when %s<>coalesce((select etag from public.http_cache where url=%s),'')
-                    or %s<>coalesce((select last_modified from public.http_cache where url=%s),'')
-                  then now() else coalesce((select last_changed_at from public.http_cache where url=%s), now()) end)
-      on conflict(url) do update set
-        etag=excluded.etag, last_modified=excluded.last_modified,
-        last_status=excluded.last_status, last_checked_at=now();
-    """, (url, etag, last_mod, status, etag or "", url, last_mod or "", url, url), prepare=False)
-
-def log_fetch(c, url, status, took_ms, err):
+# 新規行は取得時刻を last_changed_at に。既存行は on conflict 側で旧値と比べ、
+# ETag/Last-Modified/本文ハッシュが変わった時だけ last_changed_at を進める（url の1回の索引探索で済む）
+# body_hash が None（304 等で本文を読んでいない）なら旧値を残す
+UPSERT_HTTP_META_SQL = """
+  insert into public.http_cache as h(url, etag, last_modified, last_status, body_hash, last_checked_at, last_changed_at)
+  values(%s,%s,%s,%s,%s, now(), now())
+  on conflict(url) do update set
+    last_changed_at = case
+      when coalesce(excluded.etag,'')          <> coalesce(h.etag,'')
+        or coalesce(excluded.last_modified,'') <> coalesce(h.last_modified,'')
+        or (excluded.body_hash is not null and excluded.body_hash is distinct from h.body_hash)
+      then now() else coalesce(h.last_changed_at, now()) end,
+    etag=excluded.etag, last_modified=excluded.last_modified,
+    last_status=excluded.last_status, last_checked_at=now(),
+    body_hash=coalesce(excluded.body_hash, h.body_hash)
+"""
+
+def http_meta_values(url, etag, last_mod, status, body_hash=None) -> tuple:
+    return (url, etag, last_mod, status, body_hash)
+
+def upsert_http_meta(c, url, etag, last_mod, status, body_hash=None):
+    c.execute(UPSERT_HTTP_META_SQL, http_meta_values(url, etag, last_mod, status, body_hash), prepare=False)
+
+LOG_FETCH_COLS = ["url", "status", "took_ms", "error", "run_id", "lane"]
+
+def log_fetch(c, url, status, took_ms, err, lane=None, run_id=None):
     c.execute(
-        "insert into public.fetch_log(url,status,took_ms,error) values(%s,%s,%s,%s)",
-        (url, status, took_ms, err),
+        "insert into public.fetch_log(url,status,took_ms,error,run_id,lane) values(%s,%s,%s,%s,%s,%s)",
+        (url, status, took_ms, err, run_id or RUN_ID, lane),
         prepare=False,
     )
 
-def upsert_page(c, row: dict) -> bool:
+PAGE_COLS = ["url","title","summary","rate","cap","target","cost_items","deadline",
+             "fiscal_year","call_no","scheme_type","period_from","period_to","content_hash"]
+
+# content_hash が変わった時だけ更新し、書き込んだ行だけ url を返す（1往復で変更判定）
+UPSERT_PAGE_SQL = f"""
+  insert into public.pages({",".join(PAGE_COLS)})
+  values({",".join(["%s"]*len(PAGE_COLS))})
+  on conflict(url) do update set
+    title=excluded.title, summary=excluded.summary, rate=excluded.rate,
+    cap=excluded.cap, target=excluded.target, cost_items=excluded.cost_items,
+    deadline=excluded.deadline, fiscal_year=excluded.fiscal_year,
+    call_no=excluded.call_no, scheme_type=excluded.scheme_type,
+    period_from=excluded.period_from, period_to=excluded.period_to,
+    content_hash=excluded.content_hash, last_fetched=now()
+  where public.pages.content_hash is distinct from excluded.content_hash
+  returning url
+"""
+
+def strip_nul(vals) -> list:
+    """Postgres の text は NUL を持てない（pypdf の抽出結果や cp932 の化けに混ざる）ので落とす"""
+    return [v.replace("\x00", "") if isinstance(v, str) else v for v in vals]
+
+def page_values(row: dict) -> list:
     row = dict(row); row["content_hash"] = content_hash(row)
+    return strip_nul(row.get(k) for k in PAGE_COLS)
+
+# pages の世代番号。変更があった upsert の後に進め、recommend の応答キャッシュはこれが変わったら捨てる
+BUMP_GENERATION_SQL = "update public.cache_generation set gen=gen+1, bumped_at=now() where name='pages'"
+
+def bump_generation(c):
+    c.execute(BUMP_GENERATION_SQL, prepare=False)
+
+def upsert_page(c, row: dict) -> bool:
     cur = c.cursor()
-    cur.execute("select content_hash from public.pages where url=%s", (row["url"],), prepare=False)
-    prev = cur.fetchone()
-    if prev and prev[0] == row["content_hash"]:
-        return False
-    cols = ["url","title","summary","rate","cap","target","cost_items","deadline",
-            "fiscal_year","call_no","scheme_type","period_from","period_to","content_hash"]
-    vals = [row.get(k) for k in cols]
-    cur.execute(f"""
-      insert into public.pages({",".join(cols)})
-      values({",".join(["%s"]*len(cols))})
-      on conflict(url) do update set
-        title=excluded.title, summary=excluded.summary, rate=excluded.rate,
-        cap=excluded.cap, target=excluded.target, cost_items=excluded.cost_items,
-        deadline=excluded.deadline, fiscal_year=excluded.fiscal_year,
-        call_no=excluded.call_no, scheme_type=excluded.scheme_type,
-        period_from=excluded.period_from, period_to=excluded.period_to,
-        content_hash=excluded.content_hash, last_fetched=now()
-    """, vals, prepare=False)
-    return True
+    cur.execute(UPSERT_PAGE_SQL, page_values(row), prepare=False)
+    changed = cur.fetchone() is not None
+    if changed:
+        bump_generation(c)
+    return changed
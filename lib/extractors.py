@@ -1,94 +1,149 @@
 from __future__ import annotations
-import re
-from bs4 import BeautifulSoup
+import os, re, unicodedata
+from typing import NamedTuple
+from urllib.parse import urlparse, urljoin
 from .util import norm_ws, clip
+from .htmldoc import HtmlDoc, parse_html
 
-def _meta(soup: BeautifulSoup, *pairs: tuple[str, str]) -> str:
+# 抽出ロジック（HTML / PDF）を変えたら上げる。http_cache.body_hash に混ぜてあるので、
+# 上げると本文が同じページも「同じ本文」で飛ばさずに抽出し直す
+EXTRACTOR_VERSION = "1"
+
+# ---------- フィールド定義（HTML / テキスト / RSS / DR で共通） ----------
+# 本文は NFKC 正規化してから走査するので、数字・記号は半角前提で書く（％→%, ／→/, ～→~）。
+# trigger（ラベル）を1本の正規表現にまとめて本文を1回だけ走査し、
+# ヒットした位置から value を match する。同じ name は rank の小さい定義を優先、同順位なら先に出た方。
+# value が None のものは trigger のヒット文字列自体を値にする。
+
+class Field(NamedTuple):
+    name: str | tuple[str, ...]   # tuple なら value のグループ順に割り当てる
+    trigger: str                  # 捕捉グループは使わない（(?:...) で書く）
+    value: str | None = None
+    rank: int = 0
+
+_DATE = (r"(?:(?:令和\s*(?:\d{1,2}|元)|20\d{2})\s*年\s*|20\d{2}\s*[/.-]\s*)?"
+         r"\d{1,2}\s*[月/.-]\s*\d{1,2}\s*日?(?:\s*\([^)\n]{1,3}\))?(?:\s*\d{1,2}:\d{2})?")
+_SEP = r"[\s:：]*(?:は\s*)?"
+_LINE = r"([^\n。]{1,200})"
+
+FIELDS: list[Field] = [
+    Field("fiscal_year", r"(?:令和|R)\s*(?:\d{1,2}|元)\s*年度|20\d{2}\s*年度"),
+    Field("call_no",     r"第(?=\s*\d+\s*(?:次|回))", r"\s*(\d+)"),
+    Field("rate",        r"補助率|助成率",
+          _SEP + r"(\d+\s*/\s*\d+|\d+\s*分の\s*\d+|\d+(?:\.\d+)?\s*%|定額)"),
+    Field("cap",         r"(?:補助|助成)?(?:上限額?|限度額)",
+          _SEP + r"((?:\d[\d,.]*\s*(?:億|千万|百万|万|千)\s*)*\d[\d,.]*\s*(?:億|千万|百万|万|千)?\s*円)"),
+    Field("target",      r"対象者",                   _SEP + _LINE),
+    Field("target",      r"対象(?!経費|者|外|と)",    _SEP + _LINE, rank=1),
+    Field("cost_items",  r"対象経費",                 _SEP + _LINE),
+    Field("deadline",    r"(?:申請|公募|応募|募集|提出)?(?:締切|締め切り|〆切)日?|(?:受付|申請|応募|提出)期限",
+          _SEP + r"(" + _DATE + r")"),
+    Field(("period_from", "period_to"), r"(?:公募|募集|受付|申請|応募)(?:受付)?期間",
+          _SEP + r"(" + _DATE + r")[^\n]{0,12}?(?:から|[~〜\-–―ー])\s*(" + _DATE + r")"),
+    Field("scheme_type", r"補助金|助成金|給付金|交付金|奨励金|支援金|融資|税制"),
+]
+
+_NAMES = tuple(dict.fromkeys(n for f in FIELDS for n in ((f.name,) if isinstance(f.name, str) else f.name)))
+_TRIGGER = re.compile("|".join(f"(?P<f{i}>{f.trigger})" for i, f in enumerate(FIELDS)))
+_VALUES = [re.compile(f.value) if f.value else None for f in FIELDS]
+_BEST = {n: min(f.rank for f in FIELDS if n == f.name or n in f.name) for n in _NAMES}
+_HSPACE = re.compile(r"[^\S\n]+")
+_NL = re.compile(r" ?\n[\s]*")
+
+def normalize_text(text: str | None) -> str:
+    """NFKC + 空白の畳み込み。norm_ws と違って改行は残す（行単位のラベル抽出に使う）"""
+    if not text: return ""
+    t = unicodedata.normalize("NFKC", text)
+    return _NL.sub("\n", _HSPACE.sub(" ", t)).strip()
+
+def extract_fields(text: str | None) -> dict:
+    """本文を1回走査して FIELDS の各項目を返す（見つからない項目は None）"""
+    t = normalize_text(text)
+    found: dict[str, tuple[int, str]] = {}
+    for m in _TRIGGER.finditer(t):
+        i = int(m.lastgroup[1:])
+        f = FIELDS[i]
+        names = (f.name,) if isinstance(f.name, str) else f.name
+        if names[0] in found and found[names[0]][0] <= f.rank:
+            continue
+        if _VALUES[i] is None:
+            vals = (m.group(0),)
+        else:
+            v = _VALUES[i].match(t, m.end())
+            if not v: continue
+            vals = v.groups()
+        for n, val in zip(names, vals):
+            found[n] = (f.rank, clip(norm_ws(val), 200))
+        if len(found) == len(_NAMES) and all(found[n][0] == _BEST[n] for n in _NAMES):
+            break
+    out = {n: (found[n][1] if n in found else None) for n in _NAMES}
+    if not out["deadline"]:
+        out["deadline"] = out["period_to"]
+    return out
+
+def make_row(url: str, title: str, summary: str | None = None, **fields) -> dict:
+    """pages 行の形にそろえる（指定しなかった項目は None）"""
+    row = {"url": url, "title": title, "summary": summary}
+    for n in ("rate", "cap", "target", "cost_items") + _NAMES:
+        row.setdefault(n, fields.get(n))
+    return row
+
+def _meta(doc: HtmlDoc, *pairs: tuple[str, str]) -> str:
     for k, v in pairs:
-        m = soup.find("meta", attrs={k: v})
-        if m and m.get("content"):
-            return norm_ws(m["content"])
+        c = doc.meta(k, v)
+        if c:
+            return norm_ws(c)
     return ""
 
-def extract_from_html(url: str, html: str) -> dict:
+def extract_from_html(url: str, html: str | HtmlDoc) -> dict:
     """
     通常のHTMLから要点を抽出して pages テーブルの行に整形して返す。
+    パース済みの HtmlDoc を渡せば再パースしない。
     """
-    soup = BeautifulSoup(html, "html.parser")
+    doc = parse_html(html)
 
-    title = norm_ws(soup.title.text if soup.title else "") \
-        or _meta(soup, ("property", "og:title"), ("name", "twitter:title"))
-    desc = _meta(soup, ("name", "description"), ("property", "og:description"))
-    summary = desc or (norm_ws(soup.find("p").get_text(" ")) if soup.find("p") else "")
+    title = norm_ws(doc.title()) \
+        or _meta(doc, ("property", "og:title"), ("name", "twitter:title"))
+    desc = _meta(doc, ("name", "description"), ("property", "og:description"))
+    summary = desc or norm_ws(doc.first_p())
     if not title:
         title = (summary[:40] or "(無題)")
 
-    text = soup.get_text(" ")
-
-    def f(pat: str) -> str | None:
-        m = re.search(pat, text)
-        return norm_ws(m.group(1 if (m and m.lastindex) else 0)) if m else None
-
-    fiscal_year = f(r"(令和\s*[0-9０-９]+年度|20[0-9]{2}年度)")
-    call_no     = f(r"第\s*([0-9０-９]+)\s*回")
-    rate        = f(r"補助率[\s:：]*([0-9０-９]+ ?%?)")
-    cap         = f(r"上限[\s:：]*([0-9０-９,，]+ ?(?:円|万円|億円)?)")
-
-    target, cost_items = None, None
-    for lab in ("対象経費", "対象者", "対象"):
-        m = re.search(lab + r"[\s:：]*(.+?)\n", text)
-        if m:
-            val = norm_ws(m.group(1))
-            if "経費" in lab:
-                cost_items = val
-            else:
-                target = val
-
-    return {
-        "url": url,
-        "title": title or "(無題)",
-        "summary": clip(summary, 800),
-        "rate": rate,
-        "cap": cap,
-        "target": target,
-        "cost_items": cost_items,
-        "deadline": None,
-        "fiscal_year": fiscal_year,
-        "call_no": call_no,
-        "scheme_type": None,
-        "period_from": None,
-        "period_to": None,
-    }
+    return make_row(url, title or "(無題)", clip(summary, 800), **extract_fields(doc.text()))
 
 def extract_from_text(url: str, text: str) -> dict:
     """
     HTMLが取れない／テキストだけのフォールバック（Tavily raw など）で
     最低限の情報を埋めて返す。
     """
-    t = norm_ws(text or "")
-    # 1行目あたりからタイトル候補を拾う
+    t = normalize_text(text)
+    # 先頭のほうの 8〜80 文字の行をタイトル候補にする
     title = "(無題)"
     m = re.search(r"^(.{8,80})$", t, flags=re.M)
     if m:
         title = norm_ws(m.group(1))
+    return make_row(url, title, clip(norm_ws(t)[:800], 800), **extract_fields(t))
+
+def row_from_pdf_url(url: str) -> dict:
+    """
+    PDF 本文を読まずに URL のファイル名からタイトルだけ作る。
+    """
+    title = os.path.basename(urlparse(url).path) or "(PDF)"
+    title = title.replace(".pdf", "").replace(".PDF", "")
+    return make_row(url, f"{title} (PDF)", "PDF（本文未解析）")
+
+# ---------- リンク（一覧ページの詳細URL候補） ----------
+
+def extract_links(base_url: str, html: str | HtmlDoc) -> list[str]:
+    """<a href> を base_url 基準の絶対URLに（# と javascript: は除く。出現順で重複なし）"""
+    out = []
+    for href in parse_html(html).hrefs():
+        if not href or href.startswith("#") or href.startswith("javascript:"): continue
+        out.append(urljoin(base_url, href))
+    return list(dict.fromkeys(out))
+
+URL_RE = re.compile(r'https?://(?:www\.)?(?:chusho\.meti\.go\.jp|meti\.go\.jp|jgrants-portal\.go\.jp)[^\s"\'>)]+', re.I)
 
-    # 数値系をできるだけ拾う
-    rate=None; m=re.search(r"補助率[\s:：]*([0-9０-９]+ ?%?)", t);              rate=norm_ws(m.group(1)) if m else None
-    cap =None; m=re.search(r"上限[\s:：]*([0-9０-９,，]+ ?(?:円|万円|億円)?)", t);  cap =norm_ws(m.group(1)) if m else None
-    fy  =None; m=re.search(r"(令和\s*[0-9０-９]+年度|20[0-9]{2}年度)", t);       fy  =norm_ws(m.group(1)) if m else None
-
-    return {
-        "url": url,
-        "title": title,
-        "summary": clip(t[:800], 800),
-        "rate": rate,
-        "cap": cap,
-        "target": None,
-        "cost_items": None,
-        "deadline": None,
-        "fiscal_year": fy,
-        "call_no": None,
-        "scheme_type": None,
-        "period_from": None,
-        "period_to": None,
-    }
+def extract_links_by_regex(html: str) -> list[str]:
+    """本文中の対象ドメインの URL（スクリプト内など <a> 以外に書かれたもの。出現順で重複なし）"""
+    return list(dict.fromkeys(URL_RE.findall(html or "")))
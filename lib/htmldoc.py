@@ -0,0 +1,167 @@
+# lib/htmldoc.py
+# HTML を1回だけパースして、リンク抽出（一覧）とフィールド抽出（詳細）で共有するための薄い抽象。
+# バックエンドは速い順に selectolax → lxml → BeautifulSoup（入っているものを自動選択）。
+#
+# ENV:
+#   HTML_PARSER (既定: auto)  … auto / selectolax / lxml / bs4
+
+from __future__ import annotations
+import os, re
+from abc import ABC, abstractmethod
+from typing import List
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as _SxParser
+except Exception:
+    try:
+        from selectolax.parser import HTMLParser as _SxParser  # selectolax<1.0
+    except Exception:
+        _SxParser = None
+try:
+    import lxml.html as _lxml_html
+    from lxml import etree as _lxml_etree
+except Exception:
+    _lxml_html = None
+try:
+    from bs4 import BeautifulSoup
+except Exception:
+    BeautifulSoup = None
+
+HTML_PARSER = os.getenv("HTML_PARSER", "auto").lower()
+_NOISE = ("script", "style", "noscript")
+_XML_DECL = re.compile(r"^\s*<\?xml[^>]*\?>")
+
+def available_backends() -> List[str]:
+    out = []
+    if _SxParser is not None: out.append("selectolax")
+    if _lxml_html is not None: out.append("lxml")
+    if BeautifulSoup is not None: out.append("bs4")
+    return out
+
+class HtmlDoc(ABC):
+    """パース済みHTML。text() は初回だけ計算してキャッシュする"""
+    backend = ""
+
+    def __init__(self):
+        self._text: str | None = None
+
+    @abstractmethod
+    def title(self) -> str: ...
+    @abstractmethod
+    def meta(self, attr: str, value: str) -> str | None: ...
+    @abstractmethod
+    def first_p(self) -> str: ...
+    @abstractmethod
+    def hrefs(self) -> List[str]: ...
+    @abstractmethod
+    def _full_text(self) -> str: ...
+
+    def text(self) -> str:
+        """script/style を除いた本文テキスト（要素間は空白、テキスト内の改行は保持）"""
+        if self._text is None:
+            self._text = self._full_text()
+        return self._text
+
+class _SelectolaxDoc(HtmlDoc):
+    backend = "selectolax"
+
+    def __init__(self, html: str):
+        super().__init__()
+        self.tree = _SxParser(html)
+
+    def title(self) -> str:
+        n = self.tree.css_first("title")
+        return n.text() if n else ""
+
+    def meta(self, attr, value):
+        for n in self.tree.css("meta"):
+            if n.attributes.get(attr) == value and n.attributes.get("content"):
+                return n.attributes["content"]
+        return None
+
+    def first_p(self) -> str:
+        n = self.tree.css_first("p")
+        return n.text(separator=" ") if n else ""
+
+    def hrefs(self):
+        return [n.attributes.get("href") for n in self.tree.css("a[href]")]
+
+    def _full_text(self) -> str:
+        self.tree.strip_tags(list(_NOISE))
+        root = self.tree.root  # 他バックエンドと同じく <title> も含める
+        return root.text(separator=" ") if root else ""
+
+class _LxmlDoc(HtmlDoc):
+    backend = "lxml"
+
+    def __init__(self, html: str):
+        super().__init__()
+        # 文字列に encoding 宣言付きの XML 宣言があると lxml が受け付けないので落とす
+        self.root = _lxml_html.document_fromstring(_XML_DECL.sub("", html, count=1))
+
+    def title(self) -> str:
+        return self.root.findtext(".//title") or ""
+
+    def meta(self, attr, value):
+        for m in self.root.iter("meta"):
+            if m.get(attr) == value and m.get("content"):
+                return m.get("content")
+        return None
+
+    def first_p(self) -> str:
+        p = self.root.find(".//p")
+        return " ".join(p.itertext()) if p is not None else ""
+
+    def hrefs(self):
+        return [a.get("href") for a in self.root.iter("a") if a.get("href") is not None]
+
+    def _full_text(self) -> str:
+        _lxml_etree.strip_elements(self.root, *_NOISE, with_tail=False)
+        return " ".join(self.root.itertext())
+
+class _SoupDoc(HtmlDoc):
+    backend = "bs4"
+
+    def __init__(self, html: str):
+        super().__init__()
+        self.soup = BeautifulSoup(html, "lxml" if _lxml_html is not None else "html.parser")
+
+    def title(self) -> str:
+        return self.soup.title.text if self.soup.title else ""
+
+    def meta(self, attr, value):
+        m = self.soup.find("meta", attrs={attr: value})
+        return m["content"] if (m and m.get("content")) else None
+
+    def first_p(self) -> str:
+        p = self.soup.find("p")
+        return p.get_text(" ") if p else ""
+
+    def hrefs(self):
+        return [a.get("href") for a in self.soup.find_all("a", href=True)]
+
+    def _full_text(self) -> str:
+        for t in self.soup(list(_NOISE)):
+            t.decompose()
+        return self.soup.get_text(" ")
+
+_BACKENDS = {"selectolax": _SelectolaxDoc, "lxml": _LxmlDoc, "bs4": _SoupDoc}
+
+def parse_html(html: str | HtmlDoc, backend: str | None = None) -> HtmlDoc:
+    """
+    HTML をパースして HtmlDoc を返す（HtmlDoc を渡したらそのまま返す）。
+    指定バックエンドが無い/パースに失敗したら次のバックエンドへフォールバックする。
+    """
+    if isinstance(html, HtmlDoc):
+        return html
+    want = (backend or HTML_PARSER).lower()
+    order = available_backends()
+    if want in order:
+        order = [want] + [b for b in order if b != want]
+    last_err: Exception | None = None
+    for name in order:
+        try:
+            return _BACKENDS[name](html or "")
+        except Exception as e:  # 空文書・壊れたHTMLで lxml が投げる等
+            last_err = e
+    raise RuntimeError(f"no HTML parser available: {last_err}")
@@ -1,6 +1,13 @@
-import os, time, requests
+import os, re, time, asyncio, requests
 from urllib.parse import urlsplit
 from requests.adapters import HTTPAdapter, Retry
+from urllib3.exceptions import ReadTimeoutError
+from . import ratelimit
+
+try:
+    import aiohttp
+except Exception:
+    aiohttp = None
 
 # 既定のタイムアウト（ENV）
 CONNECT = int(os.getenv("CONNECT_TIMEOUT", "12"))
@@ -30,44 +37,240 @@ if SINGLE_MODE:
         allowed_methods={"GET"}
     )
 else:
+    # 通常は接続エラーだけここで再試行。429/5xx は RetryLater で呼び出し側に返し、
+    # スレッドを寝かせずに再投入させる（シリアルは1件だけなのでその場で待つ）
+    # Retry-After 付きの 429/503 も urllib3 に待たせない：respect_retry_after_header が既定(True)のままだと
+    # urllib3 が Retry-After ぶん寝たうえ status=0 で RetryError になり、RetryLater が返らない
     retry = Retry(
-        total=3, connect=3, read=0,
+        total=3, connect=3, read=0, status=0,
         backoff_factor=1.2,
-        status_forcelist=[429, 500, 502, 503, 504],
-        allowed_methods={"GET"}
+        allowed_methods={"GET"},
+        respect_retry_after_header=False
     )
 
+# 本文はストリームで読み、上限を超えたら打ち切る（ワーカー当たりのピークメモリを抑える）
+MAX_BODY_BYTES  = int(os.getenv("MAX_BODY_BYTES", "16000000"))   # 16MB
+CHUNK_BYTES     = 64 * 1024
+
+RETRY_STATUS   = {429, 500, 502, 503, 504}
+RETRY_LATER_SEC = float(os.getenv("RETRY_LATER_SEC", "10"))  # Retry-After が無い時の再投入待ち
+
+class RetryLater(Exception):
+    """429/5xx。delay 秒後に再投入すべきことを呼び出し側に伝える"""
+    def __init__(self, url: str, status: int, delay: float):
+        super().__init__(f"{status} retry after {delay:.0f}s: {url}")
+        self.url, self.status, self.delay = url, status, delay
+
+# async エンジン（aiohttp）の同時接続上限：全体 / ホスト別
+ASYNC_MAX_INFLIGHT = int(os.getenv("ASYNC_MAX_INFLIGHT", "200"))
+ASYNC_PER_HOST     = int(os.getenv("ASYNC_PER_HOST", os.getenv("PER_HOST_LIMIT", "2")))
+
+# ベンチ用：http://127.0.0.1:8765 等を指定すると https://host/path を {base}/host/path に向ける
+# （bench/replay_server.py。レート制御・タイムアウトは元のホスト名で判定する）
+HTTP_REPLAY_BASE = os.getenv("HTTP_REPLAY_BASE", "").rstrip("/")
+
+def _target(u: str) -> str:
+    if not HTTP_REPLAY_BASE: return u
+    p = urlsplit(u)
+    return f"{HTTP_REPLAY_BASE}/{p.netloc}{p.path or '/'}" + (f"?{p.query}" if p.query else "")
+
 S = requests.Session()
 A = HTTPAdapter(max_retries=retry, pool_maxsize=32)
 S.mount("https://", A); S.mount("http://", A)
 
-def conditional_fetch(u, etag, last_mod, override_connect=None, override_read=None):
-    """
-    GET を実行して本文を返す。
-    - override_* が指定されていればその値を使用
-    - なければ（シリアル強制 > HOST別 > 既定）の優先順
-    戻り値: (html or None, new_etag, new_last_mod, content_type, status_code, took_ms)
-    例外: requests.exceptions.ReadTimeout / ConnectionError など
-    """
+def _timeouts(u, override_connect=None, override_read=None) -> tuple[int, int]:
     host = urlsplit(u).netloc
-
     rt = (override_read if override_read is not None
           else SINGLE_FORCE_READ_TIMEOUT or HOST_READ.get(host, READ))
     ct = (override_connect if override_connect is not None
           else SINGLE_FORCE_CONNECT_TIMEOUT or CONNECT)
+    return ct, rt
 
+def _cond_headers(etag, last_mod) -> dict:
     hdr = dict(HEADERS)
     if etag:     hdr["If-None-Match"] = etag
     if last_mod: hdr["If-Modified-Since"] = last_mod
+    return hdr
+
+class BodyTooLarge(Exception):
+    """本文が max_bytes を超えた（Content-Length で事前に判明した場合も含む）"""
+    def __init__(self, url: str, ctype: str, size: int):
+        super().__init__(f"body too large ({size}+ bytes, {ctype or '?'}): {url}")
+        self.url, self.ctype, self.size = url, ctype, size
+
+_META_CHARSET = re.compile(rb'<meta[^>]+charset=["\']?([A-Za-z0-9_\-]+)', re.I)
+
+def _sniff_ctype(head: bytes, ctype: str) -> str:
+    """ヘッダが無い/曖昧な時だけ先頭バイトで判定（PDF を text/html として扱わない）"""
+    h = head.lstrip()[:512].lower()
+    if h.startswith(b"%pdf-"):
+        return "application/pdf"
+    if ctype in ("", "application/octet-stream", "binary/octet-stream") and \
+       (h.startswith(b"<!doctype html") or h.startswith(b"<html") or b"<head" in h):
+        return "text/html"
+    return ctype
 
+def _decode(data: bytes, content_type_header: str | None) -> str:
+    m = re.search(r"charset=([\w\-]+)", content_type_header or "", re.I)
+    enc = m.group(1) if m else None
+    if not enc:
+        mm = _META_CHARSET.search(data[:4096])
+        enc = mm.group(1).decode("ascii") if mm else None
+    for e in ([enc] if enc else []) + ["utf-8"]:
+        try:
+            return data.decode(e)
+        except (LookupError, UnicodeDecodeError):
+            pass
+    return data.decode("cp932", errors="replace")  # 官公庁の Shift_JIS 無指定ページ向け
+
+class _BodyReader:
+    """チャンクを受け取り、上限チェックと型判定を行う"""
+    def __init__(self, u, ctype, length, max_bytes):
+        self.u, self.ctype, self.max_bytes = u, ctype, max_bytes
+        if max_bytes and length and length.isdigit() and int(length) > max_bytes:
+            raise BodyTooLarge(u, ctype, int(length))
+        self.size = 0
+        self.buf: list[bytes] = []
+        self.sniffed = False
+
+    def feed(self, chunk: bytes):
+        if not chunk: return
+        self.size += len(chunk)
+        if self.max_bytes and self.size > self.max_bytes:
+            raise BodyTooLarge(self.u, self.ctype, self.size)
+        if not self.sniffed:
+            self.sniffed = True
+            self.ctype = _sniff_ctype(chunk, self.ctype)
+        self.buf.append(chunk)
+
+    def result(self, content_type_header):
+        """(本文, ctype)。本文は text→str / PDF→bytes"""
+        data = b"".join(self.buf)
+        if self.ctype == "application/pdf":
+            return data, self.ctype
+        return _decode(data, content_type_header), self.ctype
+
+def _iter_body(r):
+    """
+    r.iter_content を回す。本文の途中の読み取りタイムアウトは requests が ConnectionError に包んで投げるので、
+    ヘッダ待ちと同じ ReadTimeout に戻す（呼び出し側の DR 切替・ホスト別カウントが効くように）
+    """
+    try:
+        yield from r.iter_content(CHUNK_BYTES)
+    except requests.exceptions.ConnectionError as e:
+        if isinstance(e.args[0] if e.args else None, ReadTimeoutError):
+            raise requests.exceptions.ReadTimeout(e.args[0], request=e.request, response=e.response) from e
+        raise
+
+def _acquire_or_later(u, blocked: float):
+    """ratelimit.acquire の戻り値が正（ホストが Retry-After で停止中）なら、その秒数後の再投入を求める"""
+    if blocked > 0:
+        raise RetryLater(u, 429, blocked)
+
+def acquire(u):
+    """
+    u のホストのトークンを取る（レート分は待つ）。Retry-After で停止中なら RetryLater。
+    ホスト別の同時実行枠を持つ呼び出し側は、枠を取る前にこれを呼んで conditional_fetch(..., acquired=True) にする
+    （トークン待ちの間に枠を塞がないため）
+    """
+    _acquire_or_later(u, ratelimit.acquire(urlsplit(u).netloc, wait_blocked=SINGLE_MODE))
+
+def _observe(u, host, status, took, retry_after_hdr):
+    ra = ratelimit.parse_retry_after(retry_after_hdr) if status in RETRY_STATUS else None
+    ratelimit.observe(host, status, took, ra)
+    if status in RETRY_STATUS and not SINGLE_MODE:
+        raise RetryLater(u, status, ra or RETRY_LATER_SEC)
+
+def conditional_fetch(u, etag, last_mod, override_connect=None, override_read=None,
+                      max_bytes=MAX_BODY_BYTES, acquired=False):
+    """
+    GET を実行して本文を返す。
+    - override_* が指定されていればその値を使用
+    - なければ（シリアル強制 > HOST別 > 既定）の優先順
+    - 本文はチャンクで読み、max_bytes を超えたら BodyTooLarge（0/None で無制限）
+    - Content-Type は先頭バイトでも判定（%PDF- → application/pdf）
+    - acquired=True なら呼び出し側が acquire(u) 済み（ここではトークンを取らない）
+    戻り値: (body or None, new_etag, new_last_mod, content_type, status_code, took_ms)
+      body は HTML 等なら str、PDF なら bytes
+    例外: requests.exceptions.ReadTimeout / ConnectionError / RetryLater(429/5xx) / BodyTooLarge など
+    """
+    ct, rt = _timeouts(u, override_connect, override_read)
+    hdr = _cond_headers(etag, last_mod)
+    host = urlsplit(u).netloc
+
+    if not acquired: acquire(u)
     t0 = time.time()
-    r  = S.get(u, headers=hdr, timeout=(ct, rt), allow_redirects=True)
-    took = int((time.time()-t0)*1000)
+    try:
+        r = S.get(_target(u), headers=hdr, timeout=(ct, rt), allow_redirects=True, stream=True)
+    except Exception:
+        ratelimit.observe(host, None, int((time.time()-t0)*1000)); raise
+    with r:
+        took = int((time.time()-t0)*1000)
+        _observe(u, host, r.status_code, took, r.headers.get("Retry-After"))
 
-    ctype = (r.headers.get("Content-Type") or "").split(";")[0].lower()
+        ctype = (r.headers.get("Content-Type") or "").split(";")[0].lower()
 
-    if r.status_code == 304:
-        return None, etag, last_mod, ctype, r.status_code, took
+        if r.status_code == 304:
+            return None, etag, last_mod, ctype, r.status_code, took
+
+        r.raise_for_status()
+        body = _BodyReader(u, ctype, r.headers.get("Content-Length"), max_bytes)
+        for chunk in _iter_body(r):
+            body.feed(chunk)
+        text, ctype = body.result(r.headers.get("Content-Type"))
+        took = int((time.time()-t0)*1000)
+    return text, r.headers.get("ETag") or etag, r.headers.get("Last-Modified") or last_mod, ctype, r.status_code, took
+
+# ---------- async 版（aiohttp） ----------
+def async_session():
+    """
+    conditional_fetch_async 用のセッション。keep-alive で接続を使い回し、
+    同時接続は全体 ASYNC_MAX_INFLIGHT / ホスト別 ASYNC_PER_HOST に制限する。
+    """
+    if aiohttp is None:
+        raise RuntimeError("aiohttp is not installed")
+    connector = aiohttp.TCPConnector(limit=ASYNC_MAX_INFLIGHT, limit_per_host=ASYNC_PER_HOST,
+                                     keepalive_timeout=60, ttl_dns_cache=300)
+    return aiohttp.ClientSession(connector=connector)
+
+async def conditional_fetch_async(session, u, etag, last_mod, override_connect=None, override_read=None,
+                                  max_bytes=MAX_BODY_BYTES):
+    """
+    conditional_fetch の async 版。タイムアウト・条件付きヘッダ・戻り値・RetryLater は同じ。
+    接続エラーの再試行は同期版の Retry 設定（回数・backoff）に合わせる。
+    例外: aiohttp.ClientError / asyncio.TimeoutError / RetryLater など
+    """
+    ct, rt = _timeouts(u, override_connect, override_read)
+    hdr = _cond_headers(etag, last_mod)
+    host = urlsplit(u).netloc
+    timeout = aiohttp.ClientTimeout(sock_connect=ct, sock_read=rt)
 
-    r.raise_for_status()
-    return r.text, r.headers.get("ETag") or etag, r.headers.get("Last-Modified") or last_mod, ctype, r.status_code, took
+    for attempt in range(retry.total + 1):
+        last = attempt >= retry.total
+        _acquire_or_later(u, await ratelimit.acquire_async(host, wait_blocked=SINGLE_MODE))
+        t0 = time.time()
+        try:
+            async with session.get(_target(u), headers=hdr, timeout=timeout, allow_redirects=True) as r:
+                _observe(u, host, r.status, int((time.time()-t0)*1000), r.headers.get("Retry-After"))
+                ctype = (r.headers.get("Content-Type") or "").split(";")[0].lower()
+                if r.status == 304:
+                    return None, etag, last_mod, ctype, r.status, int((time.time()-t0)*1000)
+                r.raise_for_status()
+                body = _BodyReader(u, ctype, r.headers.get("Content-Length"), max_bytes)
+                async for chunk in r.content.iter_chunked(CHUNK_BYTES):
+                    body.feed(chunk)
+                text, ctype = body.result(r.headers.get("Content-Type"))
+                took = int((time.time()-t0)*1000)
+                return text, r.headers.get("ETag") or etag, r.headers.get("Last-Modified") or last_mod, ctype, r.status, took
+        except aiohttp.ConnectionTimeoutError:
+            # 接続タイムアウトは同期版(connect=3)同様に再試行する（ServerTimeoutError のサブクラスなので先に捕まえる）
+            ratelimit.observe(host, None, int((time.time()-t0)*1000))
+            if last: raise
+            await asyncio.sleep(retry.backoff_factor * (2 ** attempt))
+        except aiohttp.ServerTimeoutError:
+            ratelimit.observe(host, None, int((time.time()-t0)*1000))
+            raise  # 読み取りタイムアウトは同期版(read=0)同様リトライしない
+        except aiohttp.ClientConnectionError:
+            ratelimit.observe(host, None, int((time.time()-t0)*1000))
+            if last: raise
+            await asyncio.sleep(retry.backoff_factor * (2 ** attempt))
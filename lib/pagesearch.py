@@ -0,0 +1,96 @@
+# lib/pagesearch.py
+# pages の検索（文字2-gram・絞り込み・キーセット・ページング）。
+# core_cached.py と Cloud Function（cloudrun/functions/recommend）で共有する。
+# Cloud Function は単体でデプロイするので、cloudrun/functions/recommend/vendor.py が
+# このファイルを関数のディレクトリへコピーする（コピーもコミットする。標準ライブラリ以外に依存しないこと）。
+
+from __future__ import annotations
+import re, json, base64, unicodedata
+from datetime import date, datetime
+
+# 並び順のキー。last_fetched が null の行は最も古い扱い（schema.sql の idx_pages_keyset 等と同じ式）
+LF_KEY="coalesce(last_fetched,'-infinity'::timestamptz)"
+
+def normalize_filters(d:dict)->dict:
+    """
+    リクエストから絞り込み条件を取り出して揃える。不正な値は ValueError（呼び出し側で 400）
+      fiscal_year / scheme_type: 文字列・数値ならその1件、配列なら各要素（文字列・数値のみ）を文字列のリストに
+      deadline_after / deadline_before: YYYY-MM-DD
+    """
+    out={}
+    for k in ("fiscal_year","scheme_type"):
+        v=d.get(k)
+        if v is None or v=="" or v==[]: continue
+        vals=v if isinstance(v,(list,tuple)) else [v]
+        if not all(isinstance(x,(str,int,float)) and not isinstance(x,bool) for x in vals):
+            raise ValueError(f"bad {k}: {v!r}")
+        out[k]=[str(x) for x in vals]
+    for k in ("deadline_after","deadline_before"):
+        v=d.get(k)
+        if v is None or v=="": continue
+        if not isinstance(v,str): raise ValueError(f"bad {k}: {v!r}")
+        try: out[k]=date.fromisoformat(v).isoformat()
+        except ValueError: raise ValueError(f"bad {k}: {v!r}")
+    return out
+
+def encode_cursor(row:dict)->str:
+    """最後の行の (last_fetched, url) を次ページのカーソルにする"""
+    lf=row.get("last_fetched")
+    raw=json.dumps([lf.isoformat() if lf else None, row["url"]],ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cur:str)->tuple[str|None,str]:
+    try:
+        lf,url=json.loads(base64.urlsafe_b64decode(cur+"="*(-len(cur)%4)))
+        if lf is not None: datetime.fromisoformat(lf)
+        return lf,str(url)
+    except Exception:
+        raise ValueError(f"bad cursor: {cur!r}")
+
+_NGRAM_SPLIT=re.compile(r"[^0-9a-z\u3040-\u30fa\u30fc-\u30ff\u3400-\u9fff\uf900-\ufaff々〆]+")
+
+def ngram_query(q:str|None)->str|None:
+    """
+    検索語を pages.search_ngrams（schema.sql の public.ngram_tsv）と同じ規則で文字2-gram に切り、
+    & で結んだ tsquery 文字列にする。1文字だけの語は前方一致（その文字で始まる 2-gram と、連続の最後の1文字）。
+    切り出す文字は英数字/かな/漢字だけなので、引用符や演算子が混ざることはない。
+    """
+    terms=[]
+    for w in _NGRAM_SPLIT.split(unicodedata.normalize("NFKC", q or "").lower()):
+        if len(w)==1: terms.append(f"'{w}':*")
+        else: terms += [f"'{w[i:i+2]}'" for i in range(len(w)-1)]
+    return " & ".join(dict.fromkeys(terms)) or None
+
+def where_clause(q:str|None, cursor:str|None, filters:dict|None)->tuple[str,list]:
+    """
+    絞り込み条件（文字列は固定の断片だけ。値はすべてパラメータ）
+      q: 文字2-gram 検索 / cursor: (LF_KEY, url) より後 / filters: normalize_filters を通したもの
+      （fiscal_year, scheme_type は文字列のリスト、deadline_after, deadline_before は YYYY-MM-DD。締切が読めない行は対象外）
+    """
+    f=filters or {}; cond,args=[],[]
+    if q:
+        tsq=ngram_query(q)
+        if tsq: cond.append("search_ngrams @@ %s::tsquery"); args.append(tsq)
+    for col in ("fiscal_year","scheme_type"):
+        v=f.get(col)
+        if v:
+            cond.append(f"{col} = any(%s)"); args.append(list(v))
+    if f.get("deadline_after"):
+        cond.append("deadline_date >= %s::date"); args.append(f["deadline_after"])
+    if f.get("deadline_before"):
+        cond.append("deadline_date <= %s::date"); args.append(f["deadline_before"])
+    if cursor:
+        lf,url=decode_cursor(cursor)
+        cond.append(f"({LF_KEY}, url) < (coalesce(%s::timestamptz,'-infinity'::timestamptz), %s)"); args += [lf,url]
+    return (" where "+" and ".join(cond) if cond else ""), args
+
+def search_pages(cur, cols:str, q:str|None, limit:int=40, cursor:str|None=None,
+                 filters:dict|None=None)->tuple[list[dict],str|None]:
+    """(行, 次ページのカーソル)。並びは LF_KEY desc, url desc（idx_pages_keyset）。cols に last_fetched, url を含めること"""
+    where,args=where_clause(q, cursor, filters)
+    cur.execute(f"select {cols} from public.pages{where}"
+                f" order by {LF_KEY} desc, url desc limit %s", (*args, limit+1))
+    names=[d.name for d in cur.description]
+    rows=[dict(zip(names,row)) for row in cur]
+    nxt=encode_cursor(rows[limit-1]) if len(rows)>limit else None
+    return rows[:limit], nxt
@@ -0,0 +1,154 @@
+# lib/pdf.py
+# PDF 本文の抽出（公募要領など）。pypdf が無い/失敗したときは従来どおりファイル名だけの行にする。
+# - 解析は CPU を食うので ProcessPoolExecutor（spawn）で別プロセスに出す（GIL を取り合わない）。
+#   呼び出したクロールのスレッドは結果を待つ：空きワーカー待ち PDF_QUEUE_SEC ＋ 解析 PDF_TIME_SEC（＋猶予）が上限
+# - ページ順に読み、PDF_STOP_FIELDS が全部そろったらそこで打ち切る
+# - 1文書あたり PDF_MAX_PAGES ページ / PDF_TIME_SEC 秒まで。時間はワーカー内で測り、
+#   1ページの抽出が長引いてもタイマー（SIGALRM）で止めてそこまでの本文を返す。
+#   それでも返らないワーカーはプールごと作り直す
+#
+# ENV:
+#   PDF_MAX_PAGES (既定: 20)
+#   PDF_TIME_SEC (既定: 20)   … 解析時間（ワーカーが解析を始めてから）
+#   PDF_QUEUE_SEC (既定: 30)  … 空きワーカー待ち。超えたらファイル名だけの行にする
+#   PDF_WORKERS (既定: 2)     … 0 でプロセスを使わずその場で解析（デバッグ用）
+
+from __future__ import annotations
+import io, os, re, time, atexit, signal, logging, threading, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from .util import norm_ws, clip
+from .extractors import extract_fields, make_row, normalize_text, row_from_pdf_url
+
+try:
+    from pypdf import PdfReader
+except Exception:
+    PdfReader = None
+
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "20"))
+PDF_TIME_SEC  = float(os.getenv("PDF_TIME_SEC", "20"))
+PDF_QUEUE_SEC = float(os.getenv("PDF_QUEUE_SEC", "30"))
+PDF_WORKERS   = int(os.getenv("PDF_WORKERS", "2"))
+_GRACE_SEC    = 5  # ワーカー内のタイマーが効かなかったときに親が見切るまでの猶予
+PDF_STOP_FIELDS = ("rate", "cap", "target", "deadline")
+# 作成ソフトが入れる意味のないタイトル（これなら本文の1行目を使う）
+_JUNK_TITLE = re.compile(r"^(?:untitled|無題|microsoft (?:word|excel|powerpoint) - .*|.*\.(?:docx?|xlsx?|pptx?|pdf))$", re.I)
+
+log = logging.getLogger(__name__)
+
+class _Deadline(Exception):
+    pass
+
+def _alarm(signum, frame):
+    raise _Deadline()
+
+def _arm(sec: float) -> bool:
+    """ワーカー（のメインスレッド）なら sec 秒後に _Deadline を投げるタイマーを掛ける"""
+    if not hasattr(signal, "setitimer") or threading.current_thread() is not threading.main_thread():
+        return False
+    signal.signal(signal.SIGALRM, _alarm)
+    signal.setitimer(signal.ITIMER_REAL, max(sec, 0.01))
+    return True
+
+def extract_pdf(data: bytes, max_pages: int = PDF_MAX_PAGES, time_sec: float = PDF_TIME_SEC) -> tuple[str, str, dict]:
+    """
+    (タイトル, 本文先頭, フィールド) を返す。プロセスプールのワーカーで実行される。
+    フィールドはページごとに extract_fields して、先に見つかった値を残す。
+    time_sec を過ぎたら（ページの途中でも）そこまでに読めたページで返す。
+    """
+    logging.getLogger("pypdf").setLevel(logging.ERROR)  # 壊れ気味のPDFで警告が大量に出る
+    t0 = time.monotonic()
+    armed = _arm(time_sec)
+    title = ""
+    texts: list[str] = []
+    fields: dict = {}
+    try:
+        reader = PdfReader(io.BytesIO(data))
+        title = norm_ws(getattr(reader.metadata, "title", None) or "")
+        if _JUNK_TITLE.match(title): title = ""
+        for i, page in enumerate(reader.pages):
+            if i >= max_pages or time.monotonic() - t0 > time_sec:
+                break
+            t = normalize_text(page.extract_text() or "")
+            if not t: continue
+            texts.append(t)
+            for k, v in extract_fields(t).items():
+                if v and not fields.get(k): fields[k] = v
+            if all(fields.get(k) for k in PDF_STOP_FIELDS):
+                break
+    except _Deadline:
+        pass
+    finally:
+        if armed: signal.setitimer(signal.ITIMER_REAL, 0)
+    text = "\n".join(texts)
+    if not title:
+        title = next((norm_ws(l) for l in text.splitlines() if len(norm_ws(l)) >= 6), "")
+    return title, text[:2000], fields
+
+_pool: ProcessPoolExecutor | None = None
+_pool_lock = threading.Lock()
+# 空きワーカーの数。取れたら submit するので、プール内で順番待ちにならず .result の待ちが解析時間だけになる
+_slots = threading.BoundedSemaphore(max(PDF_WORKERS, 1))
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # fork だと DB プール等のスレッドのロックを子に持ち込むので spawn
+            _pool = ProcessPoolExecutor(max_workers=PDF_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        p, _pool = _pool, None
+    if p is not None:
+        p.shutdown(wait=False, cancel_futures=True)
+
+def _recycle(p: ProcessPoolExecutor):
+    """止まったワーカーごとプール p を捨てる（次の _get_pool で作り直す。p の解析中の分は失敗扱いになる）"""
+    global _pool
+    with _pool_lock:
+        if _pool is p: _pool = None
+    # 公開 API にワーカーを止める手段が無いので、プールが持つプロセスを直接止める
+    for proc in list((getattr(p, "_processes", None) or {}).values()):
+        proc.terminate()
+    p.shutdown(wait=False, cancel_futures=True)
+
+atexit.register(close_pool)
+
+def row_from_pdf(url: str, data: bytes | None) -> dict:
+    """
+    PDF の bytes から pages 行を作る。本文が取れなければ row_from_pdf_url（ファイル名のみ）。
+    """
+    if PdfReader is None or not data:
+        return row_from_pdf_url(url)
+    try:
+        if PDF_WORKERS > 0:
+            if not _slots.acquire(timeout=PDF_QUEUE_SEC):
+                log.warning("pdf extract queue full (%ss): %s", PDF_QUEUE_SEC, url)
+                return row_from_pdf_url(url)
+            try:
+                pool = _get_pool()
+                fut = pool.submit(extract_pdf, data)
+            except BaseException:
+                _slots.release(); raise
+            fut.add_done_callback(lambda _: _slots.release())
+            try:
+                title, text, fields = fut.result(timeout=PDF_TIME_SEC + _GRACE_SEC)
+            except FutureTimeout:
+                # ワーカー内のタイマーでも戻らない（C 拡張の中で止まっている等）→ プールを作り直す
+                _recycle(pool)
+                raise
+        else:
+            title, text, fields = extract_pdf(data)
+    except FutureTimeout:
+        log.warning("pdf extract timeout (%ss): %s", PDF_TIME_SEC, url)
+        return row_from_pdf_url(url)
+    except Exception as e:
+        log.warning("pdf extract failed: %s: %s", url, e)
+        return row_from_pdf_url(url)
+    if not text:
+        return row_from_pdf_url(url)  # 画像だけのPDF等
+    fallback = row_from_pdf_url(url)["title"]
+    return make_row(url, clip(title, 200) or fallback, clip(norm_ws(text), 800), **fields)
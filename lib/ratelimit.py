@@ -0,0 +1,131 @@
+# lib/ratelimit.py
+# ホスト別のトークンバケット（全レーン共通。lib.http_client の GET が必ず通る）
+# - 取得前に acquire(host)（async 版は acquire_async）でトークンを予約し、必要な分だけ待つ
+#   Retry-After でホストが止まっている間は待たずに残り秒数を返す（呼び出し側が RetryLater で再投入する）
+# - 取得後に observe(host, status, took_ms, retry_after) で速度を調整（AIMD）
+#     正常かつ応答が平常並み → rate += RL_ADD
+#     429/503・平常の RL_SLOW_FACTOR 倍以上遅い → rate *= RL_BACKOFF
+#     Retry-After があればその時刻までホストを止める
+# - stats() でホスト別の状態を返す（サマリ表示用）
+#
+# ENV:
+#   RL_RATE (既定: 1.0)         … 初期レート（req/s/host）
+#   RL_BURST (既定: 2)          … バケット容量
+#   RL_MIN_RATE (既定: 0.05)
+#   RL_MAX_RATE (既定: 8.0)
+#   RL_ADD (既定: 0.1)          … 加算増加幅
+#   RL_BACKOFF (既定: 0.5)      … 乗算減少率
+#   RL_SLOW_FACTOR (既定: 2.0)  … 平常（EWMA）の何倍で「遅い」とみなすか
+
+import os, time, asyncio, threading
+from email.utils import parsedate_to_datetime
+
+RL_RATE        = float(os.getenv("RL_RATE", "1.0"))
+RL_BURST       = float(os.getenv("RL_BURST", "2"))
+RL_MIN_RATE    = float(os.getenv("RL_MIN_RATE", "0.05"))
+RL_MAX_RATE    = float(os.getenv("RL_MAX_RATE", "8.0"))
+RL_ADD         = float(os.getenv("RL_ADD", "0.1"))
+RL_BACKOFF     = float(os.getenv("RL_BACKOFF", "0.5"))
+RL_SLOW_FACTOR = float(os.getenv("RL_SLOW_FACTOR", "2.0"))
+
+THROTTLE_STATUS = {429, 503}
+
+class HostLimiter:
+    def __init__(self, rate: float = RL_RATE, burst: float = RL_BURST):
+        self._lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.blocked_until = 0.0
+        self.ewma_ms: float | None = None
+        self.requests = 0
+        self.throttled = 0
+        self.waited_sec = 0.0
+
+    def blocked_for(self) -> float:
+        """Retry-After による停止の残り秒数（0 なら停止していない）"""
+        with self._lock:
+            return max(0.0, self.blocked_until - time.monotonic())
+
+    def reserve(self) -> float:
+        """トークンを1つ予約し、送信まで待つべき秒数を返す（負債方式：待つ間も他は後ろに並ぶ）"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1.0
+            wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+            wait = max(wait, self.blocked_until - now)
+            self.requests += 1
+            self.waited_sec += wait
+            return wait
+
+    def observe(self, status: int | None, took_ms: int, retry_after: float | None = None):
+        with self._lock:
+            slow = self.ewma_ms is not None and took_ms > RL_SLOW_FACTOR * self.ewma_ms
+            if status in THROTTLE_STATUS or slow:
+                self.rate = max(RL_MIN_RATE, self.rate * RL_BACKOFF)
+                if status in THROTTLE_STATUS:
+                    self.throttled += 1
+            elif status is not None and status < 400:
+                self.rate = min(RL_MAX_RATE, self.rate + RL_ADD)
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+            if status is not None and status < 400:
+                self.ewma_ms = took_ms if self.ewma_ms is None else 0.8 * self.ewma_ms + 0.2 * took_ms
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"rate": round(self.rate, 3), "requests": self.requests,
+                    "throttled": self.throttled, "waited_sec": round(self.waited_sec, 1),
+                    "ewma_ms": int(self.ewma_ms or 0),
+                    "blocked_sec": round(max(0.0, self.blocked_until - time.monotonic()), 1)}
+
+_limiters: dict[str, HostLimiter] = {}
+_lock = threading.Lock()
+
+def limiter(host: str) -> HostLimiter:
+    with _lock:
+        if host not in _limiters:
+            _limiters[host] = HostLimiter()
+        return _limiters[host]
+
+def acquire(host: str, wait_blocked: bool = False) -> float:
+    """
+    送信してよくなるまで待つ（レート分の待ちだけ）。戻り値 0 なら送信してよい。
+    ホストが Retry-After で止まっていれば、トークンを取らず待たずに残り秒数を返す
+    （wait_blocked=True なら止まっている間も待つ：シリアルの1件処理用）
+    """
+    l = limiter(host)
+    b = l.blocked_for()
+    if b > 0 and not wait_blocked: return b
+    w = l.reserve()
+    if w > 0: time.sleep(w)
+    return 0.0
+
+async def acquire_async(host: str, wait_blocked: bool = False) -> float:
+    l = limiter(host)
+    b = l.blocked_for()
+    if b > 0 and not wait_blocked: return b
+    w = l.reserve()
+    if w > 0: await asyncio.sleep(w)
+    return 0.0
+
+def observe(host: str, status: int | None, took_ms: int, retry_after: float | None = None):
+    limiter(host).observe(status, took_ms, retry_after)
+
+def stats() -> dict[str, dict]:
+    with _lock:
+        items = list(_limiters.items())
+    return {h: l.snapshot() for h, l in items}
+
+def parse_retry_after(v: str | None) -> float | None:
+    """Retry-After（秒 or HTTP-date）を秒に"""
+    if not v: return None
+    v = v.strip()
+    if v.isdigit(): return float(v)
+    try:
+        return max(0.0, parsedate_to_datetime(v).timestamp() - time.time())
+    except Exception:
+        return None
@@ -0,0 +1,79 @@
+# lib/schedule.py
+# http_cache と fetch_log の履歴から URL ごとの変更頻度を見積もり、
+# 「今回取りに行くべき（due）」URL だけを返す再クロールスケジューラ。
+#
+#   基本間隔 = 観測期間 / 変更回数 / 2     （よく変わるページほど短い）
+#              変更が観測されていなければ SCHED_BASE_SEC
+#   間隔     = 基本間隔 × 2^(直近の連続未変更回数)   … 304/skip が続くほど指数的に後回し
+#   いずれも [SCHED_MIN_SEC, 上限] に丸める（上限: 詳細 SCHED_MAX_SEC / 一覧 SCHED_LIST_MAX_SEC）
+#
+# ENV:
+#   SCHED_ENABLED (既定: 1)            … 0 で全URLを毎回 due 扱い（従来動作）
+#   SCHED_MIN_SEC (既定: 3600)
+#   SCHED_BASE_SEC (既定: 21600)
+#   SCHED_MAX_SEC (既定: 604800)
+#   SCHED_LIST_MAX_SEC (既定: 7200)
+#   SCHED_WINDOW_DAYS (既定: 14)       … fetch_log を遡る日数（prune の保持期間と揃える）
+
+import os
+from typing import Iterable, List
+
+SCHED_ENABLED      = os.getenv("SCHED_ENABLED", "1") == "1"
+SCHED_MIN_SEC      = int(os.getenv("SCHED_MIN_SEC", "3600"))
+SCHED_BASE_SEC     = int(os.getenv("SCHED_BASE_SEC", "21600"))
+SCHED_MAX_SEC      = int(os.getenv("SCHED_MAX_SEC", "604800"))
+SCHED_LIST_MAX_SEC = int(os.getenv("SCHED_LIST_MAX_SEC", "7200"))
+SCHED_WINDOW_DAYS  = int(os.getenv("SCHED_WINDOW_DAYS", "14"))
+
+# ok=内容が変わった / skip・304=変わらなかった（deadline 等の took_ms=0 のスキップは数えない）
+_HISTORY_SQL = """
+  select h.url,
+         extract(epoch from now() - h.last_checked_at)::float8                                 as since_check,
+         extract(epoch from now() - coalesce(s.first_seen, h.last_checked_at))::float8         as span,
+         coalesce(s.changes, 0)                                                                as changes,
+         coalesce(t.streak, 0)                                                                 as streak
+    from public.http_cache h
+    left join lateral (
+      select min(f.fetched_at)                          as first_seen,
+             max(f.fetched_at) filter (where f.status='ok') as last_ok,
+             count(*) filter (where f.status='ok')      as changes
+        from public.fetch_log f
+       where f.url = h.url and f.took_ms > 0
+         and f.status in ('ok','skip','304')
+         and f.fetched_at > now() - make_interval(days => %s)
+    ) s on true
+    left join lateral (
+      select count(*) as streak
+        from public.fetch_log f
+       where f.url = h.url and f.took_ms > 0
+         and f.status in ('skip','304')
+         and f.fetched_at > greatest(s.last_ok, h.last_changed_at,
+                                     now() - make_interval(days => %s))
+    ) t on true
+   where h.url = any(%s)
+"""
+
+def interval_sec(span: float | None, changes: int, streak: int, kind: str = "detail") -> float:
+    cap = SCHED_LIST_MAX_SEC if kind == "list" else SCHED_MAX_SEC
+    base = (span or 0) / changes / 2 if changes else SCHED_BASE_SEC
+    base = min(max(base, SCHED_MIN_SEC), cap)
+    return min(cap, base * (2 ** min(streak, 16)))
+
+def due(c, urls: Iterable[str], kind: str = "detail") -> List[str]:
+    """
+    urls のうち再取得時期が来ているものを返す。
+    未取得（http_cache に無い）URL を先頭に、残りは期限超過の大きい順。
+    """
+    urls = list(dict.fromkeys(urls))
+    if not SCHED_ENABLED or not urls:
+        return urls
+    cur = c.cursor()
+    cur.execute(_HISTORY_SQL, (SCHED_WINDOW_DAYS, SCHED_WINDOW_DAYS, urls), prepare=False)
+    known = {}
+    for u, since_check, span, changes, streak in cur.fetchall():
+        if since_check is None:
+            continue
+        known[u] = since_check / interval_sec(span, changes, streak, kind)
+    fresh = [u for u in urls if u not in known]
+    overdue = sorted((u for u, r in known.items() if r >= 1.0), key=lambda u: -known[u])
+    return fresh + overdue
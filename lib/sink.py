@@ -0,0 +1,247 @@
+# lib/sink.py
+# fetch_log / http_cache / pages への書き込みをメモリに溜め、まとめて流す write-behind バッファ。
+# - ThreadPoolExecutor のワーカーから同時に呼んでよい（追加はロック内でリストに積むだけ）
+# - 行数(WB_MAX_ROWS) か 経過秒(WB_FLUSH_SEC) でバックグラウンドスレッドが flush
+# - arm_deadline() で締切直前にも flush、プロセス終了時(atexit)にも最終 flush
+# - まとめての書き込みが失敗したら1行ずつ（1行1トランザクション）書き直し、それでも失敗した行は
+#   バッファに戻して次の flush で再試行する。WB_MAX_RETRY 回失敗した行は捨てて stats["dropped"] に数える
+#
+# ENV:
+#   WB_MAX_ROWS (既定: 200)        … これだけ溜まったら flush を起こす
+#   WB_FLUSH_SEC (既定: 5)         … 最低でもこの間隔で flush
+#   WB_KILL_MARGIN_SEC (既定: 15)  … arm_deadline の締切の何秒前に flush するか
+#   WB_MAX_RETRY (既定: 3)         … 1行ずつでも失敗した行を再試行する回数
+
+import os, time, atexit, logging, threading
+import psycopg
+from typing import Callable, Optional
+from lib.db import (conn, UPSERT_PAGE_SQL, UPSERT_HTTP_META_SQL, LOG_FETCH_COLS,
+                    RUN_ID, page_values, http_meta_values, bump_generation, strip_nul)
+
+WB_MAX_ROWS        = int(os.getenv("WB_MAX_ROWS", "200"))
+WB_FLUSH_SEC       = float(os.getenv("WB_FLUSH_SEC", "5"))
+WB_KILL_MARGIN_SEC = float(os.getenv("WB_KILL_MARGIN_SEC", "15"))
+WB_MAX_RETRY       = int(os.getenv("WB_MAX_RETRY", "3"))
+
+log = logging.getLogger(__name__)
+
+class WriteBehind:
+    def __init__(self, max_rows: int = WB_MAX_ROWS, flush_sec: float = WB_FLUSH_SEC):
+        self.max_rows  = max_rows
+        self.flush_sec = flush_sec
+        self._lock       = threading.Lock()   # バッファ操作
+        self._flush_lock = threading.Lock()   # flush は同時に1本だけ
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._logs: list[tuple] = []
+        self._meta: dict[str, tuple] = {}      # url -> http_meta_values（同一URLは最後の値）
+        self._pages: dict[str, list] = {}      # url -> page_values
+        self._page_logs: list[tuple] = []      # (url, took_ms, err, lane, on_change) … status は flush 時に ok/skip を確定
+        self._page_meta: dict[str, tuple] = {} # url -> http_meta_values（その pages 行が書けた時だけ書く）
+        self._fails: dict[tuple, int] = {}     # 1行ずつでも失敗した行 -> 失敗回数
+        self.stats = {"flushes": 0, "rows": 0, "changed": 0, "errors": 0, "retried": 0, "dropped": 0}
+
+    # ---- 追加（ワーカーから呼ぶ） ----
+    def log_fetch(self, url, status, took_ms, err, lane=None):
+        row = tuple(strip_nul((url, status, took_ms, err, RUN_ID, lane)))
+        self._add(lambda: self._logs.append(row))
+
+    def upsert_http_meta(self, url, etag, last_mod, status, body_hash=None):
+        vals = tuple(strip_nul(http_meta_values(url, etag, last_mod, status, body_hash)))
+        self._add(lambda: self._meta.__setitem__(url, vals))
+
+    def upsert_page(self, row: dict, took_ms: int = 0, err: str | None = None,
+                    lane: str | None = None, on_change: Callable[[str], None] | None = None,
+                    http_meta: tuple | None = None):
+        """
+        pages 行を溜める。変更有無は flush 時に判明するので、
+        fetch_log は ok/skip を確定させてから書き、変更時は on_change(url) を呼ぶ。
+        http_meta（http_meta_values。本文ハッシュ付き）はこの行が書けた時だけ同じトランザクションで書く
+        """
+        vals = page_values(row)
+        meta = tuple(strip_nul(http_meta)) if http_meta else None
+        def add():
+            self._pages[row["url"]] = vals
+            self._page_logs.append((row["url"], took_ms, err, lane, on_change))
+            if meta: self._page_meta[meta[0]] = meta
+        self._add(add)
+
+    def pending_pages(self) -> int:
+        """まだ書いていない pages 行の数（変更有無は flush するまで分からない）"""
+        with self._lock:
+            return len(self._pages)
+
+    def _pending(self) -> int:
+        return len(self._logs) + len(self._meta) + len(self._pages)
+
+    def _add(self, fn):
+        with self._lock:
+            fn()
+            full = self._pending() >= self.max_rows
+        self._ensure_thread()
+        if full:
+            self._wake.set()
+
+    # ---- flush ----
+    def flush(self) -> int:
+        """溜まっている行を書き出し、変更された pages の件数を返す"""
+        with self._flush_lock:
+            with self._lock:
+                logs, self._logs = self._logs, []
+                meta, self._meta = self._meta, {}
+                pages, self._pages = self._pages, {}
+                page_logs, self._page_logs = self._page_logs, []
+                page_meta, self._page_meta = self._page_meta, {}
+            if not (logs or meta or pages):
+                return 0
+            try:
+                changed = self._write(pages, meta, page_logs, logs, page_meta)
+                done = page_logs
+            except Exception as e:
+                self.stats["errors"] += 1
+                log.warning("write-behind flush failed (pages=%d meta=%d logs=%d): %s -> row by row",
+                            len(pages), len(meta), len(logs), e)
+                changed, done = self._write_each(pages, meta, page_logs, logs, page_meta)
+            self.stats["flushes"] += 1
+            self.stats["rows"] += len(pages) + len(meta) + len(logs)
+            self.stats["changed"] += len(changed)
+            # flush() から戻った時点で呼び出し側の集計が確定しているようロック内で通知
+            for u, *_, cb in done:
+                if cb and u in changed:
+                    cb(u)
+        return len(changed)
+
+    def _write(self, pages: dict, meta: dict, page_logs: list, logs: list, page_meta: dict) -> set[str]:
+        """全部を1トランザクションで書く（executemany + COPY）。変更された pages の url を返す"""
+        changed: set[str] = set()
+        meta = {**meta, **{u: v for u, v in page_meta.items() if u in pages}}
+        with conn() as c, c.transaction():
+            cur = c.cursor()
+            if pages:
+                cur.executemany(UPSERT_PAGE_SQL, list(pages.values()), returning=True)
+                while True:
+                    r = cur.fetchone()
+                    if r: changed.add(r[0])
+                    if not cur.nextset(): break
+                if changed:
+                    bump_generation(c)
+            if meta:
+                cur.executemany(UPSERT_HTTP_META_SQL, list(meta.values()))
+            rows = logs + [(u, "ok" if u in changed else "skip", took, err, RUN_ID, lane)
+                           for u, took, err, lane, _ in page_logs]
+            if rows:
+                with cur.copy(f"copy public.fetch_log({','.join(LOG_FETCH_COLS)}) from stdin") as cp:
+                    for r in rows:
+                        cp.write_row(r)
+        for u in pages: self._fails.pop(("page", u), None)
+        for u in meta: self._fails.pop(("meta", u), None)
+        for r in logs: self._fails.pop(("log", r), None)
+        return changed
+
+    def _write_each(self, pages: dict, meta: dict, page_logs: list, logs: list,
+                    page_meta: dict) -> tuple[set[str], list]:
+        """
+        1行1トランザクションで書き直す。書けなかった行はバッファに戻す（WB_MAX_RETRY 回で諦める）。
+        (変更された url, fetch_log まで書けた page_logs) を返す
+        """
+        changed: set[str] = set()
+        ok_pages: set[str] = set(); ok_meta: set[str] = set(); ok_logs: set[int] = set()
+        done: list = []
+        log_sql = (f"insert into public.fetch_log({','.join(LOG_FETCH_COLS)}) "
+                   f"values({','.join(['%s'] * len(LOG_FETCH_COLS))})")
+
+        def one(c, sql, vals, key) -> bool:
+            try:
+                with c.transaction():
+                    cur = c.execute(sql, vals, prepare=False)
+                    if key[0] == "page" and cur.fetchone(): changed.add(key[1])
+            except psycopg.OperationalError:
+                raise  # 接続が切れた：残りは全部次回へ
+            except Exception as e:
+                log.warning("write-behind row failed (%s %s): %s", key[0], key[1] if key[0] != "log" else key[1][0], e)
+                return False
+            self._fails.pop(key, None)
+            return True
+
+        try:
+            with conn() as c:
+                for u, vals in pages.items():
+                    if one(c, UPSERT_PAGE_SQL, vals, ("page", u)): ok_pages.add(u)
+                if changed:
+                    bump_generation(c)
+                meta = {**meta, **{u: v for u, v in page_meta.items() if u in ok_pages}}
+                for u, vals in meta.items():
+                    if one(c, UPSERT_HTTP_META_SQL, vals, ("meta", u)): ok_meta.add(u)
+                done = [pl for pl in page_logs if pl[0] in ok_pages]
+                rows = [(u, "ok" if u in changed else "skip", took, err, RUN_ID, lane)
+                        for u, took, err, lane, _ in done]
+                for i, r in enumerate(logs):
+                    if one(c, log_sql, r, ("log", r)): ok_logs.add(i)
+                for r in rows:
+                    one(c, log_sql, r, ("log", r))  # 結果の fetch_log は失敗しても再送しない（pages は書けている）
+        except Exception as e:
+            log.warning("write-behind row-by-row stopped: %s", e)
+        self._requeue({u: v for u, v in pages.items() if u not in ok_pages},
+                      {u: v for u, v in meta.items() if u not in ok_meta},
+                      [pl for pl in page_logs if pl[0] not in ok_pages],
+                      [r for i, r in enumerate(logs) if i not in ok_logs],
+                      {u: v for u, v in page_meta.items() if u not in ok_pages})
+        return changed, done
+
+    def _retry(self, key) -> bool:
+        n = self._fails.get(key, 0) + 1
+        if n > WB_MAX_RETRY:
+            self._fails.pop(key, None)
+            self.stats["dropped"] += 1
+            log.error("write-behind dropped %s %s after %d tries", key[0], key[1] if key[0] != "log" else key[1][0], n - 1)
+            return False
+        self._fails[key] = n
+        self.stats["retried"] += 1
+        return True
+
+    def _requeue(self, pages: dict, meta: dict, page_logs: list, logs: list, page_meta: dict):
+        """書けなかった行をバッファに戻す（その間に同じ url の新しい値が来ていればそちらを優先）"""
+        with self._lock:
+            for u, vals in pages.items():
+                if self._retry(("page", u)):
+                    self._pages.setdefault(u, vals)
+            for u, vals in page_meta.items():
+                if u in self._pages: self._page_meta.setdefault(u, vals)
+            for pl in page_logs:
+                if pl[0] in self._pages: self._page_logs.append(pl)
+                else: self._logs.append((pl[0], "ng", pl[1], "write-behind: page write failed", RUN_ID, pl[3]))
+            for u, vals in meta.items():
+                if self._retry(("meta", u)):
+                    self._meta.setdefault(u, vals)
+            for r in logs:
+                if self._retry(("log", r)):
+                    self._logs.append(r)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_sec)
+            self._wake.clear()
+            self.flush()
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+                self._thread.start()
+
+    def arm_deadline(self, deadline: float, margin: float = WB_KILL_MARGIN_SEC):
+        """deadline(epoch秒) の margin 秒前に必ず flush する（HARD_KILL_SEC 対策）"""
+        t = threading.Timer(max(0.0, deadline - margin - time.time()), self.flush)
+        t.daemon = True
+        t.start()
+        return t
+
+    def close(self):
+        self._stop.set(); self._wake.set()
+        self.flush()
+
+WB = WriteBehind()
+atexit.register(WB.close)
@@ -4,12 +4,18 @@ import time
 import re
 import argparse
 import logging
+import signal
+import socket
 import requests
-from urllib.parse import urlparse
-
-from lib.db import ensure_schema, conn, upsert_http_meta, upsert_page, log_fetch
-from lib.http_client import conditional_fetch
-from lib.extractors import extract_from_html, norm_ws, clip
+from urllib.parse import urljoin
+
+from lib.db import ensure_schema, conn, upsert_page, pool_stats, RUN_ID
+from lib.sink import WB
+from lib.http_client import conditional_fetch, BodyTooLarge
+from lib import ratelimit
+from lib.extractors import extract_from_html, extract_fields, make_row, norm_ws, clip
+from lib.pdf import row_from_pdf
+from lib import bodystore
 from lanes.lane_search_openai import dr_fetch_text  # DRでURL本文を読む
 
 # ==== シリアル/実行モード関連 ENV ====
@@ -19,15 +25,16 @@ SINGLE_MAX_TRY              = int(os.getenv("SINGLE_MAX_TRY", "5"))
 SINGLE_STAGE1_READ_TIMEOUT  = int(os.getenv("SINGLE_STAGE1_READ_TIMEOUT", "180"))  # ← 3分
 DR_FETCH_ON_SERIAL          = os.getenv("DR_FETCH_ON_SERIAL", "1") == "1"
 
-# RUN_ID: 未設定なら実行時刻で自動採番（サマリ集計のため常時付与）
-RUN_ID = os.getenv("RUN_ID")
-if not RUN_ID:
-    RUN_ID = str(int(time.time()))
+# fetch_log.lane（run --lane で上書き）
+LANE = "serial"
+
+# バックフィルのリース（取得したURLを他ワーカーに渡さない秒数）。HARD_KILL_SEC より長く
+BACKFILL_LEASE_SEC          = int(os.getenv("BACKFILL_LEASE_SEC", "900"))
+WORKER_ID                   = f"{RUN_ID}:{socket.gethostname()}:{os.getpid()}"
 
-# 巨大判定（これ以上はDRへ）
+# 巨大判定（これ以上はGETを打ち切ってDRへ）
 LARGE_BYTES_THRESHOLD       = int(os.getenv("SINGLE_LARGE_BYTES", "8000000"))  # 8MB
-HEAD_CONNECT_TIMEOUT        = int(os.getenv("HEAD_CONNECT_TIMEOUT", "8"))
-HEAD_READ_TIMEOUT           = int(os.getenv("HEAD_READ_TIMEOUT", "6"))
+DR_ON_304                   = os.getenv("DR_ON_304", "0") == "1"   # 304 でもDRを回すか（既定は回さない）
 
 # 取り回し上の既定
 DOC_TYPES = {"text/html", "application/xhtml+xml", "application/pdf"}
@@ -35,191 +42,170 @@ DOC_TYPES = {"text/html", "application/xhtml+xml", "application/pdf"}
 def time_left(deadline: float) -> float:
     return max(0.0, deadline - time.time())
 
-def log_run(c, url: str, status: str, took_ms: int, msg: str | None):
-    prefix = f"run={RUN_ID}; " if RUN_ID else ""
-    log_fetch(c, url, status, took_ms, prefix + (msg or ""))
-
-def _row_from_pdf(url: str) -> dict:
-    title = os.path.basename(urlparse(url).path) or "(PDF)"
-    title = title.replace(".pdf", "").replace(".PDF", "")
-    return {
-        "url": url,
-        "title": f"{title} (PDF)",
-        "summary": "PDF（本文未解析）",
-        "rate": None, "cap": None, "target": None, "cost_items": None,
-        "deadline": None, "fiscal_year": None, "call_no": None,
-        "scheme_type": None, "period_from": None, "period_to": None
-    }
+def log_run(url: str, status: str, took_ms: int, msg: str | None):
+    WB.log_fetch(url, status, took_ms, msg, lane=LANE)
+
+def _upsert(row: dict) -> bool:
+    # 分岐（DRに回すか）に結果が要るので pages だけは同期で書く
+    with conn() as c:
+        return upsert_page(c, row)
 
 def pick_untitled_batch(n: int) -> list[str]:
+    """
+    (無題)/空要約のページを最大 n 件「取得」して返す。
+    pages 行を SKIP LOCKED で押さえつつ backfill_claims にリースを書くので、
+    同時に走る serial/Cloud Run ワーカー同士で同じURLを取らない。
+    失敗したURLはリース切れ（BACKFILL_LEASE_SEC）まで他ワーカーからも取られず、
+    mark_tried で backfill_tried_at が進むので、その後も未試行の行より後に回る。
+    """
     with conn() as c, c.cursor() as cur:
         cur.execute(
             """
-            select url
-              from public.pages
-             where position('https://example.com/sentinel' in url)=0
-               and (title='(無題)' or coalesce(summary,'')='')
-             order by last_fetched asc nulls first
-             limit %s
+            with cand as (
+              select p.url
+                from public.pages p
+                left join public.backfill_claims b on b.url = p.url
+               where (p.title='(無題)' or coalesce(p.summary,'')='')
+                 and position('https://example.com/sentinel' in p.url)=0
+                 and (b.url is null or b.lease_until < now())
+               order by p.backfill_tried_at asc nulls first, p.last_fetched asc nulls first
+               limit %s
+                 for update of p skip locked
+            )
+            insert into public.backfill_claims(url, claimed_by, lease_until)
+            select url, %s, now() + make_interval(secs => %s) from cand
+            on conflict (url) do update
+               set claimed_by = excluded.claimed_by, lease_until = excluded.lease_until
+             where public.backfill_claims.lease_until < now()
+            returning url
             """,
-            (n,), prepare=False
+            (n, WORKER_ID, BACKFILL_LEASE_SEC), prepare=False
         )
         return [r[0] for r in cur.fetchall()]
 
+def release_claim(url: str):
+    with conn() as c:
+        c.execute("delete from public.backfill_claims where url=%s and claimed_by=%s",
+                  (url, WORKER_ID), prepare=False)
+
+def mark_tried(url: str):
+    """バックフィルで直らなかった（304/ng/skip/例外）行を後回しにする"""
+    with conn() as c:
+        c.execute("update public.pages set backfill_tried_at=now() where url=%s", (url,), prepare=False)
+
 def _upsert_text_as_summary(url: str, text: str) -> bool:
     title = norm_ws(text.splitlines()[0] if text else "") or "(本文抜粋)"
-    row = {
-        "url": url, "title": title[:80],
-        "summary": clip(norm_ws(text), 800),
-        "rate": None, "cap": None, "target": None, "cost_items": None,
-        "deadline": None, "fiscal_year": None, "call_no": None,
-        "scheme_type": None, "period_from": None, "period_to": None
-    }
-    with conn() as c:
-        return upsert_page(c, row)
+    return _upsert(make_row(url, title[:80], clip(norm_ws(text), 800), **extract_fields(text)))
 
-def head_preflight(url: str):
-    try:
-        r = requests.head(
-            url, allow_redirects=True,
-            timeout=(HEAD_CONNECT_TIMEOUT, HEAD_READ_TIMEOUT),
-            headers={"User-Agent":"Mozilla/5.0","Accept":"*/*"}
-        )
-        ct = (r.headers.get("Content-Type") or "").split(";")[0].lower()
-        cl = r.headers.get("Content-Length")
-        size = int(cl) if (cl and cl.isdigit()) else None
-        return ct, size
-    except Exception:
-        return None, None
-
-def process_one(url: str) -> bool:
-    """
-    1件だけ処理：
-      0) HEADで軽く判定（PDF/巨大→DR or PDFタイトル更新）
-      1) Stage1: READ=3分でGET。ReadTimeoutなら即DRに切替
-      2) HTML抽出 or PDFタイトル更新
-      3) 失敗/不足はDRで本文抽出
-    """
-    # 0) HEAD プリフライト
-    ct_head, size_head = head_preflight(url)
-
-    # PDF は本文GETせずタイトル更新
-    if ct_head == "application/pdf":
-        with conn() as c:
-            changed = upsert_page(c, _row_from_pdf(url))
-            log_run(c, url, "ok" if changed else "skip", 0, "single head: pdf")
+def _stored_validators(url: str):
+    with conn() as c, c.cursor() as cur:
+        cur.execute("select etag, last_modified, body_hash from public.http_cache where url=%s", (url,), prepare=False)
+        return cur.fetchone() or (None, None, None)
+
+def _dr(url: str, msg: str, none_status: str = "skip", none_msg: str | None = None) -> bool:
+    """DRで本文を取って要約として保存。DR無効/取得なしは none_status で記録"""
+    if not DR_FETCH_ON_SERIAL:
+        log_run(url, none_status, 0, none_msg or msg)
+        return False
+    txt = dr_fetch_text(url, max_chars=6000)
+    if txt:
+        changed = _upsert_text_as_summary(url, txt)
+        log_run(url, "ok" if changed else "skip", 0, msg)
         return changed
+    log_run(url, none_status, 0, none_msg or f"{msg} none")
+    return False
 
-    # 巨大は DR 抽出
-    if size_head and size_head >= LARGE_BYTES_THRESHOLD and DR_FETCH_ON_SERIAL:
-        txt = dr_fetch_text(url, max_chars=6000)
-        with conn() as c:
-            if txt:
-                changed = _upsert_text_as_summary(url, txt)
-                log_run(c, url, "ok" if changed else "skip", 0, f"single head: large->{size_head} dr-fetch")
-                return changed
-            else:
-                log_run(c, url, "skip", 0, f"single head: large->{size_head} dr-fetch none")
+def _fetch_pdf(pdf_url: str) -> bytes | None:
+    """meta refresh 先の PDF を取る（取れない/PDFでなければ None → row_from_pdf がファイル名だけの行にする）"""
+    try:
+        data, _, _, ctype, _, _ = conditional_fetch(pdf_url, None, None,
+                                                    override_read=SINGLE_STAGE1_READ_TIMEOUT,
+                                                    max_bytes=LARGE_BYTES_THRESHOLD)
+    except Exception as e:
+        logging.warning("pdf fetch failed: %s: %s: %s", pdf_url, type(e).__name__, e)
+        return None
+    return data if ctype == "application/pdf" and isinstance(data, bytes) else None
 
-    # 1) Stage1 GET（READ=3分）
+def process_one(url: str, backfill: bool = False) -> bool:
+    """
+    1件だけ処理（条件付きGET 1回で判定）：
+      1) http_cache の ETag/Last-Modified を付けてストリームGET（READ=3分、SINGLE_LARGE_BYTES で打ち切り）
+         304 → 変更なしで終了（DR_ON_304=1 のときだけDR）
+         backfill=True（(無題)/空要約の修復）は保存済みの行が壊れているので、ETag 等を付けずに本文を取り直す
+      2) 応答ヘッダ/先頭バイトで判定：HTML抽出（meta refresh→PDF） / PDF本文抽出 / その他はDR
+      3) 巨大・ReadTimeout・失敗・抽出で変化なし・前回と同じ本文（body_hash）はDRで本文抽出
+    """
+    etag0, lm0, hash0 = _stored_validators(url)
     try:
         html, etag, lm, ctype, status, took = conditional_fetch(
-            url, None, None,
+            url, None if backfill else etag0, None if backfill else lm0,
             override_connect=None,
-            override_read=SINGLE_STAGE1_READ_TIMEOUT
+            override_read=SINGLE_STAGE1_READ_TIMEOUT,
+            max_bytes=LARGE_BYTES_THRESHOLD,
         )
-        with conn() as c:
-            upsert_http_meta(c, url, etag, lm, status)
-
-        ct = (ctype or "").lower()
-
-        if html is None:
-            # 304 → DR
-            if DR_FETCH_ON_SERIAL:
-                txt = dr_fetch_text(url, max_chars=6000)
-                with conn() as c:
-                    if txt:
-                        changed = _upsert_text_as_summary(url, txt)
-                        log_run(c, url, "ok" if changed else "skip", 0, "single dr-fetch (304)")
-                        return changed
-                    else:
-                        log_run(c, url, "skip", 0, "single dr-fetch none (304)")
-            return False
-
-        if ct in ("text/html", "application/xhtml+xml"):
-            # meta refresh → PDF
-            m = re.search(r'http-equiv=["\']refresh["\'].*?url=([^";\']+\.pdf)', html, flags=re.I)
-            if m:
-                pdf_url = m.group(1)
-                with conn() as c:
-                    changed = upsert_page(c, _row_from_pdf(pdf_url))
-                    log_run(c, url, "ok" if changed else "skip", took, "single html->pdf meta refresh")
-                return changed
-
-            # HTML抽出
-            with conn() as c:
-                changed = upsert_page(c, extract_from_html(url, html))
-                log_run(c, url, "ok" if changed else "skip", took, f"single html stage1 status={status}")
-            if not changed and DR_FETCH_ON_SERIAL:
-                txt = dr_fetch_text(url, max_chars=6000)
-                with conn() as c:
-                    if txt:
-                        changed = _upsert_text_as_summary(url, txt)
-                        log_run(c, url, "ok" if changed else "skip", 0, "single dr-fetch after html")
-                        return changed
-                    else:
-                        log_run(c, url, "skip", 0, "single dr-fetch none after html")
-            return changed
+    except BodyTooLarge as e:
+        # 巨大は DR 抽出（読み込みは上限で打ち切り済み）
+        return _dr(url, f"single large->{e.size} dr-fetch")
+    except requests.exceptions.ReadTimeout:
+        # ★ 3分でタイムアウト → 即DRへ
+        return _dr(url, "single stage1 ReadTimeout -> dr-fetch")
+    except Exception as e:
+        # GET自体に失敗 → DR
+        err = f"single error: {type(e).__name__}: {e}"
+        return _dr(url, f"single dr-fetch after error: {type(e).__name__}",
+                   none_status="ng", none_msg=err + ("; dr-fetch none" if DR_FETCH_ON_SERIAL else ""))
+
+    h = bodystore.body_hash(html)
+    WB.upsert_http_meta(url, etag, lm, status)
+    ct = (ctype or "").lower()
+
+    def _mark_extracted():
+        # 本文から抽出した行を書けた時だけ body_hash を残す（失敗・DR 経由なら次回も解析し直す）
+        WB.upsert_http_meta(url, etag, lm, status, h)
+
+    if html is None:
+        # 304 → 保存済みの内容から変化なし
+        if DR_ON_304:
+            return _dr(url, "single dr-fetch (304)")
+        log_run(url, "304", took, "single conditional get")
+        return False
 
-        if ct == "application/pdf":
-            with conn() as c:
-                changed = upsert_page(c, _row_from_pdf(url))
-                log_run(c, url, "ok" if changed else "skip", took, f"single pdf stage1")
+    if h == hash0:
+        # 前回と同じ本文 → 抽出しても変化しないので解析を省く（抽出で変化なし時と同じくDRへ）
+        return _dr(url, "single same body -> dr-fetch", none_msg="single same body")
+    bodystore.put(html, h)
+
+    if ct in ("text/html", "application/xhtml+xml"):
+        # meta refresh → PDF
+        m = re.search(r'http-equiv=["\']refresh["\'].*?url=([^";\']+\.pdf)', html, flags=re.I)
+        if m:
+            pdf_url = urljoin(url, m.group(1).strip())
+            changed = _upsert(row_from_pdf(pdf_url, _fetch_pdf(pdf_url)))
+            _mark_extracted()
+            log_run(url, "ok" if changed else "skip", took, "single html->pdf meta refresh")
             return changed
 
-        # その他 → DR
-        if DR_FETCH_ON_SERIAL:
-            txt = dr_fetch_text(url, max_chars=6000)
-            with conn() as c:
-                if txt:
-                    changed = _upsert_text_as_summary(url, txt)
-                    log_run(c, url, "ok" if changed else "skip", 0, f"single dr-fetch ctype={ct}")
-                    return changed
-                else:
-                    log_run(c, url, "skip", 0, f"single dr-fetch none ctype={ct}")
-        return False
+        # HTML抽出
+        changed = _upsert(extract_from_html(url, html))
+        _mark_extracted()
+        log_run(url, "ok" if changed else "skip", took, f"single html stage1 status={status}")
+        if not changed and DR_FETCH_ON_SERIAL:
+            return _dr(url, "single dr-fetch after html", none_msg="single dr-fetch none after html")
+        return changed
 
-    except requests.exceptions.ReadTimeout:
-        # ★ 3分でタイムアウト → 即DRへ
-        if DR_FETCH_ON_SERIAL:
-            txt = dr_fetch_text(url, max_chars=6000)
-            with conn() as c:
-                if txt:
-                    changed = _upsert_text_as_summary(url, txt)
-                    log_run(c, url, "ok" if changed else "skip", 0, "single stage1 ReadTimeout -> dr-fetch")
-                    return changed
-                else:
-                    log_run(c, url, "skip", 0, "single stage1 ReadTimeout -> dr-fetch none")
-        return False
+    if ct == "application/pdf":
+        changed = _upsert(row_from_pdf(url, html))
+        _mark_extracted()
+        log_run(url, "ok" if changed else "skip", took, f"single pdf stage1")
+        return changed
 
-    except Exception as e:
-        # GET自体に失敗 → DR
-        if DR_FETCH_ON_SERIAL:
-            txt = dr_fetch_text(url, max_chars=6000)
-            with conn() as c:
-                if txt:
-                    changed = _upsert_text_as_summary(url, txt)
-                    log_run(c, url, "ok" if changed else "skip", 0, f"single dr-fetch after error: {type(e).__name__}")
-                    return changed
-                else:
-                    log_run(c, url, "ng", 0, f"single error: {type(e).__name__}: {e}; dr-fetch none")
-                    return False
-        else:
-            with conn() as c:
-                log_run(c, url, "ng", 0, f"single error: {type(e).__name__}: {e}")
-            return False
+    # その他 → DR
+    if DR_FETCH_ON_SERIAL:
+        return _dr(url, f"single dr-fetch ctype={ct}")
+    return False
 
 def print_run_summary():
+    WB.flush()  # バッファ中の fetch_log を集計に含める
     with conn() as c, c.cursor() as cur:
         cur.execute(
             "select count(*) from public.pages "
@@ -231,7 +217,7 @@ def print_run_summary():
             """
             select status, count(*)
               from public.fetch_log
-             where position('run='||%s||';' in coalesce(error,'')) > 0
+             where run_id = %s
              group by status
             """,
             (RUN_ID,), prepare=False
@@ -241,6 +227,12 @@ def print_run_summary():
           f"skip={counts.get('skip',0)}, ng={counts.get('ng',0)}, "
           f"list={counts.get('list',0)}, seed={counts.get('seed',0)}, "
           f"pages_non_sentinel={pages_after}")
+    ps = pool_stats()
+    print(f"DB pool: acquire={ps['count']}, wait_total={int(ps['ms'])}ms, "
+          f"wait_max={int(ps['max_ms'])}ms, size={ps['size']}, round_trips={ps['round_trips']}")
+    for host, st in ratelimit.stats().items():
+        print(f"HOST {host}: rate={st['rate']}/s, req={st['requests']}, throttled={st['throttled']}, "
+              f"waited={st['waited_sec']}s, ewma={st['ewma_ms']}ms")
 
 # ========= 追加: 引数パース & 自己診断 & 簡易通常経路 =========
 
@@ -287,10 +279,16 @@ def run_lane(lane: str, batch: int, deadline: float) -> tuple[int,int,int]:
             break
         processed += 1
         try:
-            if process_one(u):
+            if process_one(u, backfill=True):
                 ok_like += 1
+                release_claim(u)
+            else:
+                mark_tried(u)
         except Exception:
             errors += 1
+            mark_tried(u)
+    for u in urls[processed:]:
+        release_claim(u)  # 手を付けなかった分は即返す
     return processed, ok_like, errors
 
 def main():
@@ -299,6 +297,9 @@ def main():
 
     start = time.time()
     deadline = start + HARD_KILL_SEC
+    # HARD_KILL_SEC 直前と SIGTERM（ジョブのタイムアウト）でもバッファを書き出す
+    WB.arm_deadline(deadline)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(143))
 
     args = parse_args(sys.argv[1:])
 
@@ -318,6 +319,8 @@ def main():
 
     # 簡易「通常」ラン
     if args.cmd == "run":
+        global LANE
+        LANE = args.lane
         processed, ok_like, errors = run_lane(args.lane, args.batch, deadline)
         if args.fail_on_seed_zero and processed == 0:
             logging.error("seed/対象なし（processed=0）")
@@ -330,12 +333,17 @@ def main():
     # 互換: 旧ENVベースのSINGLE_BACKFILL_ONE（指定時のみ）
     if SINGLE_BACKFILL_ONE:
         urls = pick_untitled_batch(max(1, SINGLE_MAX_TRY))
-        updated = False
+        updated = False; tried = 0
         for u in urls:
             if time_left(deadline) < 5: break
-            if process_one(u):
+            tried += 1
+            if process_one(u, backfill=True):
+                release_claim(u)
                 updated = True
                 break
+            mark_tried(u)
+        for u in urls[tried:]:
+            release_claim(u)
         if not urls: print("single: no untitled/empty-summary rows")
         elif not updated: print("single: tried but no update (ng/skip/304/dr)")
         print_run_summary()
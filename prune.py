@@ -0,0 +1,210 @@
+# prune.py
+# 古い行の削除（旧 prune.sql の置き換え）。どの削除も PRUNE_BATCH 行ずつ・1バッチ1トランザクションで行い、
+# 索引順に古い側から切っていく（keyset）ので、ロックを長く持たず、一度に大量の dead tuple も作らない。
+#   python prune.py                        … 全対象（fetch_log, pages, http_cache, score_cache）
+#   python prune.py --only fetch_log,pages
+#   python prune.py --partition-fetch-log  … fetch_log を日別パーティションに移行（初回だけ重い）。
+#                                            以降の fetch_log は保持期間を過ぎた日のパーティションを drop するだけ
+# 最後に対象ごとの削除行数と所要時間を出す（--json でファイルにも書く）。
+#
+# ENV:
+#   PRUNE_BATCH (既定: 5000)
+#   PRUNE_PAUSE_MS (既定: 50)           … バッチ間の休止（クロールの書き込みに譲る）
+#   PRUNE_LOG_DAYS (既定: 14)           … fetch_log（lib/schedule.py の SCHED_WINDOW_DAYS と揃える）
+#   PRUNE_PAGE_DAYS (既定: 90)
+#   PRUNE_PER_HOST (既定: 120)          … ホストごとに新しい順で残す pages の件数
+#   PRUNE_HTTP_CACHE_DAYS (既定: 730)
+#   PRUNE_SCORE_DAYS (既定: 30)         … score_cache（参照側は SCORE_CACHE_TTL_SEC より古いものを使わない）
+#   PRUNE_PART_AHEAD_DAYS (既定: 7)     … 先に作っておく fetch_log の日別パーティション
+
+import os, re, sys, json, time, argparse, logging
+from datetime import date, datetime, timedelta, timezone
+
+import psycopg
+from lib.db import ensure_schema, conn, bump_generation
+
+PRUNE_BATCH           = int(os.getenv("PRUNE_BATCH", "5000"))
+PRUNE_PAUSE_MS        = int(os.getenv("PRUNE_PAUSE_MS", "50"))
+PRUNE_LOG_DAYS        = int(os.getenv("PRUNE_LOG_DAYS", "14"))
+PRUNE_PAGE_DAYS       = int(os.getenv("PRUNE_PAGE_DAYS", "90"))
+PRUNE_PER_HOST        = int(os.getenv("PRUNE_PER_HOST", "120"))
+PRUNE_HTTP_CACHE_DAYS = int(os.getenv("PRUNE_HTTP_CACHE_DAYS", "730"))
+PRUNE_SCORE_DAYS      = int(os.getenv("PRUNE_SCORE_DAYS", "30"))
+PRUNE_PART_AHEAD_DAYS = int(os.getenv("PRUNE_PART_AHEAD_DAYS", "7"))
+
+STEPS = ("fetch_log", "pages", "http_cache", "score_cache")
+_PART = re.compile(r"fetch_log_p(\d{8})")
+
+log = logging.getLogger("prune")
+
+def _batched(sql: str, args: tuple = ()) -> int:
+    """最後の %s に PRUNE_BATCH を渡して、消えた行が PRUNE_BATCH 未満になるまで繰り返す"""
+    total = 0
+    while True:
+        with conn() as c:
+            n = c.execute(sql, (*args, PRUNE_BATCH), prepare=False).rowcount
+        total += n
+        if n < PRUNE_BATCH:
+            return total
+        time.sleep(PRUNE_PAUSE_MS / 1000)
+
+# ---- fetch_log ----
+
+def _today() -> date:
+    return datetime.now(timezone.utc).date()
+
+def _is_partitioned(c) -> bool:
+    row = c.execute("""select c.relkind = 'p' from pg_class c join pg_namespace n on n.oid = c.relnamespace
+                        where n.nspname = 'public' and c.relname = 'fetch_log'""", prepare=False).fetchone()
+    return bool(row and row[0])
+
+def _ensure_partitions(c, start: date, end: date):
+    """
+    [start, end] の日別パーティションを作る（境界は UTC の日付）。既定パーティションと重なる日は飛ばす。
+    1日ずつ savepoint（c.transaction()）で囲むので、partition_fetch_log の移行トランザクションの中で
+    失敗しても、その日だけ取り消して外側のトランザクションは続けられる
+    """
+    d = start
+    while d <= end:
+        try:
+            with c.transaction():
+                c.execute(f"create table if not exists public.fetch_log_p{d:%Y%m%d} partition of public.fetch_log "
+                          f"for values from ('{d}') to ('{d + timedelta(days=1)}')", prepare=False)
+        except psycopg.Error as e:  # 既定パーティションにその日の行が入っている等
+            log.warning("partition %s: %s", d, e)
+        d += timedelta(days=1)
+
+def partition_fetch_log() -> int:
+    """
+    fetch_log を fetched_at の日別パーティションに移す（保持期間内の行だけコピー）。コピーした行数を返す。
+    移行中は fetch_log を排他ロックするので、クロールの止まっている時間帯に1回だけ実行する。
+    """
+    start = _today() - timedelta(days=PRUNE_LOG_DAYS)
+    with conn() as c:
+        if _is_partitioned(c):
+            return 0
+        with c.transaction():
+            c.execute("lock table public.fetch_log in access exclusive mode", prepare=False)
+            c.execute("alter table public.fetch_log rename to fetch_log_old", prepare=False)
+            c.execute("alter table public.fetch_log_old rename constraint fetch_log_pkey to fetch_log_old_pkey",
+                      prepare=False)
+            c.execute("""create table public.fetch_log (like public.fetch_log_old including defaults)
+                           partition by range (fetched_at)""", prepare=False)
+            c.execute("alter table public.fetch_log add primary key (id, fetched_at)", prepare=False)
+            c.execute("create table public.fetch_log_default partition of public.fetch_log default", prepare=False)
+            _ensure_partitions(c, start, _today() + timedelta(days=PRUNE_PART_AHEAD_DAYS))
+            n = c.execute("insert into public.fetch_log select * from public.fetch_log_old where fetched_at >= %s",
+                          (start,), prepare=False).rowcount
+            # id の採番を新しい表に付け替えてから旧表を消す（旧表と一緒に sequence が消えないように）
+            c.execute("alter sequence public.fetch_log_id_seq owned by public.fetch_log.id", prepare=False)
+            c.execute("drop table public.fetch_log_old", prepare=False)
+    ensure_schema()  # 索引（idx_fetch_log_*）を親テーブルに作り直す
+    return n
+
+def prune_fetch_log() -> int:
+    cutoff = _today() - timedelta(days=PRUNE_LOG_DAYS)
+    dropped = 0
+    with conn() as c:
+        if _is_partitioned(c):
+            _ensure_partitions(c, _today(), _today() + timedelta(days=PRUNE_PART_AHEAD_DAYS))
+            parts = [r[0] for r in c.execute("""select c.relname from pg_inherits i join pg_class c on c.oid = i.inhrelid
+                                                 where i.inhparent = 'public.fetch_log'::regclass""",
+                                             prepare=False).fetchall()]
+            for name in sorted(parts):
+                m = _PART.fullmatch(name)
+                if not m or datetime.strptime(m[1], "%Y%m%d").date() + timedelta(days=1) > cutoff:
+                    continue
+                n = c.execute(f"select count(*) from public.{name}", prepare=False).fetchone()[0]
+                c.execute(f"drop table public.{name}", prepare=False)
+                log.info("dropped partition %s (%d rows)", name, n)
+                dropped += n
+    # 未パーティションの表、または既定パーティションに残った古い行
+    return dropped + _batched("""
+        with d as (select id from public.fetch_log
+                    where fetched_at < now() - make_interval(days => %s)
+                    order by fetched_at limit %s)
+        delete from public.fetch_log f using d where f.id = d.id""", (PRUNE_LOG_DAYS,))
+
+# ---- pages / http_cache / score_cache ----
+
+def prune_pages() -> int:
+    n = _batched("""
+        with d as (select url from public.pages
+                    where last_fetched < now() - make_interval(days => %s)
+                    order by last_fetched limit %s)
+        delete from public.pages p using d where p.url = d.url""", (PRUNE_PAGE_DAYS,))
+    # ホストごとに新しい順 PRUNE_PER_HOST 件を残す：境目の行 (last_fetched, url) より古い行を idx_pages_host の順に消す
+    # （並びは idx_pages_host と同じく last_fetched が null の行を最も古い扱いにする）
+    with conn() as c:
+        hosts = [r[0] for r in c.execute("select host from public.pages group by host having count(*) > %s",
+                                         (PRUNE_PER_HOST,), prepare=False).fetchall()]
+    for host in hosts:
+        with conn() as c:
+            edge = c.execute("""select last_fetched, url from public.pages where host = %s
+                                 order by coalesce(last_fetched,'-infinity'::timestamptz) desc, url desc
+                                 offset %s limit 1""",
+                             (host, PRUNE_PER_HOST - 1), prepare=False).fetchone()
+        if edge is None:
+            continue
+        n += _batched("""
+            with d as (select url from public.pages
+                        where host = %s
+                          and (coalesce(last_fetched,'-infinity'::timestamptz), url)
+                              < (coalesce(%s::timestamptz,'-infinity'::timestamptz), %s)
+                        order by coalesce(last_fetched,'-infinity'::timestamptz) desc, url desc limit %s)
+            delete from public.pages p using d where p.url = d.url""", (host, *edge))
+    if n:
+        with conn() as c:
+            bump_generation(c)  # recommend の応答キャッシュに消えた行を残さない
+    return n
+
+def prune_http_cache() -> int:
+    return _batched("""
+        with d as (select url from public.http_cache
+                    where last_checked_at < now() - make_interval(days => %s)
+                    order by last_checked_at limit %s)
+        delete from public.http_cache h using d where h.url = d.url""", (PRUNE_HTTP_CACHE_DAYS,))
+
+def prune_score_cache() -> int:
+    return _batched("""
+        with d as (select profile_hash, content_hash from public.score_cache
+                    where scored_at < now() - make_interval(days => %s)
+                    order by scored_at limit %s)
+        delete from public.score_cache s using d
+         where s.profile_hash = d.profile_hash and s.content_hash = d.content_hash""", (PRUNE_SCORE_DAYS,))
+
+def main(argv=None) -> int:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    p = argparse.ArgumentParser(prog="prune")
+    p.add_argument("--only", help="カンマ区切りで対象を限定（" + ",".join(STEPS) + "）")
+    p.add_argument("--partition-fetch-log", action="store_true", help="fetch_log を日別パーティションに移行してから削除")
+    p.add_argument("--json", help="結果を JSON で書き出すパス")
+    a = p.parse_args(argv)
+    only = [s.strip() for s in a.only.split(",")] if a.only else list(STEPS)
+    bad = [s for s in only if s not in STEPS]
+    if bad:
+        print(f"unknown target: {','.join(bad)}"); return 2
+
+    ensure_schema()
+    t0 = time.time()
+    report: dict[str, dict] = {}
+    steps = {"fetch_log": prune_fetch_log, "pages": prune_pages,
+             "http_cache": prune_http_cache, "score_cache": prune_score_cache}
+    if a.partition_fetch_log:
+        steps = {"fetch_log_migrate": partition_fetch_log, **steps}
+        only = ["fetch_log_migrate", *only]
+    for name in only:
+        t1 = time.time()
+        n = steps[name]()
+        report[name] = {"rows": n, "sec": round(time.time() - t1, 2)}
+        print(f"[PRUNE] {name}: {n} rows in {report[name]['sec']}s")
+    total = sum(v["rows"] for k, v in report.items() if k != "fetch_log_migrate")
+    print(f"PRUNE: deleted={total}, took={round(time.time() - t0, 2)}s")
+    if a.json:
+        with open(a.json, "w", encoding="utf-8") as f:
+            json.dump({"deleted": total, "took_sec": round(time.time() - t0, 2), "steps": report},
+                      f, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,61 @@
+# reextract.py
+# BODY_STORE_DIR に保存済みの本文から pages を抽出し直す（抽出ロジック改善後に再取得なしで反映する）
+#   python reextract.py --limit 500
+#   python reextract.py --url https://www.chusho.meti.go.jp/koukai/koubo/2025/k250314001.html
+# 変わった行だけ pages が更新され、fetch_log には lane=reextract で ok/skip が残る。
+
+import sys, time, argparse, logging
+
+from lib.db import ensure_schema, conn
+from lib.sink import WB
+from lib import bodystore
+from lib.extractors import extract_from_html
+from lib.pdf import row_from_pdf
+
+LANE = "reextract"
+
+def _targets(limit: int, url: str | None) -> list[tuple[str, str]]:
+    with conn() as c, c.cursor() as cur:
+        if url:
+            cur.execute("select url, body_hash from public.http_cache where url=%s and body_hash is not null",
+                        (url,), prepare=False)
+        else:
+            cur.execute("""select url, body_hash from public.http_cache
+                            where body_hash is not null
+                            order by last_checked_at desc nulls last limit %s""", (limit,), prepare=False)
+        return cur.fetchall()
+
+def main(argv=None) -> int:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    p = argparse.ArgumentParser(prog="reextract")
+    p.add_argument("--limit", type=int, default=500)
+    p.add_argument("--url")
+    a = p.parse_args(argv)
+    if not bodystore.BODY_STORE_DIR:
+        print("BODY_STORE_DIR is not set"); return 2
+
+    ensure_schema()
+    t0 = time.time()
+    changed: list[str] = []
+    done = missing = errors = 0
+    for url, h in _targets(a.limit, a.url):
+        data = bodystore.get(h)
+        if data is None:
+            missing += 1; continue
+        try:
+            if data.lstrip()[:5].lower() == b"%pdf-":
+                row = row_from_pdf(url, data)
+            else:
+                row = extract_from_html(url, data.decode("utf-8", errors="replace"))
+            WB.upsert_page(row, 0, "reextract", lane=LANE, on_change=changed.append)
+            done += 1
+        except Exception as e:
+            errors += 1
+            WB.log_fetch(url, "ng", 0, f"reextract error: {e}", lane=LANE)
+    WB.flush()
+    print(f"REEXTRACT: done={done}, changed={len(changed)}, missing_body={missing}, errors={errors}, "
+          f"took={int(time.time() - t0)}s")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -16,20 +16,128 @@ create table if not exists public.pages(
   last_fetched  timestamptz default now()
 );
 
-do $$ begin
-  if not exists (
+-- 全文検索：文字2-gram の tsvector（日本語は空白で区切られないので 'simple' の語単位では部分一致しない）
+-- NFKC・小文字化して英数字/かな/漢字の連続（・や記号で区切る）ごとに2文字ずつ切り、連続の最後の1文字も入れる
+-- （1文字の検索語は前方一致 'x':* なので、どの位置の文字も 2-gram の先頭か最後の1文字で引ける）。
+-- 問い合わせ側（lib/pagesearch.ngram_query）も同じ規則で切って & で結ぶ
+create or replace function public.ngram_tsv(t text) returns tsvector
+language sql immutable parallel safe as $$
+  select coalesce(array_to_tsvector(array_agg(distinct g)), ''::tsvector)
+    from regexp_split_to_table(lower(normalize(coalesce(t,''), NFKC)),
+                               '[^0-9a-z\u3040-\u30fa\u30fc-\u30ff\u3400-\u9fff\uf900-\ufaff々〆]+') w,
+         lateral (select substr(w, i, 2) g from generate_series(1, length(w)-1) i
+                   union all select right(w, 1)) s
+   where w <> ''
+$$;
+-- 列の追加・削除は無い時/有る時だけ実行する（if not exists 付きの alter table でも
+-- ensure_schema のたびに ACCESS EXCLUSIVE ロックを取ってクロールの書き込みを止めるため）。
+-- search_ngrams は ngram_tsv の規則を変えたら列コメントの版を上げる（古い版の列は作り直して全行を切り直す）
+do $$
+begin
+  if coalesce(col_description('public.pages'::regclass,
+       (select attnum from pg_attribute where attrelid='public.pages'::regclass
+           and attname='search_ngrams' and not attisdropped)), '') <> 'ngram_tsv v2' then
+    execute 'alter table public.pages drop column if exists search_ngrams';
+    execute $ddl$alter table public.pages add column search_ngrams tsvector generated always as
+      (public.ngram_tsv(coalesce(title,'')||' '||coalesce(summary,'')||' '||
+                        coalesce(target,'')||' '||coalesce(cost_items,''))) stored$ddl$;
+    execute $ddl$comment on column public.pages.search_ngrams is 'ngram_tsv v2'$ddl$;
+  end if;
+end $$;
+create index if not exists idx_pages_ngrams on public.pages using gin(search_ngrams);
+-- 旧 to_tsvector('simple') 列（と idx_pages_tokens）は search_ngrams に置き換え
+do $$
+begin
+  if exists (
     select 1 from information_schema.columns
      where table_schema='public' and table_name='pages' and column_name='tokens'
   ) then
-    alter table public.pages add column tokens tsvector generated always as
-      (to_tsvector('simple',
-        coalesce(title,'')||' '||coalesce(summary,'')||' '||
-        coalesce(target,'')||' '||coalesce(cost_items,''))) stored;
-    create index if not exists idx_pages_tokens on public.pages using gin(tokens);
-    create index if not exists idx_pages_last   on public.pages(last_fetched desc);
+    execute 'alter table public.pages drop column tokens';
+  end if;
+end $$;
+
+-- 締切（deadline は「令和7年5月8日(木)17:00」等の文字列）を date にする。読めなければ null
+create or replace function public.jp_date(t text) returns date
+language plpgsql immutable parallel safe as $$
+declare m text[]; y int;
+begin
+  m := regexp_match(t, '(令和|平成|R|H)?\s*(\d{1,4}|元)\s*[年/.\-]\s*(\d{1,2})\s*[月/.\-]\s*(\d{1,2})');
+  if m is null then return null; end if;
+  y := case when m[2]='元' then 1 else m[2]::int end;
+  y := case when m[1] in ('令和','R') then 2018+y when m[1] in ('平成','H') then 1988+y else y end;
+  if y < 1900 then return null; end if;
+  return make_date(y, m[3]::int, m[4]::int);
+exception when others then
+  return null;
+end $$;
+do $$
+begin
+  if not exists (
+    select 1 from information_schema.columns
+     where table_schema='public' and table_name='pages' and column_name='deadline_date'
+  ) then
+    execute 'alter table public.pages add column deadline_date date generated always as (public.jp_date(deadline)) stored';
   end if;
 end $$;
 
+-- 一覧のキーセット・ページング（lib/pagesearch.py の order by と一致）と絞り込み用。
+-- last_fetched が null の行も (値, url) の比較で落ちないよう、null は最も古い '-infinity' として並べる。
+-- 以前の last_fetched そのままの索引は作り直す
+do $$
+declare r record;
+begin
+  for r in select indexname from pg_indexes
+            where schemaname='public' and tablename='pages'
+              and indexname in ('idx_pages_keyset','idx_pages_fy','idx_pages_scheme','idx_pages_host')
+              and indexdef not ilike '%coalesce%'
+  loop
+    execute format('drop index public.%I', r.indexname);
+  end loop;
+end $$;
+create index if not exists idx_pages_keyset   on public.pages(coalesce(last_fetched,'-infinity'::timestamptz) desc, url desc);
+drop index if exists public.idx_pages_last;  -- idx_pages_keyset の先頭列と重複
+create index if not exists idx_pages_fy       on public.pages(fiscal_year, coalesce(last_fetched,'-infinity'::timestamptz) desc, url desc);
+create index if not exists idx_pages_scheme   on public.pages(scheme_type, coalesce(last_fetched,'-infinity'::timestamptz) desc, url desc);
+create index if not exists idx_pages_deadline on public.pages(deadline_date) where deadline_date is not null;
+
+-- ホスト（prune.py がホストごとに新しい順 PRUNE_PER_HOST 件だけ残すのに使う）
+do $$
+begin
+  if not exists (
+    select 1 from information_schema.columns
+     where table_schema='public' and table_name='pages' and column_name='host'
+  ) then
+    execute $ddl$alter table public.pages add column host text
+      generated always as (split_part(split_part(url, '//', 2), '/', 1)) stored$ddl$;
+  end if;
+end $$;
+create index if not exists idx_pages_host on public.pages(host, coalesce(last_fetched,'-infinity'::timestamptz) desc, url desc);
+
+-- バックフィルで最後に試した時刻（直らなかった行は後回しにして、同じ先頭の行ばかり引かないように）
+do $$
+begin
+  if not exists (
+    select 1 from information_schema.columns
+     where table_schema='public' and table_name='pages' and column_name='backfill_tried_at'
+  ) then
+    execute 'alter table public.pages add column backfill_tried_at timestamptz';
+  end if;
+end $$;
+
+-- (無題)/空要約のバックフィル対象だけを未試行→古い順に引く部分索引（pick_untitled_batch の述語・順序と一致させる）
+create index if not exists idx_pages_backfill_tried on public.pages(backfill_tried_at asc nulls first, last_fetched asc nulls first)
+  where title='(無題)' or coalesce(summary,'')='';
+drop index if exists public.idx_pages_backfill;  -- idx_pages_backfill_tried に置き換え
+
+-- バックフィルの取得権（リース）。lease_until を過ぎた行は他のワーカーが取り直せる
+create table if not exists public.backfill_claims(
+  url         text primary key,
+  claimed_by  text not null,
+  lease_until timestamptz not null
+);
+
+-- prune.py --partition-fetch-log で日別パーティション（fetched_at の range）に移行できる。
+-- 移行後は主キーが (id, fetched_at) になり、古いログはパーティションごと drop される
 create table if not exists public.fetch_log(
   id         bigserial primary key,
   url        text,
@@ -39,6 +147,31 @@ create table if not exists public.fetch_log(
   fetched_at timestamptz default now()
 );
 
+-- run_id / lane を構造化列に（サマリは run_id の索引で引く。error 文字列の走査はしない）
+do $$
+begin
+  if not exists (
+    select 1 from information_schema.columns
+     where table_schema='public' and table_name='fetch_log' and column_name='run_id'
+  ) then
+    execute 'alter table public.fetch_log add column run_id text';
+  end if;
+end $$;
+do $$
+begin
+  if not exists (
+    select 1 from information_schema.columns
+     where table_schema='public' and table_name='fetch_log' and column_name='lane'
+  ) then
+    execute 'alter table public.fetch_log add column lane text';
+  end if;
+end $$;
+create index if not exists idx_fetch_log_run     on public.fetch_log(run_id, status);
+create index if not exists idx_fetch_log_lane    on public.fetch_log(lane, fetched_at desc);
+create index if not exists idx_fetch_log_fetched on public.fetch_log(fetched_at);
+-- 再クロールスケジューラ（lib/schedule.py）が URL ごとの履歴を引く
+create index if not exists idx_fetch_log_url     on public.fetch_log(url, fetched_at desc);
+
 create table if not exists public.http_cache(
   url             text primary key,
   etag            text,
@@ -47,6 +180,17 @@ create table if not exists public.http_cache(
   last_checked_at timestamptz,
   last_changed_at timestamptz
 );
+-- 本文（取得した bytes）の md5。ETag 等を無視して同じ本文を返すサーバでも解析前に未変更を判定する
+do $$
+begin
+  if not exists (
+    select 1 from information_schema.columns
+     where table_schema='public' and table_name='http_cache' and column_name='body_hash'
+  ) then
+    execute 'alter table public.http_cache add column body_hash text';
+  end if;
+end $$;
+create index if not exists idx_http_cache_checked on public.http_cache(last_checked_at);
 
 create table if not exists public.api_quota(
   month       text not null,
@@ -65,3 +209,22 @@ begin
     execute 'alter table public.api_quota rename column "limit" to quota_limit';
   end if;
 end $$;
+
+-- LLM 採点のキャッシュ（core_cached.recommend_from_db）。profile_hash は正規化したプロファイル＋モデル名の md5
+create table if not exists public.score_cache(
+  profile_hash text not null,
+  content_hash text not null,
+  score        real not null,
+  reasons      jsonb not null default '[]'::jsonb,
+  scored_at    timestamptz not null default now(),
+  primary key (profile_hash, content_hash)
+);
+create index if not exists idx_score_cache_scored on public.score_cache(scored_at);
+
+-- 世代番号（pages が変わるたびに +1。recommend の応答キャッシュの無効化に使う）
+create table if not exists public.cache_generation(
+  name      text primary key,
+  gen       bigint not null default 0,
+  bumped_at timestamptz not null default now()
+);
+insert into public.cache_generation(name) values('pages') on conflict(name) do nothing;
@@ -0,0 +1,25 @@
+# lib/extractors.py の extract_fields（本文1回走査のラベル抽出）
+from lib.extractors import extract_fields, _NAMES
+
+def test_extract_fields_labels():
+    got = extract_fields("令和7年度 第2次公募\n補助率：2/3\n補助上限額 1,000万円\n対象者：中小企業者\n"
+                         "対象経費：機械装置費\n申請締切：令和7年5月8日(木)17:00")
+    assert got == dict(got, fiscal_year="令和7年度", call_no="2", rate="2/3", cap="1,000万円",
+                       target="中小企業者", cost_items="機械装置費", deadline="令和7年5月8日(木)17:00")
+
+def test_extract_fields_normalizes_fullwidth():
+    got = extract_fields("助成率は１／２ 限度額５００万円。対象：小規模事業者。受付期限 2025/6/30")
+    assert (got["rate"], got["cap"], got["target"], got["deadline"]) == ("1/2", "500万円", "小規模事業者", "2025/6/30")
+
+def test_extract_fields_prefers_lower_rank():
+    # 「対象者」(rank 0) は先に出た「対象」(rank 1) より優先。「対象経費」「対象外」は target にしない
+    assert extract_fields("対象：全国の事業者\n対象者：中小企業者")["target"] == "中小企業者"
+    assert extract_fields("対象経費：広告費\n対象外経費：人件費")["target"] is None
+
+def test_extract_fields_period_fills_deadline():
+    got = extract_fields("公募期間：2025/4/1 ～ 2025/5/31\n本補助金は")
+    assert (got["period_from"], got["period_to"], got["deadline"], got["scheme_type"]) == \
+        ("2025/4/1", "2025/5/31", "2025/5/31", "補助金")
+
+def test_extract_fields_empty():
+    assert extract_fields(None) == extract_fields("") == {n: None for n in _NAMES}
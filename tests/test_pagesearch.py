@@ -0,0 +1,55 @@
+# lib/pagesearch.py の純粋関数（DB なし）
+from datetime import datetime, timezone
+import pytest
+from lib.pagesearch import ngram_query, encode_cursor, decode_cursor, normalize_filters, where_clause
+
+def test_ngram_query_bigrams():
+    assert ngram_query("補助金") == "'補助' & '助金'"
+
+def test_ngram_query_single_char_is_prefix():
+    assert ngram_query("国") == "'国':*"
+
+def test_ngram_query_normalizes_and_dedups():
+    # 全角英数は NFKC・小文字化、重複する 2-gram は1回だけ
+    assert ngram_query("ＩＴ導入 it") == "'it' & 't導' & '導入'"
+    assert ngram_query("ああああ") == "'ああ'"
+
+def test_ngram_query_drops_operators():
+    assert ngram_query("a & b | !c'") == "'a':* & 'b':* & 'c':*"
+    assert ngram_query("") is None and ngram_query(None) is None and ngram_query("!!") is None
+
+def test_cursor_round_trip():
+    lf=datetime(2025,5,8,17,0,tzinfo=timezone.utc)
+    url="https://example.go.jp/補助金?id=1"
+    assert decode_cursor(encode_cursor({"last_fetched":lf,"url":url})) == (lf.isoformat(),url)
+    # last_fetched が null の行（'-infinity' 扱い）も次ページを指せる
+    assert decode_cursor(encode_cursor({"last_fetched":None,"url":url})) == (None,url)
+
+@pytest.mark.parametrize("bad", ["", "not-base64!", "WyJ4Il0", "WyJub3QtYS1kYXRlIiwgInUiXQ"])
+def test_decode_cursor_rejects_garbage(bad):
+    # 順に: 空 / base64 でない / 要素が1つ / 日時でない last_fetched
+    with pytest.raises(ValueError):
+        decode_cursor(bad)
+
+def test_where_clause_keyset_uses_coalesce():
+    where,args=where_clause(None, encode_cursor({"last_fetched":None,"url":"u"}), None)
+    assert "coalesce(last_fetched,'-infinity'::timestamptz), url) <" in where and args == [None,"u"]
+
+def test_normalize_filters_accepts():
+    assert normalize_filters({"fiscal_year":2025, "scheme_type":["一般型","特別枠"], "deadline_after":"2025-01-31",
+                              "deadline_before":"", "other":"x"}) == \
+        {"fiscal_year":["2025"], "scheme_type":["一般型","特別枠"], "deadline_after":"2025-01-31"}
+    assert normalize_filters({"fiscal_year":[], "scheme_type":None}) == {}
+
+@pytest.mark.parametrize("d", [
+    {"fiscal_year":{"$gt":1}},
+    {"fiscal_year":[2025,None]},
+    {"scheme_type":True},
+    {"scheme_type":[["nested"]]},
+    {"deadline_after":"2025-13-01"},
+    {"deadline_after":"令和7年5月8日"},
+    {"deadline_before":20250101},
+])
+def test_normalize_filters_rejects(d):
+    with pytest.raises(ValueError):
+        normalize_filters(d)
@@ -0,0 +1,46 @@
+# cloudrun/functions/recommend/main.py の純粋関数（DB・LLM なし）
+import os, sys, importlib
+import pytest
+from lib.pagesearch import encode_cursor
+
+pytest.importorskip("flask"); pytest.importorskip("openai")
+FN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "cloudrun", "functions", "recommend")
+
+@pytest.fixture(scope="module")
+def fn():
+    os.environ.setdefault("OPENAI_API_KEY", "test")  # OpenAI() の生成だけ通す（呼ばない）
+    sys.path.insert(0, FN_DIR)
+    try:
+        yield importlib.import_module("main")
+    finally:
+        sys.path.remove(FN_DIR)
+
+def test_pref_key_strips_only_the_suffix(fn):
+    assert fn._pref_key("京都府") == "京都"
+    assert fn._pref_key("東京都") == "東京"
+    assert fn._pref_key("北海道") == "北海道"
+    assert fn._pref_key("京都府") != fn._pref_key("東京都")
+
+def test_prerank_does_not_confuse_kyoto_and_tokyo(fn):
+    rows=[{"url":"t","title":"東京都 創業助成"}, {"url":"k","title":"京都府 創業助成"}]
+    got={it["url"]:it["score"] for it in fn._prerank([dict(r) for r in rows], {"所在地_都道府県":"京都府"}, "創業")}
+    assert got["k"]-got["t"] == 2*fn.PREF_BONUS
+    # "京" 1文字では地域限定と見なさない（京浜 は京都府の制度ではない）
+    assert fn.PREF_RE.findall("京浜地区の事業者") == []
+
+def test_page_walks_the_whole_pool_then_the_next(fn):
+    ranked=list(range(70)); seen=[]; cur=None; start=None
+    pool2=encode_cursor({"last_fetched":None,"url":"u"})
+    for _ in range(3):
+        off=0 if cur is None else fn._decode_pool_cursor(cur)[1]
+        page,cur=fn._page(ranked,start,off,pool2,30)
+        seen += page
+    assert seen == ranked                              # 31件目以降も取りこぼさない
+    assert fn._decode_pool_cursor(cur) == (pool2,0)     # 返し切ったら次の候補集合の先頭
+    assert fn._page(ranked,None,60,None,30) == (ranked[60:],None)
+
+@pytest.mark.parametrize("bad", ["", "!!", "WyJ4IiwgMF0", "W251bGwsIC0xXQ", "W251bGwsIHRydWVd"])
+def test_decode_pool_cursor_rejects_garbage(fn, bad):
+    # 順に: 空 / base64 でない / 開始カーソルが不正 / 負の位置 / 位置が bool
+    with pytest.raises(ValueError):
+        fn._decode_pool_cursor(bad)
@@ -0,0 +1,29 @@
+# crawl_incremental._Requeue（429/5xx を受けた一覧・詳細URLの再投入）
+import time
+import pytest
+
+pytest.importorskip("requests"); pytest.importorskip("psycopg_pool")
+import crawl_incremental as ci
+from lib.http_client import RetryLater
+
+def test_ready_returns_listing_src_and_details_in_due_order():
+    rq = ci._Requeue(); far = time.time() + 60; src = {"url": "https://a.example/list"}
+    rq.push(RetryLater("https://a.example/d", 503, 0.0), far)
+    rq.push(RetryLater(src["url"], 429, 0.0), far, src)
+    rq.push(RetryLater("https://a.example/later", 503, 30.0), far)
+    assert sorted(rq.ready(), key=str) == [("https://a.example/d", None), (src["url"], src)]
+    assert [u for _, u in rq.heap] == ["https://a.example/later"]
+
+def test_gives_up_after_max_requeue_or_past_deadline(monkeypatch):
+    monkeypatch.setattr(ci, "MAX_REQUEUE", 1)
+    monkeypatch.setattr(ci, "L", lambda *a, **k: None)  # gave up の fetch_log は書かない
+    rq = ci._Requeue(); e = RetryLater("https://a.example/d", 503, 1.0)
+    assert rq.allow(e, time.time() + 60) and not rq.allow(e, time.time() + 60)
+    assert not ci._Requeue().allow(e, time.time() + 0.5)  # 待つと締切を過ぎる
+
+def test_process_listing_returns_retry_later(monkeypatch):
+    monkeypatch.setattr(ci, "_listing_due", lambda u, d: True)
+    def limited(u): raise RetryLater(u, 429, 5.0)
+    monkeypatch.setattr(ci, "acquire", limited)
+    res = ci.process_listing({"url": "https://a.example/list"}, time.time() + 60)
+    assert isinstance(res, RetryLater) and res.url == "https://a.example/list"
@@ -0,0 +1,24 @@
+# lib/schedule.py の interval_sec（変更頻度と連続未変更回数からの再取得間隔）
+import pytest
+from lib import schedule
+from lib.schedule import interval_sec
+
+@pytest.fixture(autouse=True)
+def _limits(monkeypatch):
+    for k, v in dict(SCHED_MIN_SEC=3600, SCHED_BASE_SEC=21600, SCHED_MAX_SEC=604800, SCHED_LIST_MAX_SEC=7200).items():
+        monkeypatch.setattr(schedule, k, v)
+
+def test_interval_from_change_rate():
+    assert interval_sec(10 * 86400, 5, 0) == 86400       # 10日で5回 → 1日
+    assert interval_sec(None, 0, 0) == 21600              # 変更の観測なし → SCHED_BASE_SEC
+
+def test_interval_clamped_to_min_and_cap():
+    assert interval_sec(3600, 100, 0) == 3600             # 頻繁すぎても SCHED_MIN_SEC
+    assert interval_sec(365 * 86400, 1, 0) == 604800      # 詳細の上限
+    assert interval_sec(365 * 86400, 1, 0, kind="list") == 7200
+    assert interval_sec(None, 0, 0, kind="list") == 7200  # 一覧は基本間隔も上限で丸める
+
+def test_interval_backs_off_on_unchanged_streak():
+    assert [interval_sec(None, 0, s) for s in range(4)] == [21600, 43200, 86400, 172800]
+    assert interval_sec(None, 0, 10**6) == 604800         # 指数が大きくても上限（2^16 で打ち切り）
+    assert interval_sec(3600, 100, 1, kind="list") == 7200
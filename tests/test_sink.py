@@ -0,0 +1,60 @@
+# lib/sink.py：まとめ書きが失敗した時の1行ずつの書き直しと、書けなかった行の再投入
+import os, uuid
+import pytest
+
+pytest.importorskip("psycopg_pool")
+from lib import sink
+from lib.sink import WriteBehind
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+needs_db = pytest.mark.skipif(not os.getenv("DATABASE_URL"), reason="DATABASE_URL が無い（DB に書くテスト）")
+
+@pytest.fixture
+def wb():
+    w = WriteBehind(max_rows=10**6, flush_sec=3600)  # 自動 flush はさせない
+    yield w
+    w._stop.set(); w._wake.set()
+
+def test_requeue_keeps_newer_value_and_counts_retries(wb):
+    wb._pages["u"] = ["new"]
+    wb._requeue({"u": ["old"], "v": ["v0"]}, {}, [("v", 1, None, "t", None)], [("log",)], {})
+    assert wb._pages == {"u": ["new"], "v": ["v0"]}
+    assert [pl[0] for pl in wb._page_logs] == ["v"] and wb._logs == [("log",)]
+    assert wb.stats["retried"] == 3
+
+def test_requeue_drops_after_max_retry_and_logs_ng(wb, monkeypatch):
+    monkeypatch.setattr(sink, "WB_MAX_RETRY", 1)
+    for _ in range(2):
+        wb._pages.clear(); wb._page_logs.clear(); wb._logs.clear()
+        wb._requeue({"u": ["x"]}, {}, [("u", 5, None, "t", None)], [], {})
+    assert wb._pages == {} and (wb.stats["retried"], wb.stats["dropped"]) == (1, 1)
+    assert wb._logs[0][:4] == ("u", "ng", 5, "write-behind: page write failed")
+
+@needs_db
+def test_flush_falls_back_to_row_by_row(wb, monkeypatch):
+    from lib.db import conn, ensure_schema
+    monkeypatch.chdir(ROOT); ensure_schema()
+    base = f"https://test.invalid/{uuid.uuid4().hex}/"
+    changed = []
+    try:
+        for i in range(2):
+            wb.upsert_page({"url": f"{base}{i}", "title": f"t{i}", "summary": "s"}, 1, None, lane="test", on_change=changed.append)
+        wb.upsert_page({"url": f"{base}bad", "title": None}, 1, None, lane="test", on_change=changed.append)  # title は not null
+        wb.log_fetch(f"{base}log", "ok", 1, None, lane="test")
+
+        assert wb.flush() == 2
+        assert sorted(changed) == [f"{base}0", f"{base}1"]  # 良い行は書けて通知される
+        assert wb.stats["errors"] == 1 and list(wb._pages) == [f"{base}bad"]  # 悪い行だけ残る
+
+        for _ in range(sink.WB_MAX_RETRY + 1): wb.flush()
+        assert wb._pages == {} and wb.stats["dropped"] == 1
+        with conn() as c:
+            pages = c.execute("select url from public.pages where url like %s order by 1", (base + "%",)).fetchall()
+            logs = c.execute("select url, status from public.fetch_log where url like %s order by id", (base + "%",)).fetchall()
+        assert [u for u, in pages] == [f"{base}0", f"{base}1"]
+        assert (f"{base}log", "ok") in logs and (f"{base}bad", "ng") in logs
+        assert logs.count((f"{base}0", "ok")) == 1
+    finally:
+        with conn() as c:
+            c.execute("delete from public.pages where url like %s", (base + "%",))
+            c.execute("delete from public.fetch_log where url like %s", (base + "%",))
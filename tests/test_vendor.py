@@ -0,0 +1,13 @@
+# Cloud Function に同梱した lib のコピーが元と一致しているか（python -m pytest -q tests）
+import os, importlib.util
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+VENDOR = os.path.join(HERE, "..", "cloudrun", "functions", "recommend", "vendor.py")
+
+def _vendor():
+    spec = importlib.util.spec_from_file_location("recommend_vendor", VENDOR)
+    mod = importlib.util.module_from_spec(spec); spec.loader.exec_module(mod)
+    return mod
+
+def test_vendored_copies_match_lib():
+    assert _vendor().stale() == [], "python cloudrun/functions/recommend/vendor.py を実行してコピーもコミットする"